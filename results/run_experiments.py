@@ -664,11 +664,13 @@ def I_experiment(dataset, g, m, k, C):
     else:
         iter_vals = list(range(1, max_I + 1))
 
-    for I in iter_vals:
-        fastsk = FastskRunner(dataset)
-        acc, auc, _ = fastsk.train_and_test(
-            g, m, t=1, approx=True, I=I, delta=0.025, C=C
-        )
+    # a single kernel computation, with a snapshot at every value of I
+    fastsk = FastskRunner(dataset)
+    snapshots = fastsk.train_and_test_snapshots(
+        g, m, t=1, iters=iter_vals, I=max_I, delta=0.025, C=C
+    )
+    for snapshot, acc, auc in snapshots:
+        I = snapshot["iters"]
         log_str = "{}: I = {}, auc = {}, acc = {}".format(dataset, I, auc, acc)
         print(log_str)
         results["I"].append(I)
@@ -704,12 +706,15 @@ def delta_experiment(dataset, g, m, k, C):
     }
 
     max_I = int(special.comb(g, m))
-    delta_vals = [0.005 * i for i in range(20)] + [0.1 * i for i in range(1, 11)]
-    for d in delta_vals:
-        fastsk = FastskRunner(dataset)
-        acc, auc, _ = fastsk.train_and_test(
-            g, m, t=1, approx=True, I=max_I, delta=d, C=C
-        )
+    delta_vals = [0.005 * i for i in range(1, 20)] + [0.1 * i for i in range(1, 11)]
+    # a single kernel computation, run until the smallest delta, with a
+    # snapshot at every delta
+    fastsk = FastskRunner(dataset)
+    snapshots = fastsk.train_and_test_snapshots(
+        g, m, t=1, deltas=delta_vals, I=max_I, delta=min(delta_vals), C=C
+    )
+    for snapshot, acc, auc in snapshots:
+        d = snapshot["delta"]
         log_str = "{}: d = {}, acc = {}, auc = {}".format(dataset, d, acc, auc)
         print(log_str)
         results["delta"].append(d)
@@ -1144,17 +1149,22 @@ def stdev_and_auc_vs_iters_experiments(params, output_dir):
         # include max
         iters += [max_I]
 
-    for I in tqdm(iters):
+    # one kernel computation per sample, with a snapshot at every number of iters
+    samples = []
+    for i in tqdm(range(5)):
+        fastsk = FastskRunner(dataset)
+        snapshots = fastsk.train_and_test_snapshots(
+            g, m, t=1, iters=iters, I=max_I, delta=0.025, C=C
+        )
+        samples.append(
+            {s["iters"]: (acc, auc, s["stdev"]) for s, acc, auc in snapshots}
+        )
+
+    for I in iters:
         results["iters"].append(I)
         sample_accs, sample_aucs, sample_stdevs = [], [], []
         for i in range(5):
-            fastsk = FastskRunner(dataset)
-            acc, auc = fastsk.train_and_test(
-                g, m, t=1, approx=True, I=I, delta=0.025, C=C
-            )
-            stdevs = fastsk.stdevs
-            assert len(stdevs) == I
-            stdev = stdevs[-1]
+            acc, auc, stdev = samples[i][I]
 
             log_str = "{}: I = {}, auc = {}, acc = {}, stdevs = {}"
             log_str = log_str.format(dataset, I, auc, acc, stdev)
@@ -10,47 +10,43 @@ import sys
 import pandas as pd
 from tqdm import tqdm
 
-from utils import FastskRunner
+from fastsk import Dataset, FastaUtility, grid_search
 
 min_g, max_g = 4, 15
 G_VALS = list(range(min_g, max_g + 1))
 C_VALS = [10 ** i for i in range(-3, 3)]
-GRID = []
-for C in C_VALS:
-    for g in G_VALS:
-        for m in range(0, g - 2):
-            k = g - m
-            GRID.append({"C": C, "g": g, "m": m})
+# every m with k = g - m >= 3, the grid_search default
+NUM_RUNS = sum(g - 2 for g in G_VALS) * len(C_VALS)
 
+DATA_LOCATION = "../data"
 DATASETS_CSV = "spreadsheets/datasets_to_use.csv"
 OUTPUT_CSV = "gridsearch_results.csv"
+# every (g, m, C) result, appended as soon as it is known
+ALL_RESULTS_CSV = "gridsearch_all_results.csv"
 
 
 def run_gridsearch(dataset):
     best_auc, best_params = 0, {}
 
-    iterator = tqdm(GRID, desc="{} grid search".format(dataset), total=len(GRID))
-
-    for param_vals in iterator:
-        C, g, m = param_vals["C"], param_vals["g"], param_vals["m"]
-        k = g - m
-
-        fastsk = FastskRunner(dataset)
-        acc, auc = fastsk.train_and_test(g, m, t=1, approx=True, C=C)
-
-        params = {
-            "dataset": dataset,
-            "g": g,
-            "m": m,
-            "k": k,
-            "C": C,
-            "delta": 0.025,
-            "acc": acc,
-            "auc": auc,
-        }
+    reader = FastaUtility()
+    Xtrain, Ytrain = reader.read_data(osp.join(DATA_LOCATION, dataset + ".train.fasta"))
+    Xtest, Ytest = reader.read_data(osp.join(DATA_LOCATION, dataset + ".test.fasta"))
+
+    results = grid_search(
+        Dataset(Xtrain, Xtest),
+        Ytrain,
+        Ytest,
+        G_VALS,
+        C_VALS,
+        t=1,
+        output=ALL_RESULTS_CSV,
+        extra={"dataset": dataset},
+    )
+    iterator = tqdm(results, desc="{} grid search".format(dataset), total=NUM_RUNS)
 
-        if auc > best_auc:
-            best_auc = auc
+    for params in iterator:
+        if params["auc"] > best_auc:
+            best_auc = params["auc"]
             best_params = params
 
     print(best_params)
@@ -65,7 +61,6 @@ def run_gridsearches(datasets):
             "m",
             "k",
             "C",
-            "delta",
             "acc",
             "auc",
         ]
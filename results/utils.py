@@ -23,82 +23,52 @@ def time_fastsk(
     timeout=None,
     skip_variance=False,
 ):
-    """Run FastSK kernel computation. If a timeout is provided,
-    it'll run as a subprocess, which will be killed when the timeout is
-    reached.
+    """Run FastSK kernel computation. If a timeout is provided, the
+    computation is stopped when the timeout is reached.
     """
     fastsk = FastskRunner(prefix, data_location)
 
-    start = time.time()
-    if timeout:
-        if max_iters:
-            args = {
-                "t": t,
-                "approx": approx,
-                "skip_variance": skip_variance,
-                "I": max_iters,
-            }
-        else:
-            args = {"t": t, "approx": approx, "skip_variance": skip_variance}
-        p = multiprocessing.Process(
-            target=fastsk.compute_train_kernel,
-            name="TimeFastSK",
-            args=(g, m),
-            kwargs=args,
-        )
-        p.start()
-        p.join(timeout)
-        if p.is_alive():
-            p.terminate()
-            p.join()
-    else:
-        if max_iters:
-            fastsk.compute_train_kernel(
-                g, m, t=t, approx=approx, I=max_iters, skip_variance=skip_variance
-            )
-        else:
-            fastsk.compute_train_kernel(
-                g, m, t=t, approx=approx, skip_variance=skip_variance
-            )
+    args = {
+        "t": t,
+        "approx": approx,
+        "skip_variance": skip_variance,
+        "timeout": timeout,
+    }
+    if max_iters:
+        args["I"] = max_iters
 
+    start = time.time()
+    try:
+        fastsk.compute_train_kernel(g, m, **args)
+    except TimeoutError:
+        pass
     end = time.time()
 
     return end - start
 
 
-def fastsk_wrap(dataset, g, m, t, approx, I, delta, skip_variance, C, return_dict):
-    fastsk = FastskRunner(dataset)
-    acc, auc = fastsk.train_and_test(g, m, t, I, approx, skip_variance, C)
-    return_dict["acc"] = acc
-    return_dict["auc"] = auc
-
-
 def train_and_test_fastsk(
     dataset, g, m, t, approx, I=50, delta=0.025, skip_variance=False, C=1, timeout=None
 ):
+    """Train and evaluate FastSK. If the kernel computation reaches the
+    timeout, acc and auc are 0.
+    """
     start = time.time()
-    if timeout:
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-        p = multiprocessing.Process(
-            target=fastsk_wrap,
-            name="Train and test FastSK",
-            args=(dataset, g, m, t, approx, I, delta, skip_variance, C, return_dict),
-        )
-        p.start()
-        p.join(timeout)
-        if p.is_alive():
-            p.terminate()
-            p.join()
-
-        if return_dict.values() == []:
-            acc, auc = 0, 0
-        else:
-            acc, auc = return_dict["acc"], return_dict["auc"]
-    else:
+    fastsk = FastskRunner(dataset)
+    try:
         acc, auc = fastsk.train_and_test(
-            g, m, t=t, I=I, approx=approx, skip_variance=skip_variance, C=C
+            g,
+            m,
+            t=t,
+            approx=approx,
+            I=I,
+            delta=delta,
+            skip_variance=skip_variance,
+            C=C,
+            timeout=timeout,
         )
+    except TimeoutError:
+        acc, auc = 0, 0
     end = time.time()
 
     return acc, auc, end - start
@@ -451,7 +421,15 @@ class FastskRunner:
         self.Ytest = Ytest
 
     def compute_train_kernel(
-        self, g, m, t=20, approx=True, I=100, delta=0.025, skip_variance=False
+        self,
+        g,
+        m,
+        t=20,
+        approx=True,
+        I=100,
+        delta=0.025,
+        skip_variance=False,
+        timeout=None,
     ):
         kernel = FastSK(
             g=g,
@@ -462,10 +440,22 @@ class FastskRunner:
             delta=delta,
             skip_variance=skip_variance,
         )
+        if timeout:
+            kernel.set_timeout(timeout)
         kernel.compute_train(self.train_seq)
 
     def train_and_test(
-        self, g, m, t, approx, I=100, delta=0.025, skip_variance=False, C=1
+        self,
+        g,
+        m,
+        t,
+        approx,
+        I=100,
+        delta=0.025,
+        skip_variance=False,
+        C=1,
+        timeout=None,
+        time_budget=None,
     ):
         kernel = FastSK(
             g=g,
@@ -476,16 +466,85 @@ class FastskRunner:
             delta=delta,
             skip_variance=skip_variance,
         )
+        if timeout:
+            kernel.set_timeout(timeout)
+        if time_budget:
+            kernel.set_time_budget(time_budget)
 
         kernel.compute_kernel(self.train_seq, self.test_seq)
         self.Xtrain = kernel.get_train_kernel()
         self.Xtest = kernel.get_test_kernel()
         self.stdevs = kernel.get_stdevs()
+        self.convergence = kernel.get_convergence()
         svm = LinearSVC(C=C, class_weight="balanced")
         self.clf = CalibratedClassifierCV(svm, cv=5).fit(self.Xtrain, self.Ytrain)
         acc, auc = self.evaluate_clf()
         return acc, auc
 
+    def train_and_test_snapshots(
+        self,
+        g,
+        m,
+        t,
+        iters=(),
+        deltas=(),
+        I=100,
+        delta=0.025,
+        skip_variance=False,
+        C=1,
+        timeout=None,
+    ):
+        """Train and evaluate a model on every snapshot of a single
+        approximate kernel computation, see FastSK.set_snapshots.
+        Returns a list of (snapshot, acc, auc).
+        """
+        kernel = FastSK(
+            g=g,
+            m=m,
+            t=t,
+            approx=True,
+            max_iters=I,
+            delta=delta,
+            skip_variance=skip_variance,
+        )
+        kernel.set_snapshots(iters=list(iters), deltas=list(deltas))
+        if timeout:
+            kernel.set_timeout(timeout)
+
+        kernel.compute_kernel(self.train_seq, self.test_seq)
+        self.stdevs = kernel.get_stdevs()
+        results = []
+        for i, snapshot in enumerate(kernel.get_snapshots()):
+            self.Xtrain = kernel.get_train_kernel(snapshot=i)
+            self.Xtest = kernel.get_test_kernel(snapshot=i)
+            svm = LinearSVC(C=C, class_weight="balanced")
+            self.clf = CalibratedClassifierCV(svm, cv=5).fit(self.Xtrain, self.Ytrain)
+            acc, auc = self.evaluate_clf()
+            results.append((snapshot, acc, auc))
+        return results
+
+    def train_and_test_family(self, g, ms, t, C_vals=(1,), timeout=None):
+        """Compute the exact kernels for every m in ms at once, see
+        FastSK.compute_family, then train and evaluate a model for every
+        m and C. Returns a list of (m, C, acc, auc).
+        """
+        kernel = FastSK(g=g, m=ms[0], t=t)
+        if timeout:
+            kernel.set_timeout(timeout)
+
+        kernel.compute_family(self.train_seq, self.test_seq, ms=list(ms))
+        results = []
+        for m in ms:
+            kernel.select_m(m)
+            self.Xtrain = kernel.get_train_kernel()
+            self.Xtest = kernel.get_test_kernel()
+            for C in C_vals:
+                svm = LinearSVC(C=C, class_weight="balanced")
+                self.clf = CalibratedClassifierCV(svm, cv=5).fit(self.Xtrain, self.Ytrain)
+                acc, auc = self.evaluate_clf()
+                results.append((m, C, acc, auc))
+        return results
+
     def evaluate_clf(self):
         acc = self.clf.score(self.Xtest, self.Ytest)
         probs = self.clf.predict_proba(self.Xtest)[:, 1]
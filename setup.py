@@ -35,6 +35,7 @@ def get_cpp_sources():
             "src/fastsk/_fastsk/fastsk.cpp",
             "src/fastsk/_fastsk/fastsk_kernel.cpp",
             "src/fastsk/_fastsk/shared.cpp",
+            "src/fastsk/_fastsk/profile.cpp",
             "src/fastsk/_fastsk/libsvm-code/svm.cpp",
             "src/fastsk/_fastsk/libsvm-code/eval.cpp",
         ]
@@ -1,2 +1,12 @@
-from ._fastsk import FastSK
+from ._fastsk import FastSK, Dataset, KernelCancelled
 from .utils import FastaUtility
+from .gridsearch import grid_search
+from .futures import (
+    KernelFuture,
+    compute_kernel_async,
+    compute_kernel_flat_async,
+    compute_dataset_async,
+    compute_train_async,
+    compute_cross_async,
+    fit_async,
+)
@@ -1,6 +1,7 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl_bind.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 #include "fastsk.hpp"
 #include <string>
 #include <vector>
@@ -8,41 +9,419 @@
 namespace py = pybind11;
 using namespace std;
 
+// Base of a numpy view of a kernel buffer: holds a reference to the buffer, so
+// that the view stays valid after the next computation replaces it
+static py::capsule buffer_owner(FastSK &fastsk, const void *buf) {
+    return py::capsule(new std::shared_ptr<void>(fastsk.get_owner(buf)),
+        [](void *owner) { delete (std::shared_ptr<void> *) owner; });
+}
+
+typedef void (FastSK::*CopyFloat)(float *, int);
+typedef void (FastSK::*CopyDouble)(double *, int);
+
+// Expand part of the packed kernel, or of a snapshot, into a dense float32/float64
+// array, either the caller's `out` or a newly allocated float64 one
+static py::array dense_kernel(FastSK &fastsk, py::object out, long int rows, long int cols,
+    CopyFloat copy_float, CopyDouble copy_double, int snapshot) {
+    long int size;
+    fastsk.get_packed_kernel(&size);    // throws if nothing was computed yet
+    if (out.is_none()) {
+        py::array_t<double> arr({(py::ssize_t) rows, (py::ssize_t) cols});
+        double *data = arr.mutable_data();
+        py::gil_scoped_release release;
+        (fastsk.*copy_double)(data, snapshot);
+        return arr;
+    }
+
+    if (!py::isinstance<py::array>(out)) {
+        throw py::type_error("out must be a numpy array");
+    }
+    py::array arr = out.cast<py::array>();
+    if (arr.ndim() != 2 || arr.shape(0) != rows || arr.shape(1) != cols) {
+        throw py::value_error("out must have shape (" + to_string(rows) + ", " + to_string(cols) + ")");
+    }
+    if (!arr.writeable()) {
+        throw py::value_error("out must be writeable");
+    }
+    if (py::isinstance<py::array_t<float, py::array::c_style> >(arr)) {
+        float *data = (float *) arr.mutable_data();
+        py::gil_scoped_release release;
+        (fastsk.*copy_float)(data, snapshot);
+    } else if (py::isinstance<py::array_t<double, py::array::c_style> >(arr)) {
+        double *data = (double *) arr.mutable_data();
+        py::gil_scoped_release release;
+        (fastsk.*copy_double)(data, snapshot);
+    } else {
+        throw py::type_error("out must be a C-contiguous float32 or float64 array");
+    }
+    return arr;
+}
+
+
+// Check a flat token buffer, see FastSK::compute_flat. Returns the number of
+// sequences and sets n_train = -1 to all of them.
+static long int check_flat(py::array tokens,
+    py::array_t<int64_t, py::array::c_style | py::array::forcecast> offsets,
+    long int &n_train, int dict_size) {
+    if (offsets.ndim() != 1 || offsets.shape(0) < 2) {
+        throw py::value_error("offsets must be a 1-D array with at least 2 entries");
+    }
+    long int n_str = offsets.shape(0) - 1;
+    const int64_t *off = offsets.data();
+    if (off[0] < 0 || off[n_str] > tokens.size()) {
+        throw py::value_error("offsets fall outside the token buffer");
+    }
+    for (long int i = 0; i < n_str; i++) {
+        if (off[i + 1] < off[i]) {
+            throw py::value_error("offsets must be non-decreasing");
+        }
+    }
+    if (n_train == -1) {
+        n_train = n_str;
+    }
+    if (n_train < 1 || n_train > n_str) {
+        throw py::value_error("n_train must be between 1 and the number of sequences");
+    }
+    if (dict_size != -1 && dict_size < 1) {
+        throw py::value_error("dict_size must be positive, or -1 to infer it");
+    }
+    return n_str;
+}
+
+// Kernel of sequences given as one flat uint8/int32 token buffer plus CSR-style
+// offsets, read in place; the first n_train sequences are the train set
+static void compute_kernel_flat(FastSK &fastsk, py::array tokens,
+    py::array_t<int64_t, py::array::c_style | py::array::forcecast> offsets,
+    long int n_train, bool cross, int dict_size) {
+    long int n_str = check_flat(tokens, offsets, n_train, dict_size);
+    const int64_t *off = offsets.data();
+
+    KernelLayout layout;
+    layout.cross = cross;
+    layout.a_pairs = true;
+    layout.n_a = n_train;
+    layout.n_str = n_str;
+    // tokens and offsets stay referenced by the caller's frame while the GIL is released
+    if (tokens.ndim() == 1 && py::isinstance<py::array_t<uint8_t, py::array::c_style> >(tokens)) {
+        const uint8_t *data = (const uint8_t *) tokens.data();
+        py::gil_scoped_release release;
+        fastsk.compute_flat(data, off, n_train, n_str - n_train, dict_size, layout);
+    } else if (tokens.ndim() == 1 && py::isinstance<py::array_t<int32_t, py::array::c_style> >(tokens)) {
+        const int32_t *data = (const int32_t *) tokens.data();
+        py::gil_scoped_release release;
+        fastsk.compute_flat(data, off, n_train, n_str - n_train, dict_size, layout);
+    } else {
+        throw py::type_error("tokens must be a 1-D C-contiguous uint8 or int32 array");
+    }
+}
+
+// Total wall and CPU seconds of each phase, in order of first appearance
+static py::dict phase_totals(const vector<ProfileEvent> &events) {
+    py::dict phases;
+    for (const ProfileEvent &e : events) {
+        py::str name(e.name);
+        if (!phases.contains(name)) {
+            py::dict d;
+            d["wall"] = 0.0;
+            d["cpu"] = 0.0;
+            d["count"] = 0;
+            phases[name] = d;
+        }
+        py::dict d = phases[name];
+        d["wall"] = d["wall"].cast<double>() + e.wall;
+        d["cpu"] = d["cpu"].cast<double>() + e.cpu;
+        d["count"] = d["count"].cast<long>() + 1;
+    }
+    return phases;
+}
+
+static py::dict profile_dict(const Profile &profile) {
+    py::list threads;
+    py::list work_items;
+    long int group_hist[GROUP_HIST_BINS] = {0};
+    long int bytes = profile.bytes_allocated;
+    for (const ThreadProfile &t : profile.threads) {
+        py::dict d;
+        d["phases"] = phase_totals(t.events);
+        d["work_items"] = t.work_items;
+        d["idle"] = t.idle;
+        d["bytes_allocated"] = t.bytes_allocated;
+        threads.append(d);
+        work_items.append(t.work_items);
+        for (int b = 0; b < GROUP_HIST_BINS; b++) {
+            group_hist[b] += t.group_hist[b];
+        }
+        bytes += t.bytes_allocated;
+    }
+    // sort groups by size, key 2^b counting groups of sizes [2^b, 2^(b+1))
+    py::dict group_sizes;
+    for (int b = 0; b < GROUP_HIST_BINS; b++) {
+        if (group_hist[b] > 0) {
+            group_sizes[py::int_(1L << b)] = group_hist[b];
+        }
+    }
+    py::dict d;
+    d["phases"] = phase_totals(profile.events);
+    d["threads"] = threads;
+    d["work_items"] = work_items;
+    d["group_sizes"] = group_sizes;
+    d["bytes_allocated"] = bytes;
+    return d;
+}
+
+static Dataset *dataset_from_flat(py::array tokens,
+    py::array_t<int64_t, py::array::c_style | py::array::forcecast> offsets,
+    long int n_train, int dict_size) {
+    long int n_str = check_flat(tokens, offsets, n_train, dict_size);
+    const int64_t *off = offsets.data();
+    if (tokens.ndim() == 1 && py::isinstance<py::array_t<uint8_t, py::array::c_style> >(tokens)) {
+        return new Dataset((const uint8_t *) tokens.data(), off, n_train, n_str - n_train, dict_size);
+    } else if (tokens.ndim() == 1 && py::isinstance<py::array_t<int32_t, py::array::c_style> >(tokens)) {
+        return new Dataset((const int32_t *) tokens.data(), off, n_train, n_str - n_train, dict_size);
+    }
+    throw py::type_error("tokens must be a 1-D C-contiguous uint8 or int32 array");
+}
 
 PYBIND11_MODULE(_fastsk, m) {
+    py::class_<Dataset>(m, "Dataset")
+        .def(py::init<const vector<vector<int> >&, const vector<vector<int> >&>(),
+            py::arg("Xtrain"),
+            py::arg("Xtest")=vector<vector<int> >()
+        )
+        .def_static("from_flat",
+            &dataset_from_flat,
+            py::arg("tokens"),
+            py::arg("offsets"),
+            py::arg("n_train")=-1,
+            py::arg("dict_size")=-1
+        )
+        .def_readonly("n_train", &Dataset::n_train)
+        .def_readonly("n_test", &Dataset::n_test)
+        .def_readonly("dict_size", &Dataset::dict_size)
+        .def("lengths", &Dataset::lengths)
+        ;
+
     py::class_<FastSK>(m, "FastSK")
-        .def(py::init<int, int, int, bool, double, int, bool>(), 
+        .def(py::init<int, int, int, bool, double, int, bool, bool, bool, long int, bool, int, string>(), 
             py::arg("g"), 
             py::arg("m"),
             py::arg("t")=-1,
             py::arg("approx")=false,
             py::arg("delta")=0.025,
             py::arg("max_iters")=-1,
-            py::arg("skip_variance")=false
+            py::arg("skip_variance")=false,
+            py::arg("shared_accumulator")=false,
+            py::arg("sort_reuse")=false,
+            py::arg("variance_sample")=0,
+            py::arg("global_convergence")=false,
+            py::arg("seed")=-1,
+            py::arg("sampling")="uniform"
         )
         .def("compute_kernel",
-            (void (FastSK::*)(vector<vector<int> >, vector<vector<int> >)) &FastSK::compute_kernel,
+            (void (FastSK::*)(vector<vector<int> >, vector<vector<int> >, bool)) &FastSK::compute_kernel,
             py::arg("Xtrain"),
-            py::arg("Xtest")
+            py::arg("Xtest"),
+            py::arg("cross")=false,
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("compute_kernel",
+            (void (FastSK::*)(const Dataset&, bool)) &FastSK::compute_kernel,
+            py::arg("dataset"),
+            py::arg("cross")=false,
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("compute_kernel_flat",
+            &compute_kernel_flat,
+            py::arg("tokens"),
+            py::arg("offsets"),
+            py::arg("n_train")=-1,
+            py::arg("cross")=false,
+            py::arg("dict_size")=-1
         )
         .def("compute_train", 
             &FastSK::compute_train,
-            py::arg("Xtrain")
+            py::arg("Xtrain"),
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("compute_cross",
+            &FastSK::compute_cross,
+            py::arg("A"),
+            py::arg("B"),
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("compute_family",
+            (void (FastSK::*)(vector<vector<int> >, vector<vector<int> >, vector<int>)) &FastSK::compute_family,
+            py::arg("Xtrain"),
+            py::arg("Xtest"),
+            py::arg("ms"),
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("compute_family",
+            (void (FastSK::*)(const Dataset&, vector<int>)) &FastSK::compute_family,
+            py::arg("dataset"),
+            py::arg("ms"),
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("select_m", &FastSK::select_m,
+            py::arg("m")
+        )
+        .def("get_family_ms", &FastSK::get_family_ms)
+        .def("get_train_kernel",
+            [](FastSK &self, py::object out, int snapshot) {
+                long int n = self.get_n_str_train();
+                return dense_kernel(self, out, n, n,
+                    &FastSK::copy_train_kernel<float>, &FastSK::copy_train_kernel<double>, snapshot);
+            },
+            py::arg("out")=py::none(),
+            py::arg("snapshot")=-1
+        )
+        .def("get_test_kernel",
+            [](FastSK &self, py::object out, int snapshot) {
+                return dense_kernel(self, out, self.get_n_str_test(), self.get_n_str_train(),
+                    &FastSK::copy_test_kernel<float>, &FastSK::copy_test_kernel<double>, snapshot);
+            },
+            py::arg("out")=py::none(),
+            py::arg("snapshot")=-1
+        )
+        .def("get_cross_kernel",
+            [](FastSK &self, py::object out, int snapshot) {
+                return dense_kernel(self, out, self.get_n_str_train(), self.get_n_str_test(),
+                    &FastSK::copy_cross_kernel<float>, &FastSK::copy_cross_kernel<double>, snapshot);
+            },
+            py::arg("out")=py::none(),
+            py::arg("snapshot")=-1
+        )
+        .def("get_packed_kernel",
+            [](FastSK &self) {
+                // read-only view of the packed kernel, valid after later computations
+                long int size;
+                double *K = self.get_packed_kernel(&size);
+                py::array_t<double> arr({(py::ssize_t) size}, {(py::ssize_t) sizeof(double)}, K,
+                    buffer_owner(self, K));
+                py::detail::array_proxy(arr.ptr())->flags &= ~py::detail::npy_api::NPY_ARRAY_WRITEABLE_;
+                return arr;
+            }
+        )
+        .def("set_snapshots", &FastSK::set_snapshots,
+            py::arg("iters")=vector<int>(),
+            py::arg("deltas")=vector<double>()
+        )
+        .def("get_snapshots",
+            [](py::object self) {
+                // packed kernels are read-only views, valid after later computations
+                FastSK &fastsk = self.cast<FastSK &>();
+                long int size;
+                fastsk.get_packed_kernel(&size);
+                py::list snapshots;
+                for (const Snapshot &snapshot : fastsk.get_snapshots()) {
+                    py::dict d;
+                    d["iters"] = (snapshot.iters == -1) ? py::none() : py::cast(snapshot.iters);
+                    d["delta"] = (snapshot.iters == -1) ? py::cast(snapshot.delta) : py::none();
+                    d["reached"] = snapshot.reached;
+                    d["items"] = snapshot.items;
+                    d["stdev"] = snapshot.stdev;
+                    py::array_t<float> K({(py::ssize_t) size}, {(py::ssize_t) sizeof(float)}, snapshot.K,
+                        buffer_owner(fastsk, snapshot.K));
+                    py::detail::array_proxy(K.ptr())->flags &= ~py::detail::npy_api::NPY_ARRAY_WRITEABLE_;
+                    d["kernel"] = K;
+                    snapshots.append(d);
+                }
+                return snapshots;
+            }
+        )
+        .def("set_timeout", &FastSK::set_timeout,
+            py::arg("seconds")
+        )
+        .def("set_time_budget", &FastSK::set_time_budget,
+            py::arg("seconds")
+        )
+        .def("get_convergence",
+            [](FastSK &self) {
+                const Convergence &c = self.get_convergence();
+                py::dict d;
+                d["items"] = c.items;
+                d["total"] = c.total;
+                d["stdev"] = c.stdev;
+                d["budget_expired"] = c.budget_expired;
+                return d;
+            }
+        )
+        .def("set_progress",
+            [](FastSK &self, py::object callback, double interval) {
+                if (callback.is_none()) {
+                    self.set_progress(ProgressFn(), interval);
+                    return;
+                }
+                py::function fn = callback;
+                // called from the computing thread, which does not hold the GIL
+                self.set_progress([fn](int done, int total, double elapsed, double stdev) {
+                    py::gil_scoped_acquire acquire;
+                    fn(done, total, elapsed, stdev);
+                }, interval);
+            },
+            py::arg("callback"),
+            py::arg("interval")=1.0
+        )
+        .def("cancel", &FastSK::cancel)
+        .def("set_profiling", &FastSK::set_profiling,
+            py::arg("enabled")=true
+        )
+        .def("get_profile",
+            [](FastSK &self) {
+                return profile_dict(self.get_profile());
+            }
+        )
+        .def("save_trace", &FastSK::save_trace,
+            py::arg("trace_file")
         )
-        .def("get_train_kernel", &FastSK::get_train_kernel)
-        .def("get_test_kernel", &FastSK::get_test_kernel)
         .def("get_stdevs", &FastSK::get_stdevs)
-        .def("save_kernel", &FastSK::save_kernel)
+        .def("get_work_counts", &FastSK::get_work_counts)
+        .def("save_kernel", &FastSK::save_kernel,
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("set_labels", &FastSK::set_labels,
+            py::arg("Ytrain"),
+            py::arg("Ytest")=vector<int>()
+        )
         .def("fit", &FastSK::fit,
             py::arg("C")=1.0,
             py::arg("nu")=0.5,
             py::arg("eps")=0.001,
-            py::arg("kernel_type")="linear"
+            py::arg("kernel_type")="linear",
+            py::arg("dense_q")=false,
+            py::call_guard<py::gil_scoped_release>()
         )
+        .def("fit_path", &FastSK::fit_path,
+            py::arg("C_values"),
+            py::arg("nu")=0.5,
+            py::arg("eps")=0.001,
+            py::arg("kernel_type")="linear",
+            py::arg("dense_q")=false,
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("select_C", &FastSK::select_C,
+            py::arg("C")
+        )
+        .def("get_path_Cs", &FastSK::get_path_Cs)
         .def("score", &FastSK::score,
-            py::arg("metric")="auc"
+            py::arg("metric")="auc",
+            py::call_guard<py::gil_scoped_release>()
+        )
+        .def("evaluate", &FastSK::evaluate,
+            py::call_guard<py::gil_scoped_release>()
         );
 
+    py::register_exception<KernelCancelled>(m, "KernelCancelled");
+    py::register_exception_translator([](std::exception_ptr p) {
+        try {
+            if (p) {
+                std::rethrow_exception(p);
+            }
+        } catch (const KernelTimeout &e) {
+            PyErr_SetString(PyExc_TimeoutError, e.what());
+        }
+    });
+
 #ifdef VERSION_INFO
     m.attr("__version__") = VERSION_INFO;
 #else
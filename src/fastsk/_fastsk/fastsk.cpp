@@ -11,12 +11,104 @@
 #include <iostream>
 #include <assert.h>
 #include <map>
+#include <stdexcept>
+#include <thread>
+#include <algorithm>
+#include <functional>
+#include <ctime>
+#include <random>
+#include <climits>
 
 #define Malloc(type,n) (type *)malloc((n)*sizeof(type))
 
 using namespace std;
 
-FastSK::FastSK(int g, int m, int t, bool approx, double delta, int max_iters, bool skip_variance) {
+Dataset::Dataset(const vector<vector<int> > &Xtrain, const vector<vector<int> > &Xtest) {
+    if (Xtrain.empty()) {
+        throw std::invalid_argument("Xtrain must not be empty");
+    }
+    this->n_train = Xtrain.size();
+    this->n_test = Xtest.size();
+    long int total = 0;
+    for (size_t i = 0; i < Xtrain.size(); i++) total += Xtrain[i].size();
+    for (size_t i = 0; i < Xtest.size(); i++) total += Xtest[i].size();
+    this->tokens.reserve(total);
+    this->offsets.reserve(this->n_train + this->n_test + 1);
+    this->offsets.push_back(0);
+
+    // same dictionary size as compute_kernel gives these sequences
+    set<int> dict;
+    dict.insert(0);
+    for (int s = 0; s < 2; s++) {
+        const vector<vector<int> > &X = (s == 0) ? Xtrain : Xtest;
+        for (size_t i = 0; i < X.size(); i++) {
+            for (size_t j = 0; j < X[i].size(); j++) {
+                if (X[i][j] < 0) {
+                    throw std::invalid_argument("tokens must be non-negative");
+                }
+                dict.insert(X[i][j]);
+                this->tokens.push_back(X[i][j]);
+            }
+            this->offsets.push_back(this->tokens.size());
+        }
+    }
+    this->dict_size = dict.size();
+    this->set_shortest();
+}
+
+// Copy of a flat token buffer, see compute_flat. dict_size = -1 infers it
+// from the largest token.
+template <typename T>
+Dataset::Dataset(const T *tokens, const int64_t *offsets, long int n_train, long int n_test, int dict_size) {
+    if (n_train < 1) {
+        throw std::invalid_argument("n_train must be positive");
+    }
+    this->n_train = n_train;
+    this->n_test = n_test;
+    long int total_str = n_train + n_test;
+    this->tokens.assign(tokens + offsets[0], tokens + offsets[total_str]);
+    this->offsets.resize(total_str + 1);
+    for (long int i = 0; i <= total_str; i++) {
+        this->offsets[i] = offsets[i] - offsets[0];
+    }
+
+    int max_token = 0;
+    for (size_t i = 0; i < this->tokens.size(); i++) {
+        if (this->tokens[i] < 0) {
+            throw std::invalid_argument("tokens must be non-negative");
+        }
+        if (this->tokens[i] > max_token) {
+            max_token = this->tokens[i];
+        }
+    }
+    if (dict_size == -1) {
+        dict_size = max_token + 1;
+    } else if (max_token >= dict_size) {
+        throw std::invalid_argument("tokens must be smaller than dict_size");
+    }
+    this->dict_size = dict_size;
+    this->set_shortest();
+}
+
+template Dataset::Dataset<uint8_t>(const uint8_t *, const int64_t *, long int, long int, int);
+template Dataset::Dataset<int32_t>(const int32_t *, const int64_t *, long int, long int, int);
+
+void Dataset::set_shortest() {
+    vector<int> lengths = this->lengths();
+    this->shortest_train = *min_element(lengths.begin(), lengths.begin() + this->n_train);
+    this->shortest_test = (this->n_test > 0) ? *min_element(lengths.begin() + this->n_train, lengths.end()) : 0;
+}
+
+vector<int> Dataset::lengths() const {
+    vector<int> lengths(this->n_train + this->n_test);
+    for (size_t i = 0; i < lengths.size(); i++) {
+        lengths[i] = this->offsets[i + 1] - this->offsets[i];
+    }
+    return lengths;
+}
+
+FastSK::FastSK(int g, int m, int t, bool approx, double delta, int max_iters, bool skip_variance,
+    bool shared_accumulator, bool sort_reuse, long int variance_sample, bool global_convergence, int seed, string sampling) {
     this->g = g;
     this->m = m;
     this->k = g - m;
@@ -25,10 +117,59 @@ FastSK::FastSK(int g, int m, int t, bool approx, double delta, int max_iters, bo
     this->delta = delta;
     this->max_iters = max_iters;
     this->skip_variance = skip_variance;
+    this->shared_accumulator = shared_accumulator;
+    this->sort_reuse = sort_reuse;
+    this->variance_sample = variance_sample;
+    this->global_convergence = global_convergence;
+    this->seed = seed;
+    if (sampling == "uniform") {
+        this->sampling = UNIFORM;
+    } else if (sampling == "stratified") {
+        this->sampling = STRATIFIED;
+    } else if (sampling == "antithetic") {
+        this->sampling = ANTITHETIC;
+    } else {
+        throw std::invalid_argument("sampling must be uniform, stratified or antithetic, got " + sampling);
+    }
+}
+
+void FastSK::compute_kernel(vector<vector<int> > Xtrain, vector<vector<int> > Xtest, bool cross) {
+    // Given sequences already in numerical form, compute the kernel matrix.
+    // In cross mode the test x test block is skipped.
+    KernelLayout layout;
+    layout.cross = cross;
+    layout.a_pairs = true;
+    layout.n_a = Xtrain.size();
+    layout.n_str = Xtrain.size() + Xtest.size();
+    this->compute_layout(Xtrain, Xtest, layout);
 }
 
-void FastSK::compute_kernel(vector<vector<int> > Xtrain, vector<vector<int> > Xtest) {
-    // Given sequences already in numerical form, compute the kernel matrix
+void FastSK::compute_train(vector<vector<int> > Xtrain) {
+    KernelLayout layout;
+    layout.cross = false;
+    layout.a_pairs = true;
+    layout.n_a = Xtrain.size();
+    layout.n_str = Xtrain.size();
+    vector<vector<int> > Xtest;
+    this->compute_layout(Xtrain, Xtest, layout);
+}
+
+void FastSK::compute_cross(vector<vector<int> > A, vector<vector<int> > B) {
+    // Only the A x B pairs and the self-similarities needed to normalize them
+    KernelLayout layout;
+    layout.cross = true;
+    layout.a_pairs = false;
+    layout.n_a = A.size();
+    layout.n_str = A.size() + B.size();
+    this->compute_layout(A, B, layout);
+}
+
+void FastSK::compute_layout(vector<vector<int> > &Xtrain, vector<vector<int> > &Xtest, KernelLayout layout) {
+    ProfileTime phase_start;
+    if (this->profiling) {
+        this->profile.reset();
+        phase_start = profile_now();
+    }
     vector<int> lengths;
     int shortest_train = Xtrain[0].size();
     for (unsigned long i = 0; i < Xtrain.size(); i++) {
@@ -38,7 +179,7 @@ void FastSK::compute_kernel(vector<vector<int> > Xtrain, vector<vector<int> > Xt
         }
         lengths.push_back(len);
     }
-    int shortest_test = Xtest[0].size();
+    int shortest_test = Xtest.empty() ? 0 : Xtest[0].size();
     for (unsigned long i = 0; i < Xtest.size(); i++) {
         int len = Xtest[i].size();
         if (len < shortest_test) {
@@ -48,23 +189,21 @@ void FastSK::compute_kernel(vector<vector<int> > Xtrain, vector<vector<int> > Xt
     }
 
     cout << "Length of shortest train sequence: " << shortest_train << endl;
-    cout << "Length of shortest test sequence: " << shortest_test << endl;
+    if (!Xtest.empty()) {
+        cout << "Length of shortest test sequence: " << shortest_test << endl;
+    }
 
     if (this->g > shortest_train) {
         g_greater_than_shortest_train(this->g, shortest_train);
     }
-    if (this->g > shortest_test) {
+    if (!Xtest.empty() && this->g > shortest_test) {
         g_greater_than_shortest_test(this->g, shortest_test);
     }
-    
+
     long int n_str_train = Xtrain.size();
     long int n_str_test = Xtest.size();
     long int total_str = n_str_train + n_str_test;
 
-    this->n_str_train = n_str_train;
-    this->n_str_test = n_str_test;
-    this->total_str = total_str;
-
     int **S = (int **) malloc(total_str * sizeof(int*));
 
     set<int> dict;
@@ -83,82 +222,149 @@ void FastSK::compute_kernel(vector<vector<int> > Xtrain, vector<vector<int> > Xt
     }
     int dict_size = dict.size();
     cout << "Dictionary size = " << dict_size << " (+1 for unknown char)." << endl;
-    
+
     /*Extract g-mers*/
-    Features* features = extractFeatures(S, lengths, total_str, g);
-    int nfeat = (*features).n;
-    int *feat = (*features).features;
-    if (!this->quiet) {
-        printf("g = %d, k = %d, %d features\n", this->g, this->k, nfeat);
+    if (this->profiling) {
+        this->profile.record(this->profile.events, "input", -1, phase_start);
+        phase_start = profile_now();
     }
-
-    kernel_params params;
-    params.g = g;
-    params.k = k;
-    params.m = m;
-    params.n_str_train = n_str_train;
-    params.n_str_test = n_str_test;
-    params.total_str = total_str;
-    params.n_str_pairs = (total_str / (double) 2) * (total_str + 1);
-    params.features = features;
-    params.dict_size = dict_size;
-    params.num_threads = this->num_threads;
-    params.num_mutex = this->num_mutex;
-    params.quiet = this->quiet;
-    params.approx = this->approx;
-    params.delta = this->delta;
-    params.max_iters = this->max_iters;
-    params.skip_variance = this->skip_variance;
-
-    KernelFunction* kernel_function = new KernelFunction(&params);
-    double *K = kernel_function->compute_kernel();
-
-    this->K = K;
-    this->stdevs = kernel_function->stdevs;
+    Features* features = extractFeatures(S, lengths, total_str, g);
+    free(S);
+    if (this->profiling) this->profile.record(this->profile.events, "extract", -1, phase_start);
+    this->compute_features(features, n_str_train, n_str_test, dict_size, layout);
 }
 
-void FastSK::compute_train(vector<vector<int> > Xtrain) {
-    vector<int> lengths;
-    int shortest_train = Xtrain[0].size();
-    for (int i = 0; i < Xtrain.size(); i++) {
-        int len = Xtrain[i].size();
+// Compute the kernel from sequences stored back to back in one token buffer,
+// sequence i being tokens[offsets[i]] .. tokens[offsets[i + 1] - 1]. The first
+// n_str_train sequences are the train set. Tokens must lie in [0, dict_size),
+// dict_size = -1 infers it from the largest token.
+template <typename T>
+void FastSK::compute_flat(const T *tokens, const int64_t *offsets, long int n_str_train,
+    long int n_str_test, int dict_size, KernelLayout layout) {
+    ProfileTime phase_start;
+    if (this->profiling) {
+        this->profile.reset();
+        phase_start = profile_now();
+    }
+    long int total_str = n_str_train + n_str_test;
+    int shortest_train = offsets[1] - offsets[0];
+    for (long int i = 1; i < n_str_train; i++) {
+        int len = offsets[i + 1] - offsets[i];
         if (len < shortest_train) {
             shortest_train = len;
         }
-        lengths.push_back(len);
+    }
+    int shortest_test = (n_str_test > 0) ? offsets[n_str_train + 1] - offsets[n_str_train] : 0;
+    for (long int i = n_str_train + 1; i < total_str; i++) {
+        int len = offsets[i + 1] - offsets[i];
+        if (len < shortest_test) {
+            shortest_test = len;
+        }
+    }
+
+    cout << "Length of shortest train sequence: " << shortest_train << endl;
+    if (n_str_test > 0) {
+        cout << "Length of shortest test sequence: " << shortest_test << endl;
     }
 
     if (this->g > shortest_train) {
         g_greater_than_shortest_train(this->g, shortest_train);
     }
-    
-    long int n_str_train = Xtrain.size();
-    long int n_str_test = 0;
-    long int total_str = n_str_train + n_str_test;
+    if (n_str_test > 0 && this->g > shortest_test) {
+        g_greater_than_shortest_test(this->g, shortest_test);
+    }
 
-    this->n_str_train = n_str_train;
-    this->n_str_test = n_str_test;
+    long int max_token = 0;
+    for (int64_t i = offsets[0]; i < offsets[total_str]; i++) {
+        if (tokens[i] < 0) {
+            throw std::invalid_argument("tokens must be non-negative");
+        }
+        if (tokens[i] > max_token) {
+            max_token = tokens[i];
+        }
+    }
+    if (dict_size == -1) {
+        dict_size = max_token + 1;
+    } else if (max_token >= dict_size) {
+        throw std::invalid_argument("tokens must be smaller than dict_size");
+    }
+    cout << "Dictionary size = " << dict_size << " (+1 for unknown char)." << endl;
 
-    int **S = (int **) malloc(total_str * sizeof(int*));
+    /*Extract g-mers*/
+    if (this->profiling) {
+        this->profile.record(this->profile.events, "input", -1, phase_start);
+        phase_start = profile_now();
+    }
+    Features* features = extractFeatures(tokens, offsets, total_str, g);
+    if (this->profiling) this->profile.record(this->profile.events, "extract", -1, phase_start);
+    this->compute_features(features, n_str_train, n_str_test, dict_size, layout);
+}
 
-    set<int> dict;
-    dict.insert(0);
-    for (int i = 0; i < n_str_train; i++) {
-        S[i] = Xtrain[i].data();
-        for (int j = 0; j < lengths[i]; j++) {
-            dict.insert(Xtrain[i][j]);
-        }
+template void FastSK::compute_flat<uint8_t>(const uint8_t *, const int64_t *, long int, long int, int, KernelLayout);
+template void FastSK::compute_flat<int32_t>(const int32_t *, const int64_t *, long int, long int, int, KernelLayout);
+
+// Compute the train and test kernel, or with cross the kernel between the train
+// and the test sequences, of a Dataset
+void FastSK::compute_kernel(const Dataset &data, bool cross) {
+    KernelLayout layout;
+    layout.cross = cross;
+    layout.a_pairs = true;
+    layout.n_a = data.n_train;
+    layout.n_str = data.n_train + data.n_test;
+    this->compute_dataset(data, layout);
+}
+
+void FastSK::compute_dataset(const Dataset &data, KernelLayout layout) {
+    ProfileTime phase_start;
+    if (this->profiling) {
+        this->profile.reset();
+        phase_start = profile_now();
+    }
+    cout << "Length of shortest train sequence: " << data.shortest_train << endl;
+    if (data.n_test > 0) {
+        cout << "Length of shortest test sequence: " << data.shortest_test << endl;
     }
 
-    int dict_size = dict.size();
-    cout << "Dictionary size = " << dict_size << " (+1 for unknown char)." << endl;
-    
+    if (this->g > data.shortest_train) {
+        g_greater_than_shortest_train(this->g, data.shortest_train);
+    }
+    if (data.n_test > 0 && this->g > data.shortest_test) {
+        g_greater_than_shortest_test(this->g, data.shortest_test);
+    }
+    cout << "Dictionary size = " << data.dict_size << " (+1 for unknown char)." << endl;
+
     /*Extract g-mers*/
-    Features* features = extractFeatures(S, lengths, total_str, g);
+    Features* features = extractFeatures(data.tokens.data(), data.offsets.data(),
+        data.n_train + data.n_test, g);
+    if (this->profiling) this->profile.record(this->profile.events, "extract", -1, phase_start);
+    this->compute_features(features, data.n_train, data.n_test, data.dict_size, layout);
+}
+
+void FastSK::compute_features(Features *features, long int n_str_train, long int n_str_test,
+    int dict_size, KernelLayout layout) {
+    // the features are only read while the kernel is computed
+    std::unique_ptr<Features> owned_features(features);
+    long int total_str = n_str_train + n_str_test;
+
+    ProfileTime phase_start;
+    if (this->profiling) phase_start = profile_now();
+    packFeatures(features, g);
     int nfeat = (*features).n;
-    int *feat = (*features).features;
+    if (this->profiling) {
+        this->profile.record(this->profile.events, "pack", -1, phase_start);
+        phase_start = profile_now();
+    }
+    dedupFeatures(features, g);
+    if (this->profiling) {
+        this->profile.record(this->profile.events, "dedup", -1, phase_start);
+        // features and group ids, plus packed keys and repeat counts if any
+        long int bytes = g * sizeof(int) + sizeof(int);
+        if ((*features).packed != NULL) bytes += sizeof(uint64_t);
+        if ((*features).count != NULL) bytes += sizeof(unsigned int);
+        this->profile.bytes_allocated += (*features).n * bytes;
+    }
     if (!this->quiet) {
-        printf("g = %d, k = %d, %d features\n", this->g, this->k, nfeat);
+        printf("g = %d, k = %d, %d features (%d after merging repeats)\n", this->g, this->k, nfeat, (*features).n);
     }
 
     kernel_params params;
@@ -168,58 +374,391 @@ void FastSK::compute_train(vector<vector<int> > Xtrain) {
     params.n_str_train = n_str_train;
     params.n_str_test = n_str_test;
     params.total_str = total_str;
-    params.n_str_pairs = (total_str / (double) 2) * (total_str + 1);
+    params.layout = layout;
+    params.n_str_pairs = kernel_size(&layout);
     params.features = features;
     params.dict_size = dict_size;
     params.num_threads = this->num_threads;
-    params.num_mutex = this->num_mutex;
     params.quiet = this->quiet;
     params.approx = this->approx;
     params.delta = this->delta;
     params.max_iters = this->max_iters;
     params.skip_variance = this->skip_variance;
+    params.shared_accumulator = this->shared_accumulator;
+    params.sort_reuse = this->sort_reuse;
+    params.variance_sample = this->variance_sample;
+    params.global_convergence = this->global_convergence;
+    params.sampling = this->sampling;
+    params.seed = (this->seed >= 0) ? this->seed : std::time(0);
+    params.timeout = this->timeout;
+    params.time_budget = this->time_budget;
+    params.cancel = &this->cancelled;
+    params.progress = this->progress ? &this->progress : NULL;
+    params.progress_interval = this->progress_interval;
+    params.profile = this->profiling ? &this->profile : NULL;
+    params.snapshot_iters = &this->snapshot_iters;
+    params.snapshot_deltas = &this->snapshot_deltas;
+
+    std::unique_ptr<KernelFunction> kernel_function(new KernelFunction(&params));
+    double *K;
+    vector<double*> family;
+    try {
+        if (this->family_request.empty()) {
+            K = kernel_function->compute_kernel();
+        } else {
+            family = kernel_function->compute_family(this->family_request);
+            K = family[0];
+        }
+    } catch (...) {
+        // a cancel() only applies to the computation it interrupted
+        this->cancelled = false;
+        throw;
+    }
+    this->cancelled = false;
 
-    KernelFunction* kernel_function = new KernelFunction(&params);
-    double *K = kernel_function->compute_kernel();
-
+    this->n_str_train = n_str_train;
+    this->n_str_test = n_str_test;
+    this->total_str = total_str;
+    this->layout = layout;
+    this->free_models();
+    // drop the previous kernels, the views still reading them keep them alive
+    this->owners.clear();
     this->K = K;
+    if (family.empty()) {
+        this->own(K);
+    }
     this->stdevs = kernel_function->stdevs;
+    this->work_counts = kernel_function->work_counts;
+    this->convergence = kernel_function->convergence;
+    this->snapshots = kernel_function->snapshots;
+    for (Snapshot &snapshot : this->snapshots) {
+        this->own(snapshot.K);
+    }
+    for (double *F : family) {
+        this->own(F);
+    }
+    this->family_ms = this->family_request;
+    this->family_K = family;
     this->nfeat = nfeat;
 }
 
-vector<vector<double> > FastSK::get_train_kernel() {
-    double *K = this->K;
-    int n_str_rain = this->n_str_train;
-    vector<vector<double> > train_K(n_str_train, vector<double>(n_str_train, 0));
-    for (int i = 0; i < n_str_train; i++) {
-        for (int j = 0; j < n_str_train; j++) {
-            train_K[i][j] = tri_access(K, i, j);
+// Exact kernels for every m in ms at once, see KernelFunction::compute_family.
+// The kernel of the first m is selected, see select_m.
+void FastSK::compute_family(vector<vector<int> > Xtrain, vector<vector<int> > Xtest, vector<int> ms) {
+    KernelLayout layout;
+    layout.cross = false;
+    layout.a_pairs = true;
+    layout.n_a = Xtrain.size();
+    layout.n_str = Xtrain.size() + Xtest.size();
+    this->request_family(ms);
+    try {
+        this->compute_layout(Xtrain, Xtest, layout);
+    } catch (...) {
+        this->family_request.clear();
+        throw;
+    }
+    this->family_request.clear();
+}
+
+void FastSK::compute_family(const Dataset &data, vector<int> ms) {
+    KernelLayout layout;
+    layout.cross = false;
+    layout.a_pairs = true;
+    layout.n_a = data.n_train;
+    layout.n_str = data.n_train + data.n_test;
+    this->request_family(ms);
+    try {
+        this->compute_dataset(data, layout);
+    } catch (...) {
+        this->family_request.clear();
+        throw;
+    }
+    this->family_request.clear();
+}
+
+// Check ms and make the next computation a family
+void FastSK::request_family(vector<int> ms) {
+    if (ms.empty()) {
+        throw std::invalid_argument("ms must not be empty");
+    }
+    for (size_t i = 0; i < ms.size(); i++) {
+        if (ms[i] < 0 || ms[i] >= this->g) {
+            throw std::invalid_argument("every m must be in [0, g), got " + to_string(ms[i]));
+        }
+        for (size_t j = 0; j < i; j++) {
+            if (ms[j] == ms[i]) {
+                throw std::invalid_argument("m = " + to_string(ms[i]) + " is given twice");
+            }
         }
     }
-    return train_K;
+    this->family_request = ms;
 }
 
-vector<vector<double> > FastSK::get_test_kernel() {
-    double *K = this->K;
-    int n_str_train = this->n_str_train;
-    int n_str_test = this->n_str_test;
-    int total_str = this->n_str_train + this->n_str_test;
+// Make the kernel of m, computed by the last compute_family, the one returned
+// by the get_*_kernel methods and used by fit and score. The models trained on
+// the previous kernel are dropped, score asks for a new fit
+void FastSK::select_m(int m) {
+    for (size_t i = 0; i < this->family_ms.size(); i++) {
+        if (this->family_ms[i] == m) {
+            this->free_models();
+            this->K = this->family_K[i];
+            return;
+        }
+    }
+    throw std::invalid_argument("no kernel for m = " + to_string(m) + ", see compute_family");
+}
 
-    vector<vector<double> > test_K(n_str_test, vector<double>(n_str_train, 0));
+vector<int> FastSK::get_family_ms() {
+    return this->family_ms;
+}
 
-    for (int i = n_str_train; i < total_str; i++){
-        for (int j = 0; j < n_str_train; j++){
-            test_K[i - n_str_train][j]  = tri_access(K, i, j);
+// Threads used to expand the packed kernel into dense arrays
+static int copy_threads(int num_threads, long int rows) {
+    int t = (num_threads == -1) ? 20 : num_threads;
+    if (t > rows) t = rows;
+    return (t < 1) ? 1 : t;
+}
+
+long int FastSK::get_n_str_train() {
+    return this->n_str_train;
+}
+
+long int FastSK::get_n_str_test() {
+    return this->n_str_test;
+}
+
+// Packed kernel as stored by compute_*, see kernel_index for the layout
+double *FastSK::get_packed_kernel(long int *size) {
+    if (this->K == NULL) {
+        throw std::runtime_error("no kernel has been computed yet");
+    }
+    *size = kernel_size(&this->layout);
+    return this->K;
+}
+
+// Make a malloc'd kernel buffer freed once neither this object nor any view
+// of it uses it
+void FastSK::own(void *buf) {
+    this->owners[buf] = std::shared_ptr<void>(buf, free);
+}
+
+// Reference to a buffer of the last computation, see own
+std::shared_ptr<void> FastSK::get_owner(const void *buf) {
+    auto it = this->owners.find(buf);
+    if (it == this->owners.end()) {
+        throw std::runtime_error("not a kernel buffer of the last computation");
+    }
+    return it->second;
+}
+
+// Expand the train x train block of the packed kernel K into a dense
+// row-major n x n array
+template <typename S, typename T>
+static void expand_train(const S *K, const KernelLayout *layout, long int n, int num_threads, T *out) {
+    // balance the threads by packed entries, each row i holds i + 1 of them
+    KernelLayout train_layout = {false, true, n, n};
+    long int *tiles = (long int *) malloc((num_threads + 1) * sizeof(long int));
+    get_tiles(&train_layout, num_threads, tiles);
+
+    vector<std::thread> threads;
+    for (int t = 0; t < num_threads; t++) {
+        long int start = tiles[t], end = tiles[t + 1];
+        threads.push_back(std::thread([K, layout, out, n, start, end]() {
+            for (long int i = start; i < end; i++) {
+                const S *row = K + row_start(layout, i);
+                for (long int j = 0; j <= i; j++) {
+                    out[i * n + j] = (T) row[j];
+                    out[j * n + i] = (T) row[j];
+                }
+            }
+        }));
+    }
+    for (auto &t : threads) {
+        t.join();
+    }
+    free(tiles);
+}
+
+// Expand the rows n_a.. of the packed kernel K, n_b of them, into a dense
+// row-major n_b x n_a array, or its transpose
+template <typename S, typename T>
+static void expand_rows(const S *K, const KernelLayout *layout, long int n_a, long int n_b, int num_threads,
+    bool transpose, T *out) {
+    // each thread fills a band of the rows
+    vector<std::thread> threads;
+    for (int t = 0; t < num_threads; t++) {
+        long int start = n_b * t / num_threads, end = n_b * (t + 1) / num_threads;
+        threads.push_back(std::thread([K, layout, out, n_a, n_b, transpose, start, end]() {
+            for (long int i = start; i < end; i++) {
+                const S *row = K + row_start(layout, n_a + i);
+                if (transpose) {
+                    for (long int j = 0; j < n_a; j++) {
+                        out[j * n_b + i] = (T) row[j];
+                    }
+                } else {
+                    T *dst = out + i * n_a;
+                    for (long int j = 0; j < n_a; j++) {
+                        dst[j] = (T) row[j];
+                    }
+                }
+            }
+        }));
+    }
+    for (auto &t : threads) {
+        t.join();
+    }
+}
+
+// Snapshot kernels are only kept when a kernel was computed with them
+static const float *snapshot_kernel(const vector<Snapshot> &snapshots, int snapshot) {
+    if (snapshot >= (int) snapshots.size()) {
+        throw std::out_of_range("snapshot " + to_string(snapshot) + " out of range, "
+            + to_string(snapshots.size()) + " snapshots were taken");
+    }
+    return snapshots[snapshot].K;
+}
+
+// Expand the train x train block into a dense row-major n_str_train x n_str_train
+// array, from the final kernel or the given snapshot
+template <typename T>
+void FastSK::copy_train_kernel(T *out, int snapshot) {
+    if (this->K == NULL) {
+        throw std::runtime_error("no kernel has been computed yet");
+    }
+    if (this->layout.cross && !this->layout.a_pairs) {
+        throw std::runtime_error("no train kernel after compute_cross, use get_cross_kernel");
+    }
+    long int n = this->n_str_train;
+    int num_threads = copy_threads(this->num_threads, n);
+    if (snapshot < 0) {
+        expand_train(this->K, &this->layout, n, num_threads, out);
+    } else {
+        expand_train(snapshot_kernel(this->snapshots, snapshot), &this->layout, n, num_threads, out);
+    }
+}
+
+// Expand the test x train block into a dense row-major n_str_test x n_str_train array
+template <typename T>
+void FastSK::copy_test_kernel(T *out, int snapshot) {
+    if (this->K == NULL) {
+        throw std::runtime_error("no kernel has been computed yet");
+    }
+    long int n_train = this->n_str_train;
+    long int n_test = this->n_str_test;
+    int num_threads = copy_threads(this->num_threads, n_test);
+
+    // test rows start with their n_str_train train columns in every layout
+    if (snapshot < 0) {
+        expand_rows(this->K, &this->layout, n_train, n_test, num_threads, false, out);
+    } else {
+        expand_rows(snapshot_kernel(this->snapshots, snapshot), &this->layout, n_train, n_test,
+            num_threads, false, out);
+    }
+}
+
+// A x B block of the kernel, A being the first set of sequences, as a dense
+// row-major |A| x |B| array
+template <typename T>
+void FastSK::copy_cross_kernel(T *out, int snapshot) {
+    if (this->K == NULL) {
+        throw std::runtime_error("no kernel has been computed yet");
+    }
+    long int n_a = this->n_str_train;
+    long int n_b = this->n_str_test;
+    int num_threads = copy_threads(this->num_threads, n_b);
+
+    // the packed rows belong to B
+    if (snapshot < 0) {
+        expand_rows(this->K, &this->layout, n_a, n_b, num_threads, true, out);
+    } else {
+        expand_rows(snapshot_kernel(this->snapshots, snapshot), &this->layout, n_a, n_b,
+            num_threads, true, out);
+    }
+}
+
+template void FastSK::copy_train_kernel<float>(float *, int);
+template void FastSK::copy_train_kernel<double>(double *, int);
+template void FastSK::copy_test_kernel<float>(float *, int);
+template void FastSK::copy_test_kernel<double>(double *, int);
+template void FastSK::copy_cross_kernel<float>(float *, int);
+template void FastSK::copy_cross_kernel<double>(double *, int);
+
+// Keep normalized float snapshots of the following approximate computations
+// after the given numbers of work items per thread, and once the convergence
+// estimate is within each of the given deltas
+void FastSK::set_snapshots(vector<int> iters, vector<double> deltas) {
+    for (int i : iters) {
+        if (i < 1) {
+            throw std::invalid_argument("snapshot iterations must be positive");
+        }
+    }
+    for (double d : deltas) {
+        if (!(d > 0)) {
+            throw std::invalid_argument("snapshot deltas must be positive");
         }
     }
+    // iteration checkpoints are hit in ascending order, delta ones in descending order
+    std::sort(iters.begin(), iters.end());
+    iters.erase(std::unique(iters.begin(), iters.end()), iters.end());
+    std::sort(deltas.begin(), deltas.end(), std::greater<double>());
+    deltas.erase(std::unique(deltas.begin(), deltas.end()), deltas.end());
+    this->snapshot_iters = iters;
+    this->snapshot_deltas = deltas;
+}
+
+const vector<Snapshot> &FastSK::get_snapshots() {
+    return this->snapshots;
+}
+
+// Stop kernel computations running longer than the given number of seconds,
+// -1 to never stop them
+void FastSK::set_timeout(double timeout) {
+    this->timeout = timeout;
+}
+
+// Stop approximate computations after the given number of seconds and keep
+// the estimate computed so far, -1 to never stop them
+void FastSK::set_time_budget(double time_budget) {
+    this->time_budget = time_budget;
+}
+
+const Convergence &FastSK::get_convergence() {
+    return this->convergence;
+}
+
+// Report the progress of kernel computations every interval seconds
+void FastSK::set_progress(ProgressFn progress, double interval) {
+    this->progress = progress;
+    this->progress_interval = interval;
+}
+
+// Cancel the running kernel computation, or the next one if none is running.
+// Safe to call from any thread.
+void FastSK::cancel() {
+    this->cancelled = true;
+}
+
+// Record timings and counters of the following computations, see get_profile
+void FastSK::set_profiling(bool enabled) {
+    this->profiling = enabled;
+}
 
-    return test_K;
+const Profile &FastSK::get_profile() {
+    return this->profile;
+}
+
+void FastSK::save_trace(string trace_file) {
+    this->profile.save_trace(trace_file);
 }
 
 vector<double> FastSK::get_stdevs() {
     return this->stdevs;
 }
 
+vector<int> FastSK::get_work_counts() {
+    return this->work_counts;
+}
+
 void FastSK::save_kernel(string kernel_file) {
     double *K = this->K;
     int total_str = this->n_str_train + this->n_str_test;
@@ -228,7 +767,11 @@ void FastSK::save_kernel(string kernel_file) {
         FILE *kernelfile = fopen(kernel_file.c_str(), "w");
         for (int i = 0; i < total_str; ++i) {
             for (int j = 0; j < total_str; ++j) {
-                fprintf(kernelfile, "%d:%e ", j + 1, tri_access(K,i,j));
+                // pairs skipped in cross mode are left out of the sparse rows
+                long int idx = kernel_index(&this->layout, i, j);
+                if (idx >= 0) {
+                    fprintf(kernelfile, "%d:%e ", j + 1, K[idx]);
+                }
             }
             fprintf(kernelfile, "\n");
         }
@@ -236,13 +779,92 @@ void FastSK::save_kernel(string kernel_file) {
     }
 }
 
-void FastSK::fit(double C, double nu, double eps, const string kernel_type) {
+// Free a problem made by create_svm_problem
+static void free_svm_problem(svm_problem *prob) {
+    free(prob->x[0]);
+    free(prob->x);
+    free(prob->y);
+    free(prob);
+}
+
+// Drop the models of the last fit, whose problem points into the kernel they
+// were trained on
+void FastSK::free_models() {
+    for (svm_model *model : this->models) {
+        svm_free_and_destroy_model(&model);
+    }
+    this->models.clear();
+    this->model_Cs.clear();
+    this->model = NULL;
+    if (this->problem != NULL) {
+        free_svm_problem(this->problem);
+        this->problem = NULL;
+    }
+}
+
+FastSK::~FastSK() {
+    this->free_models();
+    free(this->train_labels);
+    free(this->test_labels);
+}
+
+// Labels of the train and test sequences, used by fit and score. Labels > 0
+// are the positive class.
+void FastSK::set_labels(vector<int> Ytrain, vector<int> Ytest) {
+    free(this->train_labels);
+    free(this->test_labels);
+    this->n_train_labels = Ytrain.size();
+    this->n_test_labels = Ytest.size();
+    this->train_labels = Malloc(int, Ytrain.size());
+    this->test_labels = Malloc(int, Ytest.size());
+    for (size_t i = 0; i < Ytrain.size(); i++) {
+        this->train_labels[i] = (Ytrain[i] > 0) ? 1 : -1;
+    }
+    for (size_t i = 0; i < Ytest.size(); i++) {
+        this->test_labels[i] = (Ytest[i] > 0) ? 1 : -1;
+    }
+}
+
+// Train the SVM on the train kernel. dense_q keeps every row of Q as float once
+// computed, up to 4 * n_train^2 bytes, instead of libsvm's LRU cache of
+// cache_size MB: faster once the cache cannot hold the working set. The solver
+// splits its loops over the t threads given to the constructor, at most one per
+// core, once there are enough training sequences.
+void FastSK::fit(double C, double nu, double eps, const string kernel_type, bool dense_q) {
+    this->fit_path(vector<double>(1, C), nu, eps, kernel_type, dense_q);
+}
+
+// Train one model per C on the same kernel, see fit. The models are trained in
+// increasing order of C, each starting from the alphas of the one before (with
+// the same probability folds), which is feasible for the larger box. The model
+// of the first C given is selected, see select_C.
+void FastSK::fit_path(vector<double> C_values, double nu, double eps, const string kernel_type, bool dense_q) {
+    if (C_values.empty()) {
+        throw std::invalid_argument("C_values must not be empty");
+    }
+    for (size_t i = 0; i < C_values.size(); i++) {
+        if (!(C_values[i] > 0)) {
+            throw std::invalid_argument("every C must be positive");
+        }
+        for (size_t j = 0; j < i; j++) {
+            if (C_values[j] == C_values[i]) {
+                throw std::invalid_argument("C = " + to_string(C_values[i]) + " is given twice");
+            }
+        }
+    }
     // if ((this->kernel_type == LINEAR || this->kernel_type == RBF) && test_file.empty()) {
     //     printf("A test file must be provided for kernel type '%s'\n", this->kernel_type_name.c_str());
     //     exit(1);
     // }
 
-    this->C = C;
+    if (this->layout.cross && !this->layout.a_pairs) {
+        throw std::runtime_error("no train kernel after compute_cross, cannot fit");
+    }
+    if (this->n_train_labels != this->n_str_train) {
+        throw std::runtime_error("set_labels must give a label for each train sequence");
+    }
+
+    this->C = C_values[0];
     this->nu = nu;
     this->eps = eps;
     if (kernel_type == "linear") {
@@ -259,13 +881,6 @@ void FastSK::fit(double C, double nu, double eps, const string kernel_type) {
         exit(1);
     }
 
-    int g = this->g;
-    int m = this->m;
-    bool quiet = false;
-    int n_str_train = this->n_str_train;
-    int n_str_test = this->n_str_test;
-    int nfeat = this->nfeat;
-
     struct svm_parameter* svm_param = Malloc(svm_parameter, 1);
     svm_param->svm_type = this->svm_type;
     svm_param->kernel_type = this->kernel_type;
@@ -280,66 +895,62 @@ void FastSK::fit(double C, double nu, double eps, const string kernel_type) {
     svm_param->probability = this->probability;
     svm_param->eps = this->eps;
     svm_param->degree = 0;
-
-    svm_problem *prob;
-    struct svm_model *model;
-    
-    prob = this->create_svm_problem(this->K, this->train_labels, svm_param);
-    model = this->train_model(this->K, this->train_labels, svm_param);
-
-    this->model = model;
+    svm_param->dense_Q = dense_q;
+    // the solver's threads spin between iterations, so no more than the cores
+    int cores = std::thread::hardware_concurrency();
+    int svm_threads = (this->num_threads > 0) ? this->num_threads : cores;
+    svm_param->num_threads = (cores > 0 && svm_threads > cores) ? cores : svm_threads;
+
+    this->free_models();
+    this->models.assign(C_values.size(), NULL);
+    this->model_Cs = C_values;
+    this->problem = this->create_svm_problem(this->K, this->train_labels, svm_param);
+
+    vector<int> order(C_values.size());
+    for (size_t i = 0; i < order.size(); i++) {
+        order[i] = i;
+    }
+    std::sort(order.begin(), order.end(), [&C_values](int a, int b) { return C_values[a] < C_values[b]; });
+    long int l = this->problem->l;
+    svm_param->warm_alpha = (double *) calloc(l, sizeof(double));
+    svm_param->warm_fold_alpha = this->probability ? (double *) calloc(5 * l, sizeof(double)) : NULL;
+    // the same probability folds for every C, drawn from the seed like the
+    // approximate kernel's random order
+    std::mt19937 rng((this->seed >= 0) ? this->seed : std::time(0));
+    svm_param->fold_seed = rng() & INT_MAX;
+    for (int i : order) {
+        svm_param->C = C_values[i];
+        this->models[i] = this->train_model(this->problem, svm_param);
+    }
+    free(svm_param->warm_alpha);
+    free(svm_param->warm_fold_alpha);
+    free(svm_param);
+    this->model = this->models[0];
 }
 
-svm_model* FastSK::train_model(double *K, int *labels, svm_parameter *svm_param) {
-    int n_str_train = this->n_str_train;
-    struct svm_problem* prob = Malloc(svm_problem, 1);
-    const char* error_msg;
-
-    svm_node** x;
-    svm_node* x_space;
-    prob->l = n_str_train;
-    prob->y = Malloc(double, prob->l);
-    x = Malloc(svm_node*, prob->l);
-    if (svm_param->kernel_type == FASTSK) {
-        x_space = Malloc(struct svm_node, (n_str_train + 1) * n_str_train);
-        int totalind = 0;
-        for (int i = 0; i < n_str_train; i++) {
-            x[i] = &x_space[totalind];
-            for (int j = 0; j < n_str_train; j++) {
-                x_space[j + i * (n_str_train + 1)].index = j + 1; 
-                x_space[j + i * (n_str_train + 1)].value = tri_access(K, i, j);
-            }
-            totalind += n_str_train;
-            x_space[totalind].index = -1;
-            totalind++;
-            prob->y[i] = labels[i];
+// Make the model of C, trained by the last fit or fit_path, the one score uses
+void FastSK::select_C(double C) {
+    for (size_t i = 0; i < this->model_Cs.size(); i++) {
+        if (this->model_Cs[i] == C) {
+            this->model = this->models[i];
+            this->C = C;
+            return;
         }
-        //this->x_space = x_space;
-    } else if (svm_param->kernel_type == LINEAR || svm_param->kernel_type == RBF) {
-        x_space = Malloc(struct svm_node, (n_str_train + 1) * n_str_train);
-        int totalind = 0;
-        for (int i = 0; i < n_str_train; i++) {
-            x[i] = &x_space[totalind];
-            for (int j = 0; j < n_str_train; j++) {
-                x_space[j + i * (n_str_train + 1)].index = j + 1; 
-                x_space[j + i * (n_str_train + 1)].value = tri_access(K, i, j);
-            }
-            totalind += n_str_train;
-            x_space[totalind].index = -1;
-            totalind++;
-            prob->y[i] = labels[i];
-        }
-        //this->x_space = x_space;
     }
+    throw std::invalid_argument("no model for C = " + to_string(C) + ", see fit_path");
+}
 
-    prob->x = x;
+vector<double> FastSK::get_path_Cs() {
+    return this->model_Cs;
+}
 
+svm_model* FastSK::train_model(svm_problem *prob, svm_parameter *svm_param) {
     // if quiet mode, set libsvm's print function to null
     if (this->quiet) {
         svm_set_print_string_function(&print_null);
     }
 
-    error_msg = svm_check_parameter(prob, svm_param);
+    const char* error_msg = svm_check_parameter(prob, svm_param);
 
     if (error_msg) {
         fprintf(stderr, "ERROR: %s\n", error_msg);
@@ -350,15 +961,15 @@ svm_model* FastSK::train_model(double *K, int *labels, svm_parameter *svm_param)
     struct svm_model* model;
     model = svm_train(prob, svm_param);
 
-    free(svm_param);
-
     return model;
 }
 
+// The training problem over the train kernel. The fastsk kernel type reads K
+// directly: each sample is only its id, see svm_packed_kernel. The linear and
+// rbf kernel types use the rows of K as feature vectors.
 svm_problem* FastSK::create_svm_problem(double* K, int* labels, svm_parameter* svm_param) {
     int n_str_train = this->n_str_train;
     struct svm_problem* prob = Malloc(svm_problem, 1);
-    const char* error_msg;
     svm_node** x;
     svm_node* x_space;
 
@@ -367,51 +978,34 @@ svm_problem* FastSK::create_svm_problem(double* K, int* labels, svm_parameter* s
     x = Malloc(svm_node*, prob->l);
     
     if (svm_param->kernel_type == FASTSK) {
-        x_space = Malloc(struct svm_node, (n_str_train + 1) * n_str_train);
-        int totalind = 0;
+        // the train kernel is the leading triangle of K in every layout
+        svm_param->packed_K = K;
+        x_space = Malloc(struct svm_node, 2 * n_str_train);
         for (int i = 0; i < n_str_train; i++) {
-            x[i] = &x_space[totalind];
-            for (int j = 0; j < n_str_train; j++) {
-                x_space[j + i * (n_str_train + 1)].index = j + 1; 
-                x_space[j + i * (n_str_train + 1)].value = tri_access(K, i, j);
-            }
-            totalind += n_str_train;
-            x_space[totalind].index = -1;
-            totalind++;
+            x[i] = &x_space[2 * i];
+            x_space[2 * i].index = 0;
+            x_space[2 * i].value = i;
+            x_space[2 * i + 1].index = -1;
             prob->y[i] = labels[i];
         }
-        //this->x_space = x_space;
-    } else if (svm_param->kernel_type == LINEAR || svm_param->kernel_type == RBF) {
-        x_space = Malloc(struct svm_node, (n_str_train + 1) * n_str_train);
-        int totalind = 0;
+    } else {
+        svm_param->packed_K = NULL;
+        x_space = Malloc(struct svm_node, (long int) (n_str_train + 1) * n_str_train);
+        long int totalind = 0;
         for (int i = 0; i < n_str_train; i++) {
             x[i] = &x_space[totalind];
-            // seems like tri_access on K is causing the segfault
             for (int j = 0; j < n_str_train; j++) {
-                x_space[j + i * (n_str_train + 1)].index = j + 1; 
-                x_space[j + i * (n_str_train + 1)].value = tri_access(K, i, j);
+                x_space[j + i * (long int) (n_str_train + 1)].index = j + 1; 
+                x_space[j + i * (long int) (n_str_train + 1)].value = tri_access(K, i, j);
             }
             totalind += n_str_train;
             x_space[totalind].index = -1;
             totalind++;
             prob->y[i] = labels[i];
         }
-        //this->x_space = x_space;
     }
 
     prob->x = x;
-
-    if (this->quiet) {
-        svm_set_print_string_function(&print_null);
-    }
-
-    error_msg = svm_check_parameter(prob, svm_param);
-
-    if (error_msg) {
-        fprintf(stderr, "ERROR: %s\n", error_msg);
-        exit(1);
-    }
-
     return prob;
 }
 
@@ -419,11 +1013,22 @@ double FastSK::score(const string metric) {
     if (metric != "accuracy" && metric != "auc") {
         throw std::invalid_argument("metric argument must be 'accuracy' or 'auc'");
     }
-    int n_str = this->total_str;
+    return this->evaluate()[metric];
+}
+
+// Accuracy (in percent) and AUROC of the selected model on the test sequences,
+// from a single prediction pass
+map<string, double> FastSK::evaluate() {
+    if (this->model == NULL) {
+        throw std::runtime_error("fit must be called before score");
+    }
+    if (this->n_test_labels != this->n_str_test) {
+        throw std::runtime_error("set_labels must give a label for each test sequence");
+    }
     int n_str_train = this->n_str_train;
     int n_str_test = this->n_str_test;
     printf("Predicting labels for %d sequences...\n", n_str_test);
-    double *test_K = construct_test_kernel(n_str_train, n_str_test, this->K);
+    double *test_K = construct_test_kernel(n_str_train, n_str_test, this->K, &this->layout);
     int *test_labels = this->test_labels;
     printf("Test kernel constructed...\n");
 
@@ -447,28 +1052,14 @@ double FastSK::score(const string metric) {
     FILE *auc_file;
     auc_file = fopen("auc_file.txt", "w+");
 
-    int svcount = 0;
     for (int i = 0; i < n_str_test; i++) {
-        if (this->kernel_type == FASTSK) {
-            for (int j = 0; j < n_str_train; j++){
-                x[j].index = j + 1;
-                x[j].value = 0;
-            }
-            svcount = 0;
-            for (int j = 0; j < n_str_train; j++){
-                if (j == this->model->sv_indices[svcount] - 1){
-                    x[j].value = test_K[i * num_sv + svcount];
-                    svcount++;
-                }
-            }
-            x[n_str_train].index = -1;
-        } else if (this->kernel_type == LINEAR || this->kernel_type == RBF) {
-            for (int j = 0; j < n_str_train; j++){
-                x[j].index = j + 1;
-                x[j].value = test_K[i * n_str_train + j];
-            }
-            x[n_str_train].index = -1;
+        // the fastsk kernel type reads x[j] for the support vectors j, the
+        // others use the whole row
+        for (int j = 0; j < n_str_train; j++){
+            x[j].index = j + 1;
+            x[j].value = test_K[(long int) i * n_str_train + j];
         }
+        x[n_str_train].index = -1;
 
         // probs = [prob_pos, prob_neg], not [prob_neg, prob_pos]
         double probs[2];
@@ -500,8 +1091,10 @@ double FastSK::score(const string metric) {
     }
 
     fclose(auc_file);
+    free(test_K);
+    free(x);
 
-    if (pagg == 0 && metric == "auc") {
+    if (pagg == 0) {
         printf("No positive examples were in the test set. AUROC is undefined in this case.\n");
     }
 
@@ -510,6 +1103,8 @@ double FastSK::score(const string metric) {
     double fnr = fn / (double) pagg;
     double fpr = fp / (double) nagg;
     double auc = calculate_auc(pos, neg, pagg, nagg);
+    free(pos);
+    free(neg);
     double acc = 100 * correct / (double)  n_str_test;
     if (!this->quiet) {
         printf("Num sequences: %d\n", nagg + pagg);
@@ -522,10 +1117,9 @@ double FastSK::score(const string metric) {
     printf("\nAccuracy: %f\n", acc);
     printf("AUROC: %f\n", auc);
 
-    if (metric == "auc") {
-        return auc;
-    }
-    
-    return acc;
+    map<string, double> scores;
+    scores["accuracy"] = acc;
+    scores["auc"] = auc;
+    return scores;
 }
 
@@ -3,19 +3,42 @@
 
 #include <vector>
 #include <string>
+#include <cmath>
+#include <map>
+#include <memory>
 #include "fastsk_kernel.hpp"
 #include "libsvm-code/svm.h"
 
 using namespace std;
 
+// Sequences ingested once: their tokens back to back in one buffer, train
+// sequences first, sequence i being tokens[offsets[i]] .. tokens[offsets[i + 1] - 1].
+// The g-mers of any g are read from this buffer, so kernels for several (g, m)
+// can be computed from it without converting the input again. A Dataset is not
+// changed after it is built, so several FastSK objects may use it at once.
+class Dataset {
+public:
+    vector<int32_t> tokens;
+    vector<int64_t> offsets;
+    long int n_train;
+    long int n_test;
+    int dict_size;
+    int shortest_train;
+    int shortest_test;
+
+    Dataset(const vector<vector<int> > &, const vector<vector<int> > &);
+    template <typename T> Dataset(const T *, const int64_t *, long int, long int, int);
+    vector<int> lengths() const;
 
+private:
+    void set_shortest();
+};
 
 class FastSK {
     int g;
     int m;
     int k;
     int num_threads = -1;
-    int num_mutex = -1;
     int svm_type = C_SVC;
     int kernel_type = LINEAR;       // must be LINEAR, FASTSK, or RBF
     string kernel_type_name;   
@@ -31,36 +54,104 @@ class FastSK {
     int crossfold = 0;
     double* test_kernel = NULL;
     long int total_str;
-    long int n_str_train;
-    long int n_str_test;
+    long int n_str_train = 0;
+    long int n_str_test = 0;
     int numClasses = -1;
     char *dictionary;
     bool quiet = false;
-    svm_model *model;
+    svm_model *model = NULL;
+    svm_problem *problem = NULL;
+    // models of the last fit or fit_path, by C
+    vector<svm_model*> models;
+    vector<double> model_Cs;
     int nfeat;
     vector<vector<int> > Xtrain;
     vector<vector<int> > Xtest;
-    int* train_labels;
-    int* test_labels;
+    int* train_labels = NULL;
+    int* test_labels = NULL;
+    long int n_train_labels = 0;
+    long int n_test_labels = 0;
     double* K = NULL;
     bool approx = false;
     double delta = 0.025;
     int max_iters = -1;
     bool skip_variance = false;
+    bool shared_accumulator = false;
+    bool sort_reuse = false;
+    long int variance_sample = 0;
+    bool global_convergence = false;
+    int seed = -1;
+    Sampling sampling = UNIFORM;
     vector<double> stdevs;
+    vector<int> work_counts;
+    KernelLayout layout;
+    double timeout = -1;
+    double time_budget = -1;
+    Convergence convergence = {0, 0, NAN, false};
+    ProgressFn progress;
+    double progress_interval = 1.0;
+    std::atomic<bool> cancelled{false};
+    bool profiling = false;
+    Profile profile;
+    vector<int> snapshot_iters;
+    vector<double> snapshot_deltas;
+    vector<Snapshot> snapshots;
+    // m values of the next computation if it is a family, and of the last family
+    vector<int> family_request;
+    vector<int> family_ms;
+    vector<double*> family_K;
+    // the kernel buffers of the last computation, shared with the numpy views
+    // of them, see get_owner
+    std::map<const void*, std::shared_ptr<void> > owners;
+
+    void compute_layout(vector<vector<int> >&, vector<vector<int> >&, KernelLayout);
+    void compute_features(Features *, long int, long int, int, KernelLayout);
+    void compute_dataset(const Dataset &, KernelLayout);
+    void request_family(vector<int>);
+    void free_models();
+    void own(void *);
 
 public:
-    FastSK(int, int, int, bool, double, int, bool);
-    void compute_kernel(vector<vector<int> >, vector<vector<int> >);
+    FastSK(int, int, int, bool, double, int, bool, bool, bool, long int, bool, int, string);
+    ~FastSK();
+    void compute_kernel(vector<vector<int> >, vector<vector<int> >, bool cross=false);
     void compute_train(vector<vector<int> > Xtrain);
-    vector<vector<double> > get_train_kernel();
-    vector<vector<double> > get_test_kernel();
+    void compute_cross(vector<vector<int> >, vector<vector<int> >);
+    void compute_kernel(const Dataset &, bool cross=false);
+    void compute_family(vector<vector<int> >, vector<vector<int> >, vector<int>);
+    void compute_family(const Dataset &, vector<int>);
+    void select_m(int);
+    vector<int> get_family_ms();
+    template <typename T> void compute_flat(const T *, const int64_t *, long int, long int, int, KernelLayout);
+    long int get_n_str_train();
+    long int get_n_str_test();
+    double *get_packed_kernel(long int *);
+    std::shared_ptr<void> get_owner(const void *);
+    template <typename T> void copy_train_kernel(T *, int snapshot=-1);
+    template <typename T> void copy_test_kernel(T *, int snapshot=-1);
+    template <typename T> void copy_cross_kernel(T *, int snapshot=-1);
+    void set_snapshots(vector<int>, vector<double>);
+    const vector<Snapshot> &get_snapshots();
+    void set_timeout(double);
+    void set_time_budget(double);
+    const Convergence &get_convergence();
+    void set_progress(ProgressFn, double);
+    void cancel();
+    void set_profiling(bool);
+    const Profile &get_profile();
+    void save_trace(string);
     vector<double> get_stdevs();
+    vector<int> get_work_counts();
     void save_kernel(string);
-    void fit(double, double, double, const string);
-    svm_model* train_model(double *, int *, svm_parameter *);
+    void set_labels(vector<int>, vector<int>);
+    void fit(double, double, double, const string, bool dense_q=false);
+    void fit_path(vector<double>, double, double, const string, bool dense_q=false);
+    void select_C(double);
+    vector<double> get_path_Cs();
+    svm_model* train_model(svm_problem *, svm_parameter *);
     svm_problem* create_svm_problem(double *, int *, svm_parameter *);
     double score(const string);
+    map<string, double> evaluate();
 };
 
 #endif
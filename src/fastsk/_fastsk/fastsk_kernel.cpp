@@ -7,6 +7,8 @@
 #include <math.h>
 #include <cstring>
 #include <algorithm>
+#include <set>
+#include <map>
 #include <random>
 #include <ctime>
 #include <cmath>
@@ -15,9 +17,142 @@
 #include <fstream>
 
 #define Malloc(type,n) (type *)malloc((n)*sizeof(type))
+// train pairs the global estimate tracks when no variance_sample is given
+#define GLOBAL_SAMPLE 10000
+// work items a thread adds to the global estimate at once
+#define ESTIMATE_BATCH 4
+
+// Divide the rows [first, last) of the packed kernel K by sqrt(K_ii * K_jj),
+// given inv[i] = 1 / sqrt(K_ii). The diagonal is divided by itself, so it is
+// exactly 1.
+static void normalize_rows(double *K, const KernelLayout *layout, const double *inv,
+    long int first, long int last) {
+    for (long int i = first; i < last; i++) {
+        double *row = K + row_start(layout, i);
+        double inv_i = inv[i];
+        if (!layout->cross || (i < layout->n_a && layout->a_pairs)) {
+            for (long int j = 0; j < i; j++) {
+                row[j] *= inv_i * inv[j];
+            }
+            row[i] = row[i] / row[i];
+        } else if (i < layout->n_a) {
+            row[0] = row[0] / row[0];
+        } else {
+            for (long int j = 0; j < layout->n_a; j++) {
+                row[j] *= inv_i * inv[j];
+            }
+            row[layout->n_a] = row[layout->n_a] / row[layout->n_a];
+        }
+    }
+}
+
+// Normalize the packed kernel K with num_threads threads, each taking a band
+// of rows
+static void normalize_kernel(double *K, const kernel_params *params, int num_threads) {
+    const KernelLayout *layout = &params->layout;
+    long int n = params->total_str;
+    double *inv = (double *) malloc(n * sizeof(double));
+    for (long int i = 0; i < n; i++) {
+        inv[i] = 1 / sqrt(K[kernel_index(layout, i, i)]);
+    }
+    long int *tiles = (long int *) malloc((num_threads + 1) * sizeof(long int));
+    get_tiles(layout, num_threads, tiles);
+    std::vector<std::thread> threads;
+    for (int tid = 0; tid < num_threads; tid++) {
+        threads.push_back(std::thread(normalize_rows, K, layout, inv, tiles[tid], tiles[tid + 1]));
+    }
+    for (auto &t : threads) {
+        t.join();
+    }
+    free(tiles);
+    free(inv);
+}
+
+// Mismatch positions of each combination as a bit mask, combinations being
+// numbered like in kernel_build_parallel
+static std::vector<uint32_t> mismatch_masks(int g, int k) {
+    int num_comb = nchoosek(g, k);
+    unsigned int *out = (unsigned int *) malloc(k * num_comb * sizeof(unsigned int));
+    int *pos = (int *) malloc(g * sizeof(int));
+    unsigned int cnt_comb = 0;
+    getCombinations(g, k, pos, 0, 0, &cnt_comb, out, num_comb);
+    uint32_t all = (1u << g) - 1;
+    std::vector<uint32_t> masks(num_comb);
+    for (int c = 0; c < num_comb; c++) {
+        uint32_t kept = 0;
+        for (int j = 0; j < k; j++) {
+            kept |= 1u << out[c + j * num_comb];
+        }
+        masks[c] = all & ~kept;
+    }
+    free(out);
+    free(pos);
+    return masks;
+}
+
+// Reorder the randomly shuffled combinations so that every prefix removes each
+// position about as often: the next combination is, among the next few
+// candidates, the one whose positions were removed the least so far
+static void stratify(std::vector<int> &indexes, int g, int k) {
+    const int window = 64;
+    std::vector<uint32_t> masks = mismatch_masks(g, k);
+    std::vector<long int> removed(g, 0);
+    int n = indexes.size();
+    for (int i = 0; i < n; i++) {
+        int best = i;
+        long int best_cost = -1;
+        for (int c = i; c < std::min(n, i + window); c++) {
+            long int cost = 0;
+            for (int p = 0; p < g; p++) {
+                if (masks[indexes[c]] >> p & 1) {
+                    cost += removed[p];
+                }
+            }
+            if (best_cost == -1 || cost < best_cost) {
+                best = c;
+                best_cost = cost;
+            }
+        }
+        std::swap(indexes[i], indexes[best]);
+        for (int p = 0; p < g; p++) {
+            removed[p] += masks[indexes[i]] >> p & 1;
+        }
+    }
+}
+
+// Follow each randomly shuffled combination by its antithetic one, which
+// removes the positions shifted by g / 2 (cyclically), so that neighbouring
+// positions of the first are far apart in the second
+static void antithetic(std::vector<int> &indexes, int g, int k) {
+    std::vector<uint32_t> masks = mismatch_masks(g, k);
+    std::map<uint32_t, int> index_of;
+    for (size_t c = 0; c < masks.size(); c++) {
+        index_of[masks[c]] = c;
+    }
+    uint32_t all = (1u << g) - 1;
+    int shift = g / 2;
+    std::vector<bool> used(masks.size(), false);
+    std::vector<int> order;
+    for (int c : indexes) {
+        if (used[c]) {
+            continue;
+        }
+        used[c] = true;
+        order.push_back(c);
+        uint32_t mask = masks[c];
+        int partner = index_of[((mask << shift) | (mask >> (g - shift))) & all];
+        if (!used[partner]) {
+            used[partner] = true;
+            order.push_back(partner);
+        }
+    }
+    indexes = order;
+}
 
 KernelFunction::KernelFunction(kernel_params* params) {
-    std::cout << "Initializing kernel function" << std::endl;
+    if (!params->quiet) {
+        std::cout << "Initializing kernel function" << std::endl;
+    }
     this->params = params;
 }
 
@@ -33,13 +168,26 @@ double* KernelFunction::compute_kernel() {
         indexes[i] = i;
     }
 
-    auto rng = std::default_random_engine {};
-    rng.seed(std::time(0));
-    std::shuffle(std::begin(indexes), std::end(indexes), rng);
+    /* With sort reuse, combinations stay in lexicographic order of their kept
+    positions so that consecutive ones share a prefix of kept positions, and
+    threads take them in contiguous blocks */
+    if (params->sort_reuse && params->approx) {
+        printf("Sort reuse is only used for the exact kernel...\n");
+        params->sort_reuse = false;
+    }
+    if (!params->sort_reuse) {
+        auto rng = std::default_random_engine {};
+        rng.seed(params->seed);
+        std::shuffle(std::begin(indexes), std::end(indexes), rng);
+        if (params->approx && params->sampling == STRATIFIED) {
+            stratify(indexes, params->g, params->k);
+        } else if (params->approx && params->sampling == ANTITHETIC) {
+            antithetic(indexes, params->g, params->k);
+        }
+    }
 
     int queueSize = numCombinations;
     WorkItem *workQueue = new WorkItem[queueSize];
-    int itemNum = 0;
 
     for (int i = 0; i < numCombinations; i++) {
         workQueue[i].m = params->m;
@@ -47,8 +195,10 @@ double* KernelFunction::compute_kernel() {
     }
 
     /* Allocate gapped k-mer kernel */
+    Profile *profile = params->profile;
     double *K = (double *) malloc(params->n_str_pairs * sizeof(double));
     memset(K, 0, params->n_str_pairs * sizeof(double));
+    if (profile) profile->bytes_allocated += params->n_str_pairs * sizeof(double);
 
     /* Determine how many threads to use */
     int num_threads = params->num_threads;
@@ -60,21 +210,97 @@ double* KernelFunction::compute_kernel() {
     }
     num_threads = (num_threads > queueSize) ? queueSize : num_threads;
 
-    /* Create an array of mutex locks */
-    int num_mutex = params->num_mutex;
-    num_mutex = (num_mutex == -1 || num_mutex > num_threads) ? num_threads : num_mutex; 
-    pthread_mutex_t *mutexes = (pthread_mutex_t*) malloc(num_mutex * sizeof(pthread_mutex_t));
-    for (int i = 0; i < num_mutex; i++) {
-        pthread_mutex_init(&mutexes[i], NULL);
+    params->num_threads = num_threads;
+
+    /* In shared accumulator mode all threads add into a single partial kernel,
+    so memory no longer grows with the number of threads */
+    this->shared_Ks = NULL;
+    if (params->shared_accumulator) {
+        if (params->approx && !params->skip_variance) {
+            printf("Variances need per-thread partial kernels; skipping variance with the shared accumulator...\n");
+            params->skip_variance = true;
+        }
+        this->shared_Ks = (unsigned int *) malloc(params->n_str_pairs * sizeof(unsigned int));
+        memset(this->shared_Ks, 0, params->n_str_pairs * sizeof(unsigned int));
+        if (profile) profile->bytes_allocated += params->n_str_pairs * sizeof(unsigned int);
     }
 
-    params->num_threads = num_threads;
-    params->num_mutex = num_mutex;
+    /* Anytime snapshots: each thread adds its partial kernel to a checkpoint
+    once it has done that many work items or the convergence estimate is
+    within that delta, or else when it runs out of work, so a snapshot is the
+    kernel a run with that max_iters or delta would have returned */
+    this->snapshots.clear();
+    this->snapshot_sums = NULL;
+    this->n_snapshot_iters = 0;
+    this->deltas_reached = 0;
+    bool want_snapshots = (params->snapshot_iters != NULL && !params->snapshot_iters->empty())
+        || (params->snapshot_deltas != NULL && !params->snapshot_deltas->empty());
+    if (want_snapshots && (!params->approx || params->shared_accumulator)) {
+        printf("Snapshots need the approximate kernel with per-thread partial kernels; skipping snapshots...\n");
+    } else if (want_snapshots) {
+        if (params->snapshot_iters != NULL) {
+            for (int iters : *params->snapshot_iters) {
+                this->snapshots.push_back({iters, -1, false, 0, NAN, NULL});
+            }
+        }
+        this->n_snapshot_iters = this->snapshots.size();
+        if (params->snapshot_deltas != NULL) {
+            for (double d : *params->snapshot_deltas) {
+                this->snapshots.push_back({-1, d, false, 0, NAN, NULL});
+            }
+        }
+        int n_snapshots = this->snapshots.size();
+        this->snapshot_sums = (double **) calloc(n_snapshots, sizeof(double *));
+        this->snapshot_threads = (int *) calloc(n_snapshots, sizeof(int));
+        this->snapshot_mutexes = new std::mutex[n_snapshots];
+    }
 
     // If central theorem unlikely to apply, compute exact kernel
     // if (numCombinations / num_threads < 50) {
     //     params->approx = false;
     // }
+    /* Sampled variance: the partial kernels accumulate like in exact mode and
+    the variance is only tracked on a random sample of the train pairs. The
+    global estimate uses the same machinery, over GLOBAL_SAMPLE pairs unless a
+    sample size is given */
+    this->sample = NULL;
+    this->n_sample = 0;
+    bool global = params->approx && !params->skip_variance && params->global_convergence;
+    if (params->approx && !params->skip_variance && (params->variance_sample > 0 || global)) {
+        long int n_pairs = variance_pairs(params);
+        long int wanted = (params->variance_sample > 0) ? params->variance_sample : GLOBAL_SAMPLE;
+        this->n_sample = std::min(wanted, n_pairs);
+        this->sample = (long int *) malloc(this->n_sample * sizeof(long int));
+        if (this->n_sample == n_pairs) {
+            for (long int i = 0; i < n_pairs; i++) {
+                this->sample[i] = i;
+            }
+        } else {
+            // Floyd's algorithm, the set keeps the sample sorted
+            std::default_random_engine rng(params->seed);
+            std::set<long int> chosen;
+            for (long int j = n_pairs - this->n_sample; j < n_pairs; j++) {
+                long int i = std::uniform_int_distribution<long int>(0, j)(rng);
+                if (!chosen.insert(i).second) {
+                    chosen.insert(j);
+                }
+            }
+            std::copy(chosen.begin(), chosen.end(), this->sample);
+        }
+        if (profile) profile->bytes_allocated += this->n_sample * sizeof(long int);
+    }
+
+    /* Running mean and M2 of every tracked pair over the work items of all
+    threads, merged from the threads' batches under estimate_mutex */
+    this->est_n = 0;
+    this->est_mean = NULL;
+    this->est_m2 = NULL;
+    if (global) {
+        this->est_mean = (double *) calloc(this->n_sample, sizeof(double));
+        this->est_m2 = (double *) calloc(this->n_sample, sizeof(double));
+        if (profile) profile->bytes_allocated += 2 * this->n_sample * sizeof(double);
+    }
+
     if (params->approx) {
         printf("Computing approximate kernel...\n");
     } else {
@@ -83,28 +309,662 @@ double* KernelFunction::compute_kernel() {
 
     /* Multithreaded kernel construction */
     if (!params->quiet) printf("Computing %d mismatch profiles using %d threads...\n", numCombinations, num_threads);
+    /* Work items are handed out dynamically from a shared counter so threads
+    that fall behind simply take fewer items */
+    this->next_item = 0;
+    this->block_size = 1;
+    if (params->sort_reuse) {
+        this->block_size = std::max(1, queueSize / (num_threads * 8));
+    }
+    this->stop = false;
+    this->work_counts.assign(num_threads, 0);
+    this->partial_Ks = (unsigned int **) malloc(num_threads * sizeof(unsigned int *));
+    this->partial_K_hats = (double **) malloc(num_threads * sizeof(double *));
+    this->partial_scales = (double *) malloc(num_threads * sizeof(double));
+
+    /* Threads check the deadline and the cancellation flag between work items */
+    std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+    this->interrupt = RUNNING;
+    if (params->timeout >= 0) {
+        this->deadline = start + std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+            std::chrono::duration<double>(params->timeout));
+    }
+    /* With a time budget the threads stop like on convergence, and the mean of
+    the partial kernels computed so far is the estimate */
+    if (params->time_budget >= 0 && !params->approx) {
+        printf("The time budget is only used for the approximate kernel...\n");
+        params->time_budget = -1;
+    }
+    this->budget_expired = false;
+    if (params->time_budget >= 0) {
+        this->budget_deadline = start + std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+            std::chrono::duration<double>(params->time_budget));
+    }
+    this->items_done = 0;
+    this->current_sd = NAN;
+    this->threads_done = 0;
+
+    ProfileTime phase_start;
+    if (profile) {
+        profile->start_threads(num_threads);
+        phase_start = profile_now();
+    }
     std::vector<std::thread> threads;
     for (int tid = 0; tid < num_threads; tid++) {
-        threads.push_back(std::thread(&KernelFunction::kernel_build_parallel, this, tid, workQueue, queueSize, mutexes, params, K));
+        threads.push_back(std::thread(&KernelFunction::kernel_build_parallel, this, tid, workQueue, queueSize, params));
+    }
+
+    /* Progress is reported from this thread, so the callback never runs in
+    the workers' loop */
+    std::exception_ptr progress_error = NULL;
+    if (params->progress != NULL) {
+        std::chrono::steady_clock::duration interval = std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+            std::chrono::duration<double>(params->progress_interval));
+        std::chrono::steady_clock::time_point next_report = start + interval;
+        std::unique_lock<std::mutex> lock(this->done_mutex);
+        while (this->threads_done < num_threads) {
+            // woken early only when a thread finishes
+            if (this->done_cv.wait_until(lock, next_report) == std::cv_status::timeout
+                && this->threads_done < num_threads && progress_error == NULL) {
+                lock.unlock();
+                try {
+                    this->report_progress(queueSize, start);
+                } catch (...) {
+                    // stop the workers, the error is raised once they are done
+                    progress_error = std::current_exception();
+                    this->stop = true;
+                }
+                next_report = std::chrono::steady_clock::now() + interval;
+                lock.lock();
+            }
+        }
     }
 
     for (auto &t : threads) {
         t.join();
     }
+    if (profile) {
+        profile->record(profile->events, "kernel", -1, phase_start);
+        // time each thread waited for the slowest one
+        double last = 0;
+        for (int tid = 0; tid < num_threads; tid++) {
+            last = std::max(last, profile->threads[tid].finish);
+        }
+        for (int tid = 0; tid < num_threads; tid++) {
+            profile->threads[tid].idle = last - profile->threads[tid].finish;
+        }
+    }
+
+    if (progress_error != NULL || this->interrupt != RUNNING) {
+        this->free_partials(num_threads);
+        free(this->shared_Ks);
+        free(this->sample);
+        free(this->est_mean);
+        free(this->est_m2);
+        if (this->snapshot_sums != NULL) {
+            for (size_t s = 0; s < this->snapshots.size(); s++) {
+                free(this->snapshot_sums[s]);
+                free(this->snapshots[s].K);
+            }
+            this->snapshots.clear();
+            free(this->snapshot_sums);
+            free(this->snapshot_threads);
+            delete[] this->snapshot_mutexes;
+        }
+        free(K);
+        delete[] workQueue;
+        if (progress_error != NULL) {
+            std::rethrow_exception(progress_error);
+        }
+        if (this->interrupt == CANCELLED) {
+            throw KernelCancelled("kernel computation was cancelled");
+        }
+        throw KernelTimeout("kernel computation timed out");
+    }
+    if (params->progress != NULL) {
+        this->report_progress(queueSize, start);
+    }
+    this->convergence.items = this->items_done;
+    this->convergence.total = queueSize;
+    this->convergence.stdev = this->current_sd;
+    this->convergence.budget_expired = this->budget_expired;
+    if (this->budget_expired && !params->quiet) {
+        printf("Time budget reached after %d of %d mismatch profiles\n", (int) this->items_done, queueSize);
+    }
+    if (this->snapshot_sums != NULL) {
+        // every thread has added itself to every snapshot on its way out
+        free(this->snapshot_sums);
+        free(this->snapshot_threads);
+        delete[] this->snapshot_mutexes;
+    }
 
-    /* Kernel normalization */
-    for (int i = 0; i < params->total_str; i++) {
-        for (int j = 0; j < i; j++) {
-            tri_access(K, i, j) = tri_access(K, i, j) / sqrt(tri_access(K, i, i) * tri_access(K, j, j));
+    if (params->shared_accumulator) {
+        this->partial_Ks[0] = this->shared_Ks;
+    }
+    if (global) {
+        // every work item gets the same weight in the final kernel
+        long int total = 0;
+        for (int tid = 0; tid < num_threads; tid++) {
+            total += this->work_counts[tid];
+        }
+        for (int tid = 0; tid < num_threads; tid++) {
+            this->partial_scales[tid] = (total > 0) ? 1.0 / total : 0.0;
         }
+        free(this->est_mean);
+        free(this->est_m2);
     }
-    for (int i = 0; i < params->total_str; i++) {
-        tri_access(K, i, i) = tri_access(K, i, i) / sqrt(tri_access(K, i, i) * tri_access(K, i, i));
+
+    /* Merge the partial kernels and normalize. The diagonal is merged first;
+    then each thread owns a disjoint band of rows of the triangular matrix, sums
+    every partial kernel over it a block of rows at a time and normalizes the
+    block while it is in cache, so no locking is needed */
+    if (profile) phase_start = profile_now();
+    long int n = params->total_str;
+    double *inv = (double *) malloc(n * sizeof(double));
+    for (long int i = 0; i < n; i++) {
+        long int index = kernel_index(&params->layout, i, i);
+        double diag = 0;
+        for (int t = 0; t < num_threads; t++) {
+            this->add_partial(t, index, index + 1, &diag);
+        }
+        inv[i] = 1 / sqrt(diag);
     }
+    long int *tiles = (long int *) malloc((num_threads + 1) * sizeof(long int));
+    get_tiles(&params->layout, num_threads, tiles);
+    threads.clear();
+    for (int tid = 0; tid < num_threads; tid++) {
+        threads.push_back(std::thread(&KernelFunction::reduce_partials, this, tid, tiles[tid], tiles[tid + 1], K, inv));
+    }
+
+    for (auto &t : threads) {
+        t.join();
+    }
+    if (profile) profile->record(profile->events, "reduce", -1, phase_start);
+
+    this->free_partials(num_threads);
+    free(this->sample);
+    free(tiles);
+    free(inv);
+    delete[] workQueue;
 
     return K;
 }
 
+/* Exact kernels for several m at once. The kernel for (g, m) sums, over every
+subset of g - m kept positions, the pairs of g-mers agreeing on the subset.
+The subsets are walked depth-first in increasing order of positions, each one
+refining the groups of g-mers of its parent by one more position, so the
+g-mers are extracted once and subsets sharing a prefix share its sorting.
+Kernels are returned in the order of ms and normalized. */
+std::vector<double*> KernelFunction::compute_family(const std::vector<int> &ms) {
+    kernel_params *params = this->params;
+    Profile *profile = params->profile;
+    int g = params->g;
+
+    this->family_sizes.clear();
+    int min_size = g;
+    for (int m : ms) {
+        this->family_sizes.push_back(g - m);
+        min_size = std::min(min_size, g - m);
+    }
+    int n_kernels = this->family_sizes.size();
+
+    // g-mer characters, bucketed by the refinement sorts
+    Features *features = params->features;
+    int nfeat = (*features).n;
+    int max_char = 0;
+    for (long int i = 0; i < (long int) nfeat * g; i++) {
+        max_char = std::max(max_char, (*features).features[i]);
+    }
+    this->family_chars = max_char + 1;
+
+    /* Walks start from the subsets of the first one or two positions, so the
+    threads can share the large subtrees of the first positions */
+    int depth = std::min(2, min_size);
+    this->family_tasks.clear();
+    for (int p1 = 0; p1 < g; p1++) {
+        if (depth == 1) {
+            if (this->family_reachable(1, p1)) {
+                this->family_tasks.push_back({p1});
+            }
+            continue;
+        }
+        for (int p2 = p1 + 1; p2 < g; p2++) {
+            if (this->family_reachable(2, p2)) {
+                this->family_tasks.push_back({p1, p2});
+            }
+        }
+    }
+    int queueSize = this->family_tasks.size();
+
+    int num_threads = params->num_threads;
+    if (num_threads == -1) {
+        num_threads = 20;
+    }
+    num_threads = std::max(1, std::min(num_threads, queueSize));
+    params->num_threads = num_threads;
+
+    // partial kernels, a single set shared by all threads in shared accumulator mode
+    bool shared = params->shared_accumulator;
+    long int n_pairs = params->n_str_pairs;
+    this->family_Ks = (unsigned int **) malloc(num_threads * n_kernels * sizeof(unsigned int *));
+    for (int tid = 0; tid < num_threads; tid++) {
+        for (int i = 0; i < n_kernels; i++) {
+            if (shared && tid > 0) {
+                this->family_Ks[tid * n_kernels + i] = this->family_Ks[i];
+            } else {
+                this->family_Ks[tid * n_kernels + i] = (unsigned int *) calloc(n_pairs, sizeof(unsigned int));
+                if (profile) profile->bytes_allocated += n_pairs * sizeof(unsigned int);
+            }
+        }
+    }
+    int n_partials = shared ? 1 : num_threads;
+
+    if (!params->quiet) {
+        printf("Computing the kernels of %d values of m from %d subtrees using %d threads...\n",
+            n_kernels, queueSize, num_threads);
+    }
+    this->next_item = 0;
+    this->stop = false;
+    this->work_counts.assign(num_threads, 0);
+    std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+    this->interrupt = RUNNING;
+    if (params->timeout >= 0) {
+        this->deadline = start + std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+            std::chrono::duration<double>(params->timeout));
+    }
+
+    ProfileTime phase_start;
+    if (profile) {
+        profile->start_threads(num_threads);
+        phase_start = profile_now();
+    }
+    std::vector<std::thread> threads;
+    for (int tid = 0; tid < num_threads; tid++) {
+        threads.push_back(std::thread(&KernelFunction::family_build_parallel, this, tid));
+    }
+    for (auto &t : threads) {
+        t.join();
+    }
+    if (profile) profile->record(profile->events, "kernel", -1, phase_start);
+
+    if (this->interrupt != RUNNING) {
+        for (int t = 0; t < n_partials * n_kernels; t++) {
+            free(this->family_Ks[t]);
+        }
+        free(this->family_Ks);
+        if (this->interrupt == CANCELLED) {
+            throw KernelCancelled("kernel computation was cancelled");
+        }
+        throw KernelTimeout("kernel computation timed out");
+    }
+
+    /* Merge the partial kernels, each thread summing a band of rows */
+    if (profile) phase_start = profile_now();
+    std::vector<double*> kernels;
+    for (int i = 0; i < n_kernels; i++) {
+        kernels.push_back((double *) calloc(n_pairs, sizeof(double)));
+        if (profile) profile->bytes_allocated += n_pairs * sizeof(double);
+    }
+    long int *tiles = (long int *) malloc((num_threads + 1) * sizeof(long int));
+    get_tiles(&params->layout, num_threads, tiles);
+    threads.clear();
+    for (int tid = 0; tid < num_threads; tid++) {
+        long int begin = row_start(&params->layout, tiles[tid]);
+        long int end = row_start(&params->layout, tiles[tid + 1]);
+        threads.push_back(std::thread([this, &kernels, n_kernels, n_partials, begin, end]() {
+            for (int i = 0; i < n_kernels; i++) {
+                double *K = kernels[i];
+                for (int t = 0; t < n_partials; t++) {
+                    unsigned int *Ks = this->family_Ks[t * n_kernels + i];
+                    for (long int j = begin; j < end; j++) {
+                        K[j] += Ks[j];
+                    }
+                }
+            }
+        }));
+    }
+    for (auto &t : threads) {
+        t.join();
+    }
+    free(tiles);
+    for (int t = 0; t < n_partials * n_kernels; t++) {
+        free(this->family_Ks[t]);
+    }
+    free(this->family_Ks);
+    if (profile) profile->record(profile->events, "reduce", -1, phase_start);
+
+    if (profile) phase_start = profile_now();
+    for (double *K : kernels) {
+        normalize_kernel(K, params, num_threads);
+    }
+    if (profile) profile->record(profile->events, "normalize", -1, phase_start);
+
+    this->convergence = {queueSize, queueSize, NAN, false};
+    return kernels;
+}
+
+// Whether a subset of `size` kept positions, the last one being `last`, can
+// still be extended into one of the family's subset sizes
+bool KernelFunction::family_reachable(int size, int last) {
+    for (int s : this->family_sizes) {
+        if (s >= size && s - size <= this->params->g - 1 - last) {
+            return true;
+        }
+    }
+    return false;
+}
+
+void KernelFunction::family_build_parallel(int tid) {
+    kernel_params *params = this->params;
+    Features *features = params->features;
+    long int nfeat = (*features).n;
+    int g = params->g;
+    Profile *profile = params->profile;
+    ThreadProfile *tprof = profile ? &profile->threads[tid] : NULL;
+
+    FamilyWalk walk;
+    walk.Ks = this->family_Ks + tid * this->family_sizes.size();
+    walk.group_hist = profile ? tprof->group_hist : NULL;
+    for (int d = 0; d <= g; d++) {
+        walk.idx[d] = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+        walk.gid[d] = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+        walk.seq[d] = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+        walk.w[d] = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+    }
+    walk.order = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+    walk.tmp = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+    walk.bucket = (long int *) malloc((std::max((long int) this->family_chars, nfeat) + 1) * sizeof(long int));
+    if (profile) {
+        tprof->bytes_allocated += (g + 1) * nfeat * (3 * sizeof(unsigned int) + sizeof(uint64_t));
+    }
+
+    // the empty subset: every g-mer in a single group
+    for (long int i = 0; i < nfeat; i++) {
+        walk.idx[0][i] = i;
+        walk.gid[0][i] = 0;
+        walk.seq[0][i] = (*features).group[i];
+        walk.w[0][i] = ((*features).count != NULL) ? (*features).count[i] : 1;
+    }
+    walk.n[0] = nfeat;
+
+    int items = 0;
+    while (true) {
+        int item = this->next_item.fetch_add(1);
+        if (item >= (int) this->family_tasks.size() || this->interrupted()) {
+            break;
+        }
+        const std::vector<int> &task = this->family_tasks[item];
+        int d = task.size();
+        // the ancestors of the task's subset are shared with other tasks, so
+        // only its own subtree may drop the g-mers left alone in their group
+        for (int j = 0; j < d; j++) {
+            this->family_refine(&walk, j, task[j], j == d - 1);
+        }
+        this->family_visit(&walk, d, task[d - 1]);
+        this->work_counts[tid]++;
+        items++;
+    }
+
+    if (profile) {
+        tprof->work_items = items;
+        tprof->finish = profile->elapsed();
+    }
+    for (int d = 0; d <= g; d++) {
+        free(walk.idx[d]);
+        free(walk.gid[d]);
+        free(walk.seq[d]);
+        free(walk.w[d]);
+    }
+    free(walk.order);
+    free(walk.tmp);
+    free(walk.bucket);
+}
+
+// Build level d + 1 of the walk by splitting the groups of level d on the
+// character at position p. With prune, a g-mer left alone in its group only
+// ever matches itself below this subset, so its self-pair is added to every
+// kernel for each subset of the subtree and it is dropped from the walk.
+void KernelFunction::family_refine(FamilyWalk *walk, int d, int p, bool prune) {
+    kernel_params *params = this->params;
+    const int *feat = (*params->features).features;
+    long int nfeat = (*params->features).n;
+    long int n = walk->n[d];
+    unsigned int *idx = walk->idx[d];
+    uint64_t *gid = walk->gid[d];
+    long int *bucket = walk->bucket;
+
+    // stable bucket sort by character, then by group
+    int n_chars = this->family_chars;
+    memset(bucket, 0, (n_chars + 1) * sizeof(long int));
+    for (long int i = 0; i < n; i++) {
+        bucket[feat[idx[i] + p * nfeat] + 1]++;
+    }
+    for (int c = 0; c < n_chars; c++) {
+        bucket[c + 1] += bucket[c];
+    }
+    for (long int i = 0; i < n; i++) {
+        walk->tmp[bucket[feat[idx[i] + p * nfeat]]++] = i;
+    }
+    long int n_groups = (n > 0) ? gid[n - 1] + 1 : 0;
+    memset(bucket, 0, (n_groups + 1) * sizeof(long int));
+    for (long int i = 0; i < n; i++) {
+        bucket[gid[i] + 1]++;
+    }
+    for (long int c = 0; c < n_groups; c++) {
+        bucket[c + 1] += bucket[c];
+    }
+    for (long int j = 0; j < n; j++) {
+        long int i = walk->tmp[j];
+        walk->order[bucket[gid[i]]++] = i;
+    }
+
+    // subsets of each size in the subtree of the new subset, itself included
+    int n_kernels = this->family_sizes.size();
+    unsigned int subtree[MAXG + 1];
+    for (int s = 0; s < n_kernels; s++) {
+        int extra = this->family_sizes[s] - (d + 1);
+        subtree[s] = (extra >= 0) ? nchoosek(params->g - 1 - p, extra) : 0;
+    }
+
+    unsigned int *out_idx = walk->idx[d + 1];
+    uint64_t *out_gid = walk->gid[d + 1];
+    unsigned int *out_seq = walk->seq[d + 1];
+    unsigned int *out_w = walk->w[d + 1];
+    long int m = 0;
+    uint64_t next_gid = 0;
+    long int j = 0;
+    while (j < n) {
+        // g-mers of one new group: same old group and same character at p
+        long int i = walk->order[j];
+        int c = feat[idx[i] + p * nfeat];
+        long int end = j + 1;
+        while (end < n && gid[walk->order[end]] == gid[i] && feat[idx[walk->order[end]] + p * nfeat] == c) {
+            end++;
+        }
+        if (prune && end - j == 1) {
+            unsigned int s_id = walk->seq[d][i];
+            unsigned int w = walk->w[d][i];
+            long int diag = kernel_index(&params->layout, s_id, s_id);
+            for (int s = 0; s < n_kernels; s++) {
+                if (subtree[s] == 0) {
+                    continue;
+                }
+                if (params->shared_accumulator) {
+                    __atomic_fetch_add(&walk->Ks[s][diag], subtree[s] * w * w, __ATOMIC_RELAXED);
+                } else {
+                    walk->Ks[s][diag] += subtree[s] * w * w;
+                }
+            }
+        } else {
+            for (long int t = j; t < end; t++) {
+                long int k = walk->order[t];
+                out_idx[m] = idx[k];
+                out_gid[m] = next_gid;
+                out_seq[m] = walk->seq[d][k];
+                out_w[m] = walk->w[d][k];
+                m++;
+            }
+            next_gid++;
+        }
+        j = end;
+    }
+    walk->n[d + 1] = m;
+}
+
+// Add the subset of d kept positions ending at `last` to the kernels of its
+// size, then walk its extensions
+void KernelFunction::family_visit(FamilyWalk *walk, int d, int last) {
+    kernel_params *params = this->params;
+    if (this->interrupted()) {
+        return;
+    }
+    for (size_t s = 0; s < this->family_sizes.size(); s++) {
+        if (this->family_sizes[s] == d && walk->n[d] > 0) {
+            countAndUpdateTriPacked(walk->Ks[s], walk->gid[d], walk->seq[d], walk->w[d], walk->n[d],
+                params->total_str, params->shared_accumulator, &params->layout, walk->group_hist);
+        }
+    }
+    if (walk->n[d] == 0) {
+        return;
+    }
+    for (int p = last + 1; p < params->g; p++) {
+        if (this->family_reachable(d + 1, p)) {
+            this->family_refine(walk, d, p, true);
+            this->family_visit(walk, d + 1, p);
+        }
+    }
+}
+
+// Add the current work item of a thread to its batch: the running mean and M2
+// of its tracked pairs over its last items. Every ESTIMATE_BATCH items the batch
+// is merged into the estimate shared by all threads, which stops them once it is
+// within delta. Ks is the thread's cumulative partial kernel, prev its tracked
+// entries before this item.
+void KernelFunction::update_estimate(unsigned int *Ks, unsigned int *prev, double *mean, double *m2,
+    long int *batch_n) {
+    long int b = ++*batch_n;
+    for (long int s = 0; s < this->n_sample; s++) {
+        unsigned int cur = Ks[this->sample[s]];
+        double x = cur - prev[s];
+        prev[s] = cur;
+        double delta = x - mean[s];
+        mean[s] += delta / b;
+        m2[s] += delta * (x - mean[s]);
+    }
+    if (b < ESTIMATE_BATCH) {
+        return;
+    }
+    *batch_n = 0;
+
+    std::lock_guard<std::mutex> lock(this->estimate_mutex);
+    long int n_a = this->est_n;
+    long int n = n_a + b;
+    double sum_m2 = 0;
+    for (long int s = 0; s < this->n_sample; s++) {
+        // Chan et al.'s merge of two running means and M2s
+        double delta = mean[s] - this->est_mean[s];
+        this->est_mean[s] += delta * b / n;
+        this->est_m2[s] += m2[s] + delta * delta * n_a * b / n;
+        sum_m2 += this->est_m2[s];
+        mean[s] = 0;
+        m2[s] = 0;
+    }
+    this->est_n = n;
+    // the average variance of a work item over the tracked pairs, on the scale
+    // of the per-thread estimate (see get_variance): its square root over the
+    // number of items
+    double sd = std::sqrt(sum_m2 / this->n_sample / (n - 1)) / n;
+    this->stdevs.push_back(sd);
+    this->current_sd = sd;
+    if (this->snapshot_sums != NULL) {
+        this->trigger_deltas(sd);
+    }
+    if (this->params->delta / sd > 1.96) {
+        this->stop = true;
+    }
+}
+
+// Add a thread's partial kernel to snapshot s: either its mean partial kernel
+// K_hat, or its integer partial kernel Ks times scale. The last thread to add
+// itself normalizes the snapshot and stores it as float.
+void KernelFunction::add_snapshot(int s, const unsigned int *Ks, const double *K_hat, double scale,
+    long int items, bool reached) {
+    std::lock_guard<std::mutex> lock(this->snapshot_mutexes[s]);
+    long int n = this->params->n_str_pairs;
+    double *sum = this->snapshot_sums[s];
+    if (sum == NULL) {
+        sum = (double *) calloc(n, sizeof(double));
+        this->snapshot_sums[s] = sum;
+    }
+    if (K_hat != NULL) {
+        for (long int i = 0; i < n; i++) {
+            sum[i] += K_hat[i];
+        }
+    } else {
+        for (long int i = 0; i < n; i++) {
+            sum[i] += Ks[i] * scale;
+        }
+    }
+    Snapshot *snapshot = &this->snapshots[s];
+    snapshot->items += items;
+    snapshot->reached = snapshot->reached || reached;
+    if (++this->snapshot_threads[s] < this->params->num_threads) {
+        return;
+    }
+    // the other threads are still computing
+    normalize_kernel(sum, this->params, 1);
+    snapshot->K = (float *) malloc(n * sizeof(float));
+    for (long int i = 0; i < n; i++) {
+        snapshot->K[i] = (float) sum[i];
+    }
+    free(sum);
+    this->snapshot_sums[s] = NULL;
+    if (snapshot->iters != -1) {
+        snapshot->stdev = this->current_sd;
+    }
+}
+
+// Mark the delta checkpoints the convergence estimate sd is within as reached;
+// the threads add themselves to them after their current work item
+void KernelFunction::trigger_deltas(double sd) {
+    int n_deltas = this->snapshots.size() - this->n_snapshot_iters;
+    int reached = this->deltas_reached;
+    int j = reached;
+    while (j < n_deltas && this->snapshots[this->n_snapshot_iters + j].delta / sd > 1.96) {
+        j++;
+    }
+    while (reached < j) {
+        if (this->deltas_reached.compare_exchange_weak(reached, j)) {
+            for (int d = reached; d < j; d++) {
+                this->snapshots[this->n_snapshot_iters + d].stdev = sd;
+            }
+            break;
+        }
+    }
+}
+
+// Same estimate as get_variance, over the sampled pairs only. Ks holds the
+// cumulative partial kernel, the value of the current item is the increase
+// since the previous one.
+double KernelFunction::get_sample_variance(unsigned int *Ks, unsigned int *prev, double *mean, int iter) {
+    double avg_variance = 0;
+    for (long int s = 0; s < this->n_sample; s++) {
+        unsigned int cur = Ks[this->sample[s]];
+        double x = cur - prev[s];
+        prev[s] = cur;
+        double delta = x - mean[s];
+        mean[s] += delta / iter;
+        avg_variance += delta * (x - mean[s]);
+    }
+    avg_variance /= this->n_sample;
+    if (iter == 1) {
+        // undefined from a single item, never within delta
+        return NAN;
+    }
+    return avg_variance / (iter - 1);
+}
+
 double KernelFunction::get_variance(unsigned int *Ks, double *K_hat, double *variances, int n_str_pairs, int n_train_pairs, int iter) {
     double max_variance = 0;
     double avg_variance = 0;
@@ -132,8 +992,9 @@ double KernelFunction::get_variance(unsigned int *Ks, double *K_hat, double *var
 
     avg_variance /= count;
     if (iter == 1) {
-        avg_variance = 9999999;
-        max_variance = 9999999;
+        // undefined from a single item, never within delta
+        avg_variance = NAN;
+        max_variance = NAN;
     } else {
         avg_variance /= iter - 1;
         max_variance /= max_variance / (iter - 1);
@@ -143,192 +1004,440 @@ double KernelFunction::get_variance(unsigned int *Ks, double *K_hat, double *var
 }
 
 void KernelFunction::kernel_build_parallel(int tid, WorkItem *workQueue, int queueSize,
-    pthread_mutex_t *mutexes, kernel_params *params, double *Ksfinal) {
+    kernel_params *params) {
 
-    int itemNum = tid;
     Feature *features = params->features;
     int nfeat = (*features).n;
     int *feat = (*features).features;
     int g = params->g;
-    int m = params->m;
     int k = params->k;
-    int n_str_train = params->n_str_train;
-    int n_str_test = params->n_str_test;
     long int n_str_pairs = params->n_str_pairs;
     long int total_str = params->total_str;
     int dict_size = params->dict_size;
-    int num_mutex = params->num_mutex;
-    int num_threads = params->num_threads;
     double delta = params->delta;
-    bool quiet = params->quiet;
     bool approx = params->approx;
     int max_iters = params->max_iters;
     bool skip_variance = params->skip_variance;
+    Profile *profile = params->profile;
+    ThreadProfile *tprof = profile ? &profile->threads[tid] : NULL;
+    long int *group_hist = profile ? tprof->group_hist : NULL;
+    ProfileTime phase_start;
 
     int num_comb = nchoosek(g, k);
-    long int n_train_pairs = (n_str_train / (double) 2) * (n_str_train + 1);
-    long int n_test_pairs = (n_str_test / (double) 2) * (n_str_test + 1);
+    KernelLayout *layout = &params->layout;
+    long int n_train_pairs = variance_pairs(params);
 
     bool working = true;
     int iter = 1;
+    int itemNum = 0;
+    int blockEnd = 0;
 
-    unsigned int* Ks = (unsigned int*) malloc(sizeof(unsigned int) * n_str_pairs);
-    memset(Ks, 0, sizeof(unsigned int) * n_str_pairs);
-    
-    double* K_hat;
-    double* variances;
+    bool shared = params->shared_accumulator;
+    unsigned int* Ks;
+    if (shared) {
+        Ks = this->shared_Ks;
+    } else {
+        Ks = (unsigned int*) malloc(sizeof(unsigned int) * n_str_pairs);
+        memset(Ks, 0, sizeof(unsigned int) * n_str_pairs);
+        if (profile) tprof->bytes_allocated += sizeof(unsigned int) * n_str_pairs;
+    }
 
-    if (approx && !skip_variance) {
+    double* K_hat = NULL;
+    double* variances = NULL;
+    bool sampled = this->sample != NULL;
+    bool global = this->est_mean != NULL;
+    // next iteration and delta checkpoints this thread has to add itself to
+    bool snapshotting = this->snapshot_sums != NULL;
+    int n_iter_snaps = this->n_snapshot_iters;
+    int next_iter_snap = 0;
+    int next_delta_snap = 0;
+    // per sampled pair: its value in Ks before the current item, and its running
+    // mean and M2 (over the current batch with global convergence)
+    unsigned int *sample_prev = NULL;
+    double *sample_mean = NULL;
+    double *sample_m2 = NULL;
+    long int batch_n = 0;
+
+    if (sampled) {
+        sample_prev = (unsigned int *) calloc(this->n_sample, sizeof(unsigned int));
+        sample_mean = (double *) calloc(this->n_sample, sizeof(double));
+        if (profile) tprof->bytes_allocated += this->n_sample * (sizeof(unsigned int) + sizeof(double));
+        if (global) {
+            sample_m2 = (double *) calloc(this->n_sample, sizeof(double));
+            if (profile) tprof->bytes_allocated += this->n_sample * sizeof(double);
+        }
+    } else if (approx && !skip_variance) {
         K_hat = (double*) malloc(sizeof(double) * n_str_pairs);
         variances = (double*) malloc(sizeof(double) * n_train_pairs);
         memset(K_hat, 0, sizeof(double) * n_str_pairs);
         memset(variances, 0, sizeof(double) * n_train_pairs);
+        if (profile) tprof->bytes_allocated += sizeof(double) * (n_str_pairs + n_train_pairs);
+    }
+
+    // kept (non-mismatch) positions of every combination
+    unsigned int *out = (unsigned int *) malloc(k * num_comb * sizeof(unsigned int));
+    int *pos = (int *) malloc(g * sizeof(int));
+    unsigned int cnt_comb = 0;
+    getCombinations(g, k, pos, 0, 0, &cnt_comb, out, num_comb);
+    int *kept = (int *) malloc(k * sizeof(int));
+
+    // gmer ids and occurrence counts, associated with the sorted features
+    unsigned int *group_srt = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+    unsigned int *count = (*features).count;
+    unsigned int *count_srt = (count != NULL) ? (unsigned int *) malloc(nfeat * sizeof(unsigned int)) : NULL;
+
+    // g-mers packed into 64-bit words are sorted as single integer keys
+    bool packed = (*features).packed != NULL;
+    int bits = (*features).bits;
+    uint64_t *keys = NULL;
+    uint64_t *keys_tmp = NULL;
+    unsigned int *sort_idx = NULL;
+    unsigned int *idx_tmp = NULL;
+    unsigned int run_shift[MAXG], run_len[MAXG];
+    uint64_t run_mask[MAXG];
+    if (packed) {
+        keys = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+        keys_tmp = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+        sort_idx = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+        idx_tmp = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+        if (profile) tprof->bytes_allocated += nfeat * (2 * sizeof(uint64_t) + 2 * sizeof(unsigned int));
     }
 
+    // kept positions of the combination the features are currently sorted by
+    bool sort_reuse = params->sort_reuse && packed;
+    int *prev_kept = (int *) malloc(k * sizeof(int));
+    bool have_prev = false;
+
     while (working) {
+        if (itemNum >= blockEnd) {
+            itemNum = this->next_item.fetch_add(this->block_size);
+            blockEnd = std::min(itemNum + this->block_size, queueSize);
+        }
+        if (itemNum >= queueSize || this->stop || this->interrupted()) {
+            break;
+        }
+        // every thread gets at least one work item in
+        if (params->time_budget >= 0 && iter > 1 && std::chrono::steady_clock::now() >= this->budget_deadline) {
+            this->budget_expired = true;
+            this->stop = true;
+            break;
+        }
         WorkItem workItem = workQueue[itemNum];
+        itemNum++;
 
         // don't cumulate mismatch profiles if computing partial kernel variances
-        if (approx && !skip_variance) {
+        if (approx && !skip_variance && !sampled) {
             memset(Ks, 0, sizeof(unsigned int) * n_str_pairs);
         }
 
         // specifies which partial kernel is to be computed
         int combo_num = workItem.combo_num;
-        Combinations *combinations = (Combinations *) malloc(sizeof(combinations));
-        (*combinations).n = g;
-        (*combinations).k = k;
-        (*combinations).num_comb = num_comb;
+        for (int j = 0; j < k; ++j) {
+            kept[j] = out[combo_num + j * num_comb];
+        }
 
-        // array of gmer indices associated with group_srt and features_srt
-        unsigned int *sortIdx = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
-        // sorted gmers
-        unsigned int *features_srt = (unsigned int *) malloc(nfeat * g * sizeof(unsigned int));
-        // gmer ids; associated with features_srt and sortIdx
-        unsigned int *group_srt = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
-        unsigned int *cnt_comb = (unsigned int *) malloc(2 * sizeof(unsigned int)); //
-        // sorted features once mismatch positions are removed
-        unsigned int *feat1 = (unsigned int *) malloc(nfeat * g * sizeof(unsigned int)); 
+        if (profile) phase_start = profile_now();
+        if (packed) {
+            // project each packed g-mer onto the kept positions, then sort the keys
+            unsigned int nruns = get_runs(kept, k, g, bits, run_shift, run_mask, run_len);
 
-        int *pos = (int *) malloc(nfeat * sizeof(int));
-        memset(pos, 0, sizeof(int) * nfeat);
+            // number of leading kept positions shared with the current sort order
+            int prefix = 0;
+            if (sort_reuse && have_prev) {
+                while (prefix < k && kept[prefix] == prev_kept[prefix]) {
+                    prefix++;
+                }
+            }
 
-        unsigned int *out = (unsigned int *) malloc(k * num_comb * sizeof(unsigned int));
-        unsigned int *cnt_m = (unsigned int *) malloc(g * sizeof(unsigned int));
-        cnt_comb[0] = 0;
-        getCombinations((*combinations).n, (*combinations).k, pos, 0, 0, cnt_comb, out, num_comb);
-        cnt_m[m] = cnt_comb[0];
-        cnt_comb[0] += ((*combinations).k * num_comb);
+            if (prefix == 0) {
+                for (int j1 = 0; j1 < nfeat; ++j1) {
+                    keys[j1] = project_key((*features).packed[j1], nruns, run_shift, run_mask, run_len);
+                    sort_idx[j1] = j1;
+                }
+                radixsort(keys, sort_idx, keys_tmp, idx_tmp, nfeat, k * bits);
+            } else {
+                // already sorted by the shared prefix, only the rest needs sorting
+                for (int j1 = 0; j1 < nfeat; ++j1) {
+                    keys[j1] = project_key((*features).packed[sort_idx[j1]], nruns, run_shift, run_mask, run_len);
+                }
+                refinesort(keys, sort_idx, keys_tmp, idx_tmp, nfeat, (k - prefix) * bits);
+            }
+            for (int j1 = 0; j1 < nfeat; ++j1) {
+                group_srt[j1] = (*features).group[sort_idx[j1]];
+            }
+            if (count != NULL) {
+                for (int j1 = 0; j1 < nfeat; ++j1) {
+                    count_srt[j1] = count[sort_idx[j1]];
+                }
+            }
+            memcpy(prev_kept, kept, k * sizeof(int));
+            have_prev = true;
+            if (profile) {
+                profile->record(tprof->events, "sort", tid, phase_start);
+                phase_start = profile_now();
+            }
+
+            // compute partial mismatch profile for these mismatch positions (slow)
+            countAndUpdateTriPacked(Ks, keys, group_srt, count_srt, nfeat, total_str, shared, layout, group_hist);
+        } else {
+            // array of gmer indices associated with group_srt and features_srt
+            unsigned int *sortIdx = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+            // sorted gmers
+            unsigned int *features_srt = (unsigned int *) malloc(nfeat * g * sizeof(unsigned int));
+            // sorted features once mismatch positions are removed
+            unsigned int *feat1 = (unsigned int *) malloc(nfeat * g * sizeof(unsigned int));
 
-        // remove mismatch positions
-        for (int j1 = 0; j1 < nfeat; ++j1) {
-            for (int j2 = 0; j2 < k; ++j2) {
-                feat1[j1 + j2 * nfeat] = feat[j1 + (out[(cnt_m[m] - num_comb + combo_num) + j2 * num_comb]) * nfeat];
+            // remove mismatch positions
+            for (int j1 = 0; j1 < nfeat; ++j1) {
+                for (int j2 = 0; j2 < k; ++j2) {
+                    feat1[j1 + j2 * nfeat] = feat[j1 + kept[j2] * nfeat];
+                }
             }
-        }
 
-        // sort the g-mers (this is relatively fast)
-        cntsrtna(sortIdx, feat1, k, nfeat, dict_size);
+            // sort the g-mers (this is relatively fast)
+            cntsrtna(sortIdx, feat1, k, nfeat, dict_size);
 
-        for (int j1 = 0; j1 < nfeat; ++j1) {
-            for (int j2 = 0; j2 <  k; ++j2) {
-                features_srt[j1 + j2*nfeat] = feat1[(sortIdx[j1]) + j2*nfeat];
+            for (int j1 = 0; j1 < nfeat; ++j1) {
+                for (int j2 = 0; j2 <  k; ++j2) {
+                    features_srt[j1 + j2*nfeat] = feat1[(sortIdx[j1]) + j2*nfeat];
+                }
+                group_srt[j1] = (*features).group[sortIdx[j1]];
+                if (count != NULL) {
+                    count_srt[j1] = count[sortIdx[j1]];
+                }
+            }
+            if (profile) {
+                profile->record(tprof->events, "sort", tid, phase_start);
+                phase_start = profile_now();
             }
-            group_srt[j1] = (*features).group[sortIdx[j1]];
-        }
 
-        // compute partial mismatch profile for these mismatch positions (slow)
-        countAndUpdateTri(Ks, features_srt, group_srt, k, nfeat, total_str);
+            // compute partial mismatch profile for these mismatch positions (slow)
+            countAndUpdateTri(Ks, features_srt, group_srt, count_srt, k, nfeat, total_str, shared, layout, group_hist);
+
+            free(sortIdx);
+            free(features_srt);
+            free(feat1);
+        }
+        if (profile) profile->record(tprof->events, "update", tid, phase_start);
 
         if (approx && !skip_variance) {
-            double sd = this->get_variance(Ks, K_hat, variances, n_str_pairs, n_train_pairs, iter);
+            if (profile) phase_start = profile_now();
+            double sd;
+            if (global) {
+                // the shared estimate records the trace and stops every thread
+                this->update_estimate(Ks, sample_prev, sample_mean, sample_m2, &batch_n);
+            } else if (sampled) {
+                sd = this->get_sample_variance(Ks, sample_prev, sample_mean, iter);
+            } else {
+                sd = this->get_variance(Ks, K_hat, variances, n_str_pairs, n_train_pairs, iter);
+            }
+            if (profile) profile->record(tprof->events, "variance", tid, phase_start);
 
-            if (iter >= 1) {
+            if (!global) {
                 sd = std::sqrt(sd / iter);
                 if (tid == 0) {
                     this->stdevs.push_back(sd);
+                    this->current_sd = sd;
+                }
+                if (snapshotting) {
+                    this->trigger_deltas(sd);
                 }
                 if (delta / sd > 1.96) {
-                    printf("thread %d converged in %d iterations...\n", tid, iter);
+                    // let every thread finish together
+                    this->stop = true;
                     working = false;
                 }
             }
         }
         if (approx) {
             if (max_iters != -1 && iter >= max_iters) {
-                printf("thread %d reached max iterations...\n", tid);
                 working = false;
             }
         }
 
-        free(cnt_m);
-        free(out);
-        free(sortIdx);
-        free(features_srt);
-        free(group_srt);
-        free(feat1);
-        free(cnt_comb);
-        free(pos);
-        free(combinations);
-
-        // Check if the thread needs to handle more mismatch profiles
-        itemNum += num_threads;
-        if (itemNum >= queueSize) {
-            working = false;
+        if (snapshotting) {
+            double scale = (sampled && !global) ? 1.0 / iter : 1.0;
+            while (next_iter_snap < n_iter_snaps && this->snapshots[next_iter_snap].iters <= iter) {
+                this->add_snapshot(next_iter_snap++, Ks, K_hat, scale, iter, true);
+            }
+            while (next_delta_snap < this->deltas_reached) {
+                this->add_snapshot(n_iter_snaps + next_delta_snap++, Ks, K_hat, scale, iter, true);
+            }
         }
 
+        this->work_counts[tid]++;
+        this->items_done++;
         iter++;
     }
 
-    printf("Thread %d finished in %d iterations...\n", tid, iter - 1);
+    if (snapshotting && !this->interrupted()) {
+        // checkpoints this thread never got to hold its final partial kernel
+        double scale = (sampled && !global) ? ((iter > 1) ? 1.0 / (iter - 1) : 0.0) : 1.0;
+        int n_snapshots = this->snapshots.size();
+        while (next_iter_snap < n_iter_snaps) {
+            this->add_snapshot(next_iter_snap++, Ks, K_hat, scale, iter - 1, false);
+        }
+        for (int s = n_iter_snaps + next_delta_snap; s < n_snapshots; s++) {
+            this->add_snapshot(s, Ks, K_hat, scale, iter - 1, false);
+        }
+    }
+
+    if (profile) {
+        tprof->work_items = iter - 1;
+        tprof->finish = profile->elapsed();
+    }
 
-    // set up the mutexes to lock as you go through the matrix
-    int cusps[num_mutex];
-    for (int i = 0; i < num_mutex; i++) {
-        cusps[i] = (int) (i * ((double) n_str_pairs) / num_mutex);
+    free(out);
+    free(pos);
+    free(kept);
+    free(group_srt);
+    free(count_srt);
+    free(keys);
+    free(keys_tmp);
+    free(sort_idx);
+    free(idx_tmp);
+    free(prev_kept);
+
+    // hand the partial kernel over to the reduction step
+    this->partial_Ks[tid] = shared ? NULL : Ks;
+    this->partial_K_hats[tid] = NULL;
+    this->partial_scales[tid] = 1.0;
+    if (sampled) {
+        // the mean partial kernel, like K_hat
+        this->partial_scales[tid] = (iter > 1) ? 1.0 / (iter - 1) : 0.0;
+        free(sample_prev);
+        free(sample_mean);
+        free(sample_m2);
+    } else if (approx && !skip_variance) {
+        this->partial_K_hats[tid] = K_hat;
+        free(variances);
     }
 
-    /* the feared kernel update step, locking is necessary to keep it thread-safe.
-    current locking strategy involves splitting the array rows into groups and locking per group.
-    also tried going top->bottom or bottom->top dependent on work order to split
-    contention among the locks, seemed to split up contention but made it slightly slower?
-    */
-    int count = 0;
-    if (num_threads > 1) {
-        for (int j1 = 0; j1 < n_str_pairs; ++j1) {
-            if (j1 == cusps[count]) {
-                if (count != 0) {
-                    pthread_mutex_unlock(&mutexes[count - 1]);
-                }
-                pthread_mutex_lock(&mutexes[count]);
-                if (count + 1 < num_mutex) count++;
-            }
-            double val = (approx && !skip_variance) ? K_hat[j1] : Ks[j1];
-            if (val != 0) Ksfinal[j1] += val;
+    {
+        std::lock_guard<std::mutex> lock(this->done_mutex);
+        this->threads_done++;
+    }
+    this->done_cv.notify_one();
+}
+
+// True once the computation was cancelled or ran past its deadline
+bool KernelFunction::interrupted() {
+    if (this->interrupt != RUNNING) {
+        return true;
+    }
+    if (this->params->cancel != NULL && *this->params->cancel) {
+        this->interrupt = CANCELLED;
+    } else if (this->params->timeout >= 0 && std::chrono::steady_clock::now() >= this->deadline) {
+        this->interrupt = TIMED_OUT;
+    }
+    return this->interrupt != RUNNING;
+}
+
+void KernelFunction::report_progress(int total, std::chrono::steady_clock::time_point start) {
+    std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+    (*this->params->progress)(this->items_done, total, elapsed.count(), this->current_sd);
+}
+
+void KernelFunction::free_partials(int num_threads) {
+    for (int tid = 0; tid < num_threads; tid++) {
+        free(this->partial_Ks[tid]);
+        free(this->partial_K_hats[tid]);
+    }
+    free(this->partial_Ks);
+    free(this->partial_K_hats);
+    free(this->partial_scales);
+}
+
+void KernelFunction::reduce_partials(int tid, long int first, long int last, double *Ksfinal, const double *inv) {
+    kernel_params *params = this->params;
+    const KernelLayout *layout = &params->layout;
+    ProfileTime phase_start;
+    if (params->profile) phase_start = profile_now();
+    // blocks of about 128 KB of the final kernel
+    const long int block = 1 << 14;
+
+    long int r = first;
+    while (r < last) {
+        long int begin = row_start(layout, r);
+        long int r_end = r + 1;
+        while (r_end < last && row_start(layout, r_end + 1) - begin <= block) {
+            r_end++;
         }
-        pthread_mutex_unlock(&mutexes[num_mutex - 1]);
-    } else {
-        for (int i = 0; i < n_str_pairs; i++) {
-            double val = (approx && !skip_variance) ? K_hat[i] : Ks[i];
-            if (val != 0) Ksfinal[i] += val;
+        long int end = row_start(layout, r_end);
+        for (int t = 0; t < params->num_threads; t++) {
+            this->add_partial(t, begin, end, Ksfinal + begin);
         }
+        normalize_rows(Ksfinal, layout, inv, r, r_end);
+        r = r_end;
     }
+    if (params->profile) params->profile->record(params->profile->threads[tid].events, "reduce", tid, phase_start);
+}
 
-    free(Ks);
-    if (approx && !skip_variance) {
-        free(K_hat);
-        free(variances);
+// Add the entries [begin, end) of the partial kernel of thread t, with its
+// scale, to out[0 .. end - begin)
+void KernelFunction::add_partial(int t, long int begin, long int end, double *out) {
+    kernel_params *params = this->params;
+    bool use_hat = params->approx && !params->skip_variance && this->sample == NULL;
+    if (use_hat) {
+        double *K_hat = this->partial_K_hats[t];
+        for (long int i = begin; i < end; i++) {
+            out[i - begin] += K_hat[i];
+        }
+    } else if (this->partial_Ks[t] != NULL && this->partial_scales[t] != 1.0) {
+        unsigned int *Ks = this->partial_Ks[t];
+        double scale = this->partial_scales[t];
+        for (long int i = begin; i < end; i++) {
+            out[i - begin] += Ks[i] * scale;
+        }
+    } else if (this->partial_Ks[t] != NULL) {
+        unsigned int *Ks = this->partial_Ks[t];
+        for (long int i = begin; i < end; i++) {
+            out[i - begin] += Ks[i];
+        }
     }
 }
 
-double *construct_test_kernel(int n_str_train, int n_str_test, double *K) {
-    double* test_K = (double*) malloc(n_str_test * n_str_train * sizeof(double));
+// Number of leading kernel entries the variance is tracked over: the train
+// pairs, or every entry if there are none
+long int variance_pairs(const kernel_params *params) {
+    if (params->layout.cross && !params->layout.a_pairs) {
+        return params->n_str_pairs;
+    }
+    return (params->n_str_train / (double) 2) * (params->n_str_train + 1);
+}
+
+// Split the rows of a kernel stored with the given layout into num_tiles bands
+// holding roughly the same number of entries. Band t covers rows
+// [bounds[t], bounds[t + 1]).
+void get_tiles(const KernelLayout *layout, int num_tiles, long int *bounds) {
+    long int n = layout->n_str;
+    double size = kernel_size(layout);
+    bounds[0] = 0;
+    for (int t = 1; t < num_tiles; t++) {
+        double target = t * (size / num_tiles);
+        // first row starting at or after the target entry
+        long int lo = bounds[t - 1], hi = n;
+        while (lo < hi) {
+            long int mid = (lo + hi) / 2;
+            if (row_start(layout, mid) < target) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        bounds[t] = lo;
+    }
+    bounds[num_tiles] = n;
+}
+
+// The test rows of the packed kernel K as a dense n_str_test x n_str_train
+// matrix. K is already normalized by compute_kernel.
+double *construct_test_kernel(int n_str_train, int n_str_test, double *K, const KernelLayout *layout) {
+    double* test_K = (double*) malloc((long int) n_str_test * n_str_train * sizeof(double));
     int total_str = n_str_train + n_str_test;
     for (int i = n_str_train; i < total_str; i++){
-        for (int j = 0; j < n_str_train; j++){
-            test_K[(i - n_str_train) * n_str_train + j] 
-                = tri_access(K, i, j) / sqrt(tri_access(K, i, i) * tri_access(K, j, j));
-        }
+        const double *row = K + kernel_index(layout, i, 0);
+        memcpy(test_K + (long int) (i - n_str_train) * n_str_train, row, n_str_train * sizeof(double));
     }
     return test_K;
 }
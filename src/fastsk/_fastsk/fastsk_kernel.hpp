@@ -2,7 +2,58 @@
 #define FASTSK_KERNEL_H
 
 #include "shared.h"
+#include "profile.h"
 #include <thread>
+#include <atomic>
+#include <mutex>
+#include <condition_variable>
+#include <chrono>
+#include <functional>
+#include <stdexcept>
+#include <exception>
+#include <vector>
+
+// Progress report: work items done, total work items, seconds elapsed and the
+// current convergence estimate (NaN when it is not tracked)
+typedef std::function<void(int, int, double, double)> ProgressFn;
+
+// Thrown by KernelFunction::compute_kernel when it is cancelled or runs past
+// its deadline; the partial kernel is discarded
+class KernelCancelled : public std::runtime_error {
+public:
+    KernelCancelled(const std::string &what) : std::runtime_error(what) {}
+};
+
+class KernelTimeout : public std::runtime_error {
+public:
+    KernelTimeout(const std::string &what) : std::runtime_error(what) {}
+};
+
+// Kernel as it stood at a checkpoint of an approximate computation, see
+// FastSK::set_snapshots
+typedef struct Snapshot {
+    int iters;          // work items per thread, -1 for a delta checkpoint
+    double delta;       // convergence threshold, -1 for an iteration checkpoint
+    bool reached;       // false if the computation ended before the checkpoint
+    long int items;     // work items the snapshot is made of
+    double stdev;       // convergence estimate when the checkpoint was hit
+    float *K;           // normalized packed kernel, see kernel_index
+} Snapshot;
+
+// Order in which the approximate algorithm samples the mismatch combinations
+enum Sampling {
+    UNIFORM,        // uniformly random
+    STRATIFIED,     // every prefix removes each position about equally often
+    ANTITHETIC      // each combination followed by its shift by g / 2 positions
+};
+
+// How far an approximate computation got
+typedef struct Convergence {
+    int items;              // work items (mismatch combinations) computed
+    int total;              // work items of the exact kernel
+    double stdev;           // final convergence estimate, NaN if not tracked
+    bool budget_expired;    // stopped by the time budget
+} Convergence;
 
 typedef struct kernel_params {
     int g;
@@ -12,10 +63,10 @@ typedef struct kernel_params {
     long int n_str_test;
     long int total_str;
     long int n_str_pairs;
+    KernelLayout layout;
     Feature *features;
     int dict_size;
     int num_threads;
-    int num_mutex;
     WorkItem *workQueue;
     int queueSize;
     bool quiet;
@@ -23,19 +74,115 @@ typedef struct kernel_params {
     double delta;
     int max_iters;
     bool skip_variance;
+    bool shared_accumulator;
+    bool sort_reuse;
+    long int variance_sample;       // train pairs the variance is tracked on, 0 for all
+    bool global_convergence;        // one variance estimate shared by all threads
+    Sampling sampling;
+    unsigned int seed;              // of the combination order and variance sample
+    double timeout;                 // seconds, -1 for no deadline
+    double time_budget;             // seconds, -1 for no budget
+    std::atomic<bool> *cancel;      // set from another thread to cancel, may be NULL
+    const ProgressFn *progress;     // may be NULL
+    double progress_interval;       // seconds between progress reports
+    Profile *profile;               // NULL unless profiling
+    const std::vector<int> *snapshot_iters;     // ascending, may be NULL
+    const std::vector<double> *snapshot_deltas; // descending, may be NULL
 } kernel_params;
 
+// Per-thread state of the depth-first walk of KernelFunction::compute_family.
+// Level d holds the g-mers still active at a subset of d kept positions,
+// ordered by group of g-mers agreeing on those positions.
+typedef struct FamilyWalk {
+    unsigned int **Ks;              // one partial kernel per subset size
+    unsigned int *idx[MAXG + 1];    // feature indexes
+    uint64_t *gid[MAXG + 1];        // group ids, 0, 1, .. along the order
+    unsigned int *seq[MAXG + 1];    // sequence of each g-mer
+    unsigned int *w[MAXG + 1];      // occurrences of each g-mer
+    long int n[MAXG + 1];
+    unsigned int *order;            // scratch space of the bucket sorts
+    unsigned int *tmp;
+    long int *bucket;
+    long int *group_hist;
+} FamilyWalk;
+
 class KernelFunction {
     kernel_params* params;
+    // per-thread partial kernels, kept alive until the reduction step
+    unsigned int **partial_Ks;
+    double **partial_K_hats;
+    // factor applied to each partial kernel when merging them
+    double *partial_scales;
+    // sorted indexes of the kernel entries the variance is tracked on, NULL for all
+    long int *sample;
+    long int n_sample;
+    // variance estimate shared by all threads with global_convergence
+    std::mutex estimate_mutex;
+    long int est_n;
+    double *est_mean;
+    double *est_m2;
+    // running sums of the snapshots until every thread has added its partial
+    // kernel; iteration checkpoints come first, then the delta ones
+    double **snapshot_sums;
+    int *snapshot_threads;
+    std::mutex *snapshot_mutexes;
+    int n_snapshot_iters;
+    std::atomic<int> deltas_reached;
+    // single partial kernel shared by all threads in shared accumulator mode
+    unsigned int *shared_Ks;
+    // index of the next work item to hand out, and flag to end all threads early
+    std::atomic<int> next_item;
+    int block_size;
+    std::atomic<bool> stop;
+    // why the threads were stopped early, see interrupted()
+    enum { RUNNING, CANCELLED, TIMED_OUT };
+    std::atomic<int> interrupt;
+    std::chrono::steady_clock::time_point deadline;
+    // the threads stop once past it but keep their partial kernels
+    std::chrono::steady_clock::time_point budget_deadline;
+    std::atomic<bool> budget_expired;
+    // progress shared with the thread reporting it
+    std::atomic<int> items_done;
+    std::atomic<double> current_sd;
+    int threads_done;
+    std::mutex done_mutex;
+    std::condition_variable done_cv;
+
+    bool interrupted();
+    void report_progress(int, std::chrono::steady_clock::time_point);
+    void free_partials(int);
+    // subset sizes (g - m) of the kernel family, the partial kernels of each
+    // thread (num_threads x sizes) and the subsets the walks start from
+    std::vector<int> family_sizes;
+    unsigned int **family_Ks;
+    std::vector<std::vector<int> > family_tasks;
+    int family_chars;
+    bool family_reachable(int, int);
+    void family_refine(FamilyWalk*, int, int, bool);
+    void family_visit(FamilyWalk*, int, int);
+    void add_snapshot(int, const unsigned int*, const double*, double, long int, bool);
+    void trigger_deltas(double);
 
 public:
     std::vector<double> stdevs;
+    std::vector<int> work_counts;
+    std::vector<Snapshot> snapshots;
+    Convergence convergence;
     KernelFunction(kernel_params*);
     double* compute_kernel();
-    void kernel_build_parallel(int, WorkItem*, int, pthread_mutex_t*, kernel_params*, double*);
+    std::vector<double*> compute_family(const std::vector<int>&);
+    void family_build_parallel(int);
+    void kernel_build_parallel(int, WorkItem*, int, kernel_params*);
+    void reduce_partials(int, long int, long int, double*, const double*);
+    void add_partial(int, long int, long int, double*);
     double get_variance(unsigned int*, double*, double *, int, int, int);
+    double get_sample_variance(unsigned int*, unsigned int*, double*, int);
+    void update_estimate(unsigned int*, unsigned int*, double*, double*, long int*);
 };
 
-double* construct_test_kernel(int, int, double*);
+long int variance_pairs(const kernel_params*);
+void get_tiles(const KernelLayout*, int, long int*);
+
+double* construct_test_kernel(int, int, double*, const KernelLayout*);
 
 #endif
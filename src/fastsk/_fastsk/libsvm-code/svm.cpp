@@ -7,6 +7,13 @@
 #include <stdarg.h>
 #include <limits.h>
 #include <locale.h>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <atomic>
+#include <functional>
+#include <vector>
+#include <random>
 #include "svm.h"
 #include "eval.h"
 //#include "../fastsk_kernel.hpp"
@@ -39,6 +46,7 @@ static inline double powi(double base, int times)
 }
 #define INF HUGE_VAL
 #define TAU 1e-12
+#define MIN_PART 4096	// fewest variables per thread in the solver's parallel loops
 #define Malloc(type,n) (type *)malloc((n)*sizeof(type))
 
 static void print_string_stdout(const char *s)
@@ -234,8 +242,12 @@ private:
 	//static double fastsk_dot(const svm_node *px, const svm_node *py);
 	static double dot(const svm_node *px, const svm_node *py);
 
+	const double *packed_K;
+
 	double kernel_fastsk(int i, int j) const
 	{
+		if(packed_K)
+			return svm_packed_kernel(packed_K,(int)x[i][0].value,(int)x[j][0].value);
     	return x[i][j].value;
 	}
 	double kernel_linear(int i, int j) const
@@ -262,7 +274,7 @@ private:
 
 Kernel::Kernel(int l, svm_node * const * x_, const svm_parameter& param)
 :kernel_type(param.kernel_type), degree(param.degree),
- gamma(param.gamma), coef0(param.coef0)
+ gamma(param.gamma), coef0(param.coef0), packed_K(param.packed_K)
 {
 	this->l = l; //so we can use it to access elements with only x and y values
 
@@ -307,6 +319,12 @@ Kernel::~Kernel()
 }
 
 
+double svm_packed_kernel(const double *packed_K, int a, int b)
+{
+	if(a < b) swap(a,b);
+	return packed_K[(long int)a*(a+1)/2+b];
+}
+
 double Kernel::dot(const svm_node *px, const svm_node *py)
 {
 	double sum = 0;
@@ -384,6 +402,8 @@ double Kernel::k_function(const svm_node *x, const svm_node *y,
 		case PRECOMPUTED:  //x: test (validation), y: SV
 			return x[(int)(y->value)].value;
 		case FASTSK:
+			if(param.packed_K && x->index == 0 && y->index == 0)
+				return svm_packed_kernel(param.packed_K,(int)x->value,(int)y->value);
 			return 0;//*(x).value;
 		default:
 			return 0;  // Unreachable 
@@ -408,9 +428,109 @@ double Kernel::k_function(const svm_node *x, const svm_node *y,
 //
 // solution will be put in \alpha, objective value will be put in obj
 //
+// Runs a task over [0, n) cut into contiguous parts, part p on thread p, the
+// calling thread doing part 0. The workers spin for a while between tasks,
+// which are short, then sleep.
+class ThreadPool {
+public:
+	typedef std::function<void(int part, int begin, int end)> Task;
+
+	ThreadPool(int num_threads)
+	:num_threads(num_threads), generation(0), pending(0), stop(false)
+	{
+		job.task = NULL;
+		job.n = job.parts = 0;
+		job.generation = 0;
+		for(int t=1;t<num_threads;t++)
+			threads.push_back(std::thread(&ThreadPool::work,this,t));
+	}
+	~ThreadPool()
+	{
+		{
+			std::lock_guard<std::mutex> lock(mutex);
+			stop = true;
+			generation++;
+		}
+		cv.notify_all();
+		for(auto &t : threads)
+			t.join();
+	}
+	int size() const { return num_threads; }
+	void run(int n, int parts, const Task &fn)
+	{
+		Job current;
+		{
+			std::lock_guard<std::mutex> lock(mutex);
+			job.task = &fn;
+			job.n = n;
+			job.parts = parts;
+			job.generation = generation+1;
+			current = job;
+			pending = parts-1;
+			generation++;
+		}
+		cv.notify_all();
+		do_part(current,0);
+		while(pending.load() > 0)
+			std::this_thread::yield();
+	}
+private:
+	// one run, published under mutex; a worker copies it and does at most its
+	// own part of each generation
+	struct Job {
+		const Task *task;
+		int n, parts;
+		long generation;
+	};
+	int num_threads;
+	std::vector<std::thread> threads;
+	std::mutex mutex;
+	std::condition_variable cv;
+	std::atomic<long> generation;
+	std::atomic<int> pending;
+	bool stop;
+	Job job;
+
+	static void do_part(const Job &j, int p)
+	{
+		(*j.task)(p,(int)((long int)j.n*p/j.parts),(int)((long int)j.n*(p+1)/j.parts));
+	}
+	void work(int tid)
+	{
+		long seen = 0;
+		while(true)
+		{
+			for(int spins=0;generation.load()==seen;spins++)
+			{
+				if(spins < 1000)
+					std::this_thread::yield();
+				else
+				{
+					std::unique_lock<std::mutex> lock(mutex);
+					cv.wait(lock,[&]{ return generation.load()!=seen; });
+				}
+			}
+			Job current;
+			{
+				std::lock_guard<std::mutex> lock(mutex);
+				if(stop) return;
+				current = job;
+			}
+			// runs with no part for this thread may have come and gone
+			// meanwhile, only the latest one is looked at
+			seen = current.generation;
+			if(tid < current.parts)
+			{
+				do_part(current,tid);
+				pending--;
+			}
+		}
+	}
+};
+
 class Solver {
 public:
-	Solver() {};
+	Solver(int num_threads = 1): num_threads(num_threads) {};
 	virtual ~Solver() {};
 
 	struct SolutionInfo {
@@ -441,6 +561,28 @@ protected:
 	int l;
 	bool unshrink;	// XXX
 
+	// the O(l) loops of an iteration run on num_threads threads once l is
+	// long enough, see parallel_for
+	int num_threads;
+	ThreadPool *pool;
+	struct ScanResult {
+		double Gmax, Gmax2, obj_diff_min;
+		int Gmax_idx, Gmin_idx;
+	};
+	ScanResult *scan;
+	int num_parts(int n)
+	{
+		if(!pool) return 1;
+		return max(1,min(pool->size(),n/MIN_PART));
+	}
+	void parallel_for(int n, int parts, const ThreadPool::Task &fn)
+	{
+		if(parts > 1)
+			pool->run(n,parts,fn);
+		else
+			fn(0,0,n);
+	}
+
 	double get_C(int i)
 	{
 		return (y[i] > 0)? Cp : Cn;
@@ -533,6 +675,8 @@ void Solver::Solve(int l, const QMatrix& Q, const double *p_, const schar *y_,
 	this->Cn = Cn;
 	this->eps = eps;
 	unshrink = false;
+	pool = (num_threads > 1 && l >= 2*MIN_PART) ? new ThreadPool(num_threads) : NULL;
+	scan = new ScanResult[max(num_threads,1)];
 
 	// initialize alpha_status
 	{
@@ -710,10 +854,11 @@ void Solver::Solve(int l, const QMatrix& Q, const double *p_, const schar *y_,
 		double delta_alpha_i = alpha[i] - old_alpha_i;
 		double delta_alpha_j = alpha[j] - old_alpha_j;
 		
-		for(int k=0;k<active_size;k++)
+		parallel_for(active_size,num_parts(active_size),[&](int, int begin, int end)
 		{
-			G[k] += Q_i[k]*delta_alpha_i + Q_j[k]*delta_alpha_j;
-		}
+			for(int k=begin;k<end;k++)
+				G[k] += Q_i[k]*delta_alpha_i + Q_j[k]*delta_alpha_j;
+		});
 
 		// update alpha_status and G_bar
 
@@ -722,27 +867,26 @@ void Solver::Solve(int l, const QMatrix& Q, const double *p_, const schar *y_,
 			bool uj = is_upper_bound(j);
 			update_alpha_status(i);
 			update_alpha_status(j);
-			int k;
 			if(ui != is_upper_bound(i))
 			{
 				Q_i = Q.get_Q(i,l);
-				if(ui)
-					for(k=0;k<l;k++)
-						G_bar[k] -= C_i * Q_i[k];
-				else
-					for(k=0;k<l;k++)
-						G_bar[k] += C_i * Q_i[k];
+				double c_i = ui ? -C_i : C_i;
+				parallel_for(l,num_parts(l),[&](int, int begin, int end)
+				{
+					for(int k=begin;k<end;k++)
+						G_bar[k] += c_i * Q_i[k];
+				});
 			}
 
 			if(uj != is_upper_bound(j))
 			{
 				Q_j = Q.get_Q(j,l);
-				if(uj)
-					for(k=0;k<l;k++)
-						G_bar[k] -= C_j * Q_j[k];
-				else
-					for(k=0;k<l;k++)
-						G_bar[k] += C_j * Q_j[k];
+				double c_j = uj ? -C_j : C_j;
+				parallel_for(l,num_parts(l),[&](int, int begin, int end)
+				{
+					for(int k=begin;k<end;k++)
+						G_bar[k] += c_j * Q_j[k];
+				});
 			}
 		}
 	}
@@ -799,6 +943,8 @@ void Solver::Solve(int l, const QMatrix& Q, const double *p_, const schar *y_,
 	delete[] active_set;
 	delete[] G;
 	delete[] G_bar;
+	delete[] scan;
+	delete pool;
 }
 
 // return 1 if already optimal, return 0 otherwise
@@ -810,30 +956,46 @@ int Solver::select_working_set(int &out_i, int &out_j)
 	//    (if quadratic coefficeint <= 0, replace it with tau)
 	//    -y_j*grad(f)_j < -y_i*grad(f)_i, j in I_low(\alpha)
 	
+	// each part of the active set is scanned on its own, then the parts are
+	// merged in order so that ties go to the last index, as in a single scan
 	double Gmax = -INF;
 	double Gmax2 = -INF;
 	int Gmax_idx = -1;
 	int Gmin_idx = -1;
 	double obj_diff_min = INF;
+	int parts = num_parts(active_size);
 
-	for(int t=0;t<active_size;t++)
-		if(y[t]==+1)	
-		{
-			if(!is_upper_bound(t))
-				if(-G[t] >= Gmax)
-				{
-					Gmax = -G[t];
-					Gmax_idx = t;
-				}
-		}
-		else
+	parallel_for(active_size,parts,[&](int part, int begin, int end)
+	{
+		double Gmax = -INF;
+		int Gmax_idx = -1;
+		for(int t=begin;t<end;t++)
+			if(y[t]==+1)	
+			{
+				if(!is_upper_bound(t))
+					if(-G[t] >= Gmax)
+					{
+						Gmax = -G[t];
+						Gmax_idx = t;
+					}
+			}
+			else
+			{
+				if(!is_lower_bound(t))
+					if(G[t] >= Gmax)
+					{
+						Gmax = G[t];
+						Gmax_idx = t;
+					}
+			}
+		scan[part].Gmax = Gmax;
+		scan[part].Gmax_idx = Gmax_idx;
+	});
+	for(int p=0;p<parts;p++)
+		if(scan[p].Gmax_idx != -1 && scan[p].Gmax >= Gmax)
 		{
-			if(!is_lower_bound(t))
-				if(G[t] >= Gmax)
-				{
-					Gmax = G[t];
-					Gmax_idx = t;
-				}
+			Gmax = scan[p].Gmax;
+			Gmax_idx = scan[p].Gmax_idx;
 		}
 
 	int i = Gmax_idx;
@@ -841,56 +1003,75 @@ int Solver::select_working_set(int &out_i, int &out_j)
 	if(i != -1) // NULL Q_i not accessed: Gmax=-INF if i=-1
 		Q_i = Q->get_Q(i,active_size);
 
-	for(int j=0;j<active_size;j++)
+	parallel_for(active_size,parts,[&](int part, int begin, int end)
 	{
-		if(y[j]==+1)
+		double Gmax2 = -INF;
+		int Gmin_idx = -1;
+		double obj_diff_min = INF;
+		for(int j=begin;j<end;j++)
 		{
-			if (!is_lower_bound(j))
+			if(y[j]==+1)
 			{
-				double grad_diff=Gmax+G[j];
-				if (G[j] >= Gmax2)
-					Gmax2 = G[j];
-				if (grad_diff > 0)
+				if (!is_lower_bound(j))
 				{
-					double obj_diff;
-					double quad_coef = QD[i]+QD[j]-2.0*y[i]*Q_i[j];
-					if (quad_coef > 0)
-						obj_diff = -(grad_diff*grad_diff)/quad_coef;
-					else
-						obj_diff = -(grad_diff*grad_diff)/TAU;
-
-					if (obj_diff <= obj_diff_min)
+					double grad_diff=Gmax+G[j];
+					if (G[j] >= Gmax2)
+						Gmax2 = G[j];
+					if (grad_diff > 0)
 					{
-						Gmin_idx=j;
-						obj_diff_min = obj_diff;
+						double obj_diff;
+						double quad_coef = QD[i]+QD[j]-2.0*y[i]*Q_i[j];
+						if (quad_coef > 0)
+							obj_diff = -(grad_diff*grad_diff)/quad_coef;
+						else
+							obj_diff = -(grad_diff*grad_diff)/TAU;
+
+						if (obj_diff <= obj_diff_min)
+						{
+							Gmin_idx=j;
+							obj_diff_min = obj_diff;
+						}
 					}
 				}
 			}
-		}
-		else
-		{
-			if (!is_upper_bound(j))
+			else
 			{
-				double grad_diff= Gmax-G[j];
-				if (-G[j] >= Gmax2)
-					Gmax2 = -G[j];
-				if (grad_diff > 0)
+				if (!is_upper_bound(j))
 				{
-					double obj_diff;
-					double quad_coef = QD[i]+QD[j]+2.0*y[i]*Q_i[j];
-					if (quad_coef > 0)
-						obj_diff = -(grad_diff*grad_diff)/quad_coef;
-					else
-						obj_diff = -(grad_diff*grad_diff)/TAU;
-
-					if (obj_diff <= obj_diff_min)
+					double grad_diff= Gmax-G[j];
+					if (-G[j] >= Gmax2)
+						Gmax2 = -G[j];
+					if (grad_diff > 0)
 					{
-						Gmin_idx=j;
-						obj_diff_min = obj_diff;
+						double obj_diff;
+						double quad_coef = QD[i]+QD[j]+2.0*y[i]*Q_i[j];
+						if (quad_coef > 0)
+							obj_diff = -(grad_diff*grad_diff)/quad_coef;
+						else
+							obj_diff = -(grad_diff*grad_diff)/TAU;
+
+						if (obj_diff <= obj_diff_min)
+						{
+							Gmin_idx=j;
+							obj_diff_min = obj_diff;
+						}
 					}
 				}
 			}
 		}
+		scan[part].Gmax2 = Gmax2;
+		scan[part].Gmin_idx = Gmin_idx;
+		scan[part].obj_diff_min = obj_diff_min;
+	});
+	for(int p=0;p<parts;p++)
+	{
+		if(scan[p].Gmax2 >= Gmax2)
+			Gmax2 = scan[p].Gmax2;
+		if(scan[p].Gmin_idx != -1 && scan[p].obj_diff_min <= obj_diff_min)
+		{
+			Gmin_idx = scan[p].Gmin_idx;
+			obj_diff_min = scan[p].obj_diff_min;
+		}
 	}
 
 	if(Gmax+Gmax2 < eps || Gmin_idx == -1){
@@ -1029,7 +1210,7 @@ double Solver::calculate_rho()
 class Solver_NU: public Solver
 {
 public:
-	Solver_NU() {}
+	Solver_NU(int num_threads = 1): Solver(num_threads) {}
 	void Solve(int l, const QMatrix& Q, const double *p, const schar *y,
 		   double *alpha, double Cp, double Cn, double eps,
 		   SolutionInfo* si, int shrinking)
@@ -1289,18 +1470,55 @@ public:
 	SVC_Q(const svm_problem& prob, const svm_parameter& param, const schar *y_)
 	:Kernel(prob.l, prob.x, param)
 	{
+		l = prob.l;
 		clone(y,y_,prob.l);
-		cache = new Cache(prob.l,(long int)(param.cache_size*(1<<20)));
+		cache = 0;
+		rows = 0;
+		filled = 0;
+		slot = 0;
+		computed = 0;
 		QD = new double[prob.l];
 		for(int i=0;i<prob.l;i++)
 			QD[i] = (this->*kernel_function)(i,i);
+		if(param.dense_Q)
+		{
+			// rows of Q are computed when first asked for and never evicted
+			rows = new Qfloat*[l];
+			filled = new int[l];
+			slot = new int[l];
+			computed = new int[l];
+			n_computed = 0;
+			for(int i=0;i<l;i++)
+			{
+				rows[i] = 0;
+				filled[i] = 0;
+				slot[i] = -1;
+			}
+		}
+		else
+			cache = new Cache(prob.l,(long int)(param.cache_size*(1<<20)));
 	}
 	
 	Qfloat *get_Q(int i, int len) const
 	{
 		Qfloat *data;
 		int start, j;
-		if((start = cache->get_data(i,&data,len)) < len)
+		if(rows)
+		{
+			if(!rows[i])
+			{
+				rows[i] = new Qfloat[l];
+				slot[i] = n_computed;
+				computed[n_computed++] = i;
+			}
+			data = rows[i];
+			start = filled[i];
+			if(start < len)
+				filled[i] = len;
+		}
+		else
+			start = cache->get_data(i,&data,len);
+		if(start < len)
 		{
 			for(j=start;j<len;j++)
 				data[j] = (Qfloat)(y[i]*y[j]*(this->*kernel_function)(i,j));
@@ -1315,7 +1533,10 @@ public:
 
 	void swap_index(int i, int j) const
 	{
-		cache->swap_index(i,j);
+		if(rows)
+			swap_rows(i,j);
+		else
+			cache->swap_index(i,j);
 		Kernel::swap_index(i,j);
 		swap(y[i],y[j]);
 		swap(QD[i],QD[j]);
@@ -1325,12 +1546,48 @@ public:
 	{
 		delete[] y;
 		delete cache;
+		if(rows)
+			for(int i=0;i<l;i++)
+				delete[] rows[i];
+		delete[] rows;
+		delete[] filled;
+		delete[] slot;
+		delete[] computed;
 		delete[] QD;
 	}
 private:
+	int l;
 	schar *y;
 	Cache *cache;
+	Qfloat **rows;	// dense_Q: row i holds Q(i, 0 .. filled[i] - 1)
+	int *filled;
+	int *computed;	// the n_computed rows allocated so far, row computed[slot[i]] = i
+	int *slot;
+	mutable int n_computed;
 	double *QD;
+
+	// as Cache::swap_index, rows only missing entry i are cut back to it
+	void swap_rows(int i, int j) const
+	{
+		if(i==j) return;
+		swap(rows[i],rows[j]);
+		swap(filled[i],filled[j]);
+		swap(slot[i],slot[j]);
+		if(slot[i] >= 0) computed[slot[i]] = i;
+		if(slot[j] >= 0) computed[slot[j]] = j;
+		if(i>j) swap(i,j);
+		for(int c=0;c<n_computed;c++)
+		{
+			int k = computed[c];
+			if(filled[k] > i)
+			{
+				if(filled[k] > j)
+					swap(rows[k][i],rows[k][j]);
+				else
+					filled[k] = i;
+			}
+		}
+	}
 };
 
 class ONE_CLASS_Q: public Kernel
@@ -1474,7 +1731,22 @@ static void solve_c_svc(
 		if(prob->y[i] > 0) y[i] = +1; else y[i] = -1;
 	}
 
-	Solver s;
+	if(param->warm_alpha)
+	{
+		// start from the given alpha clipped to the box, unless that
+		// breaks y^T alpha = 0
+		double sum = 0;
+		for(i=0;i<l;i++)
+		{
+			alpha[i] = min(max(param->warm_alpha[i],0.0),y[i] > 0 ? Cp : Cn);
+			sum += y[i]*alpha[i];
+		}
+		if(fabs(sum) > 1e-6*max(Cp,Cn))
+			for(i=0;i<l;i++)
+				alpha[i] = 0;
+	}
+
+	Solver s(param->num_threads);
 	s.Solve(l, SVC_Q(*prob,*param,y), minus_ones, y,
 		alpha, Cp, Cn, param->eps, si, param->shrinking);
 
@@ -1528,7 +1800,7 @@ static void solve_nu_svc(
 	for(i=0;i<l;i++)
 		zeros[i] = 0;
 
-	Solver_NU s;
+	Solver_NU s(param->num_threads);
 	s.Solve(l, SVC_Q(*prob,*param,y), zeros, y,
 		alpha, 1.0, 1.0, param->eps, si,  param->shrinking);
 	double r = si->r;
@@ -1571,7 +1843,7 @@ static void solve_one_class(
 		ones[i] = 1;
 	}
 
-	Solver s;
+	Solver s(param->num_threads);
 	s.Solve(l, ONE_CLASS_Q(*prob,*param), zeros, ones,
 		alpha, 1.0, 1.0, param->eps, si, param->shrinking);
 
@@ -1600,7 +1872,7 @@ static void solve_epsilon_svr(
 		y[i+l] = -1;
 	}
 
-	Solver s;
+	Solver s(param->num_threads);
 	s.Solve(2*l, SVR_Q(*prob,*param), linear_term, y,
 		alpha2, param->C, param->C, param->eps, si, param->shrinking);
 
@@ -1641,7 +1913,7 @@ static void solve_nu_svr(
 		y[i+l] = -1;
 	}
 
-	Solver_NU s;
+	Solver_NU s(param->num_threads);
 	s.Solve(2*l, SVR_Q(*prob,*param), linear_term, y,
 		alpha2, C, C, param->eps, si, param->shrinking);
 
@@ -1919,11 +2191,13 @@ static void svm_binary_svc_probability(
 	int *perm = Malloc(int,prob->l);
 	double *dec_values = Malloc(double,prob->l);
 
-	// random shuffle
+	// random shuffle, reproducible without touching rand() given a fold_seed
+	std::mt19937 rng(param->fold_seed);
 	for(i=0;i<prob->l;i++) perm[i]=i;
 	for(i=0;i<prob->l;i++)
 	{
-		int j = i+rand()%(prob->l-i);
+		int r = (param->fold_seed >= 0) ? (int)(rng()%(prob->l-i)) : rand()%(prob->l-i);
+		int j = i+r;
 		swap(perm[i],perm[j]);
 	}
 	for(i=0;i<nr_fold;i++)
@@ -1978,6 +2252,8 @@ static void svm_binary_svc_probability(
 			subparam.weight_label[1]=-1;
 			subparam.weight[0]=Cp;
 			subparam.weight[1]=Cn;
+			subparam.warm_alpha = param->warm_fold_alpha ? param->warm_fold_alpha+(long int)i*prob->l : NULL;
+			subparam.warm_fold_alpha = NULL;
 			struct svm_model *submodel = svm_train(&subprob,&subparam);
 			for(j=begin;j<end;j++)
 			{
@@ -2113,6 +2389,9 @@ svm_model *svm_train(const svm_problem *prob, const svm_parameter *param)
 {
 	svm_model *model = Malloc(svm_model,1);
 	model->param = *param;
+	model->param.warm_alpha = NULL;
+	model->param.warm_fold_alpha = NULL;
+	model->param.fold_seed = -1;
 	model->free_sv = 0;	// XXX
 
 	if(param->svm_type == ONE_CLASS ||
@@ -2231,16 +2510,36 @@ svm_model *svm_train(const svm_problem *prob, const svm_parameter *param)
 					sub_prob.y[ci+k] = -1;
 				}
 
+				// the warm start alpha in the order of sub_prob
+				svm_parameter sub_param = *param;
+				sub_param.warm_alpha = NULL;
+				if(param->warm_alpha && nr_class == 2)
+				{
+					sub_param.warm_alpha = Malloc(double,sub_prob.l);
+					for(k=0;k<ci;k++)
+						sub_param.warm_alpha[k] = param->warm_alpha[perm[si+k]];
+					for(k=0;k<cj;k++)
+						sub_param.warm_alpha[ci+k] = param->warm_alpha[perm[sj+k]];
+				}
+
 				if(param->probability)
-					svm_binary_svc_probability(&sub_prob,param,weighted_C[i],weighted_C[j],probA[p],probB[p]);
+					svm_binary_svc_probability(&sub_prob,&sub_param,weighted_C[i],weighted_C[j],probA[p],probB[p]);
 
-				f[p] = svm_train_one(&sub_prob,param,weighted_C[i],weighted_C[j]);
+				f[p] = svm_train_one(&sub_prob,&sub_param,weighted_C[i],weighted_C[j]);
 				for(k=0;k<ci;k++)
 					if(!nonzero[si+k] && fabs(f[p].alpha[k]) > 0)
 						nonzero[si+k] = true;
 				for(k=0;k<cj;k++)
 					if(!nonzero[sj+k] && fabs(f[p].alpha[ci+k]) > 0)
 						nonzero[sj+k] = true;
+				if(sub_param.warm_alpha)
+				{
+					for(k=0;k<ci;k++)
+						param->warm_alpha[perm[si+k]] = fabs(f[p].alpha[k]);
+					for(k=0;k<cj;k++)
+						param->warm_alpha[perm[sj+k]] = fabs(f[p].alpha[ci+k]);
+					free(sub_param.warm_alpha);
+				}
 				free(sub_prob.x);
 				free(sub_prob.y);
 				++p;
@@ -2456,7 +2755,11 @@ void svm_cross_validation(const svm_problem *prob, const svm_parameter *param, i
 			subprob.y[k] = prob->y[perm[j]];
 			++k;
 		}
-		struct svm_model *submodel = svm_train(&subprob,param);
+		// warm start alphas are indexed by the whole problem
+		svm_parameter subparam = *param;
+		subparam.warm_alpha = NULL;
+		subparam.warm_fold_alpha = NULL;
+		struct svm_model *submodel = svm_train(&subprob,&subparam);
 		if(param->probability && 
 		   (param->svm_type == C_SVC || param->svm_type == NU_SVC))
 		{
@@ -2544,7 +2847,9 @@ double svm_predict_values(const svm_model *model, const svm_node *x, double* dec
 		
 		double *kvalue = Malloc(double,l);
 		for(i=0;i<l;i++)
-			if (model->param.kernel_type == FASTSK){
+			if (model->param.kernel_type == FASTSK && model->param.packed_K && x->index == 0){
+				kvalue[i] = Kernel::k_function(x,model->SV[i],model->param);
+			}else if (model->param.kernel_type == FASTSK){
 				kvalue[i] = x[model->sv_indices[i]-1].value;
 			}else{
 				kvalue[i] = Kernel::k_function(x,model->SV[i],model->param);
@@ -2914,6 +3219,12 @@ svm_model *svm_load_model(const char *model_file_name)
 	// read parameters
 
 	svm_model *model = Malloc(svm_model,1);
+	model->param.packed_K = NULL;
+	model->param.dense_Q = 0;
+	model->param.num_threads = 1;
+	model->param.warm_alpha = NULL;
+	model->param.warm_fold_alpha = NULL;
+	model->param.fold_seed = -1;
 	model->rho = NULL;
 	model->probA = NULL;
 	model->probB = NULL;
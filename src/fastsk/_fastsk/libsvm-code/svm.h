@@ -45,6 +45,12 @@ struct svm_parameter
 	double p;	/* for EPSILON_SVR */
 	int shrinking;	/* use the shrinking heuristics */
 	int probability; /* do probability estimates */
+	const double *packed_K;	/* for FASTSK: kernel read by sample id, see svm_packed_kernel */
+	int dense_Q;	/* C_SVC and NU_SVC: keep every row of Q once computed, bypassing the cache */
+	int num_threads;	/* threads for the solver's loops over the variables */
+	double *warm_alpha;	/* C_SVC, two classes: alpha to start from by sample, NULL for 0, see svm_train */
+	double *warm_fold_alpha;	/* the same for the 5 folds of the probability estimates, 5 * l */
+	int fold_seed;	/* >= 0: seeds the shuffle of the probability folds, -1 uses rand() */
 };
 
 //
@@ -72,6 +78,15 @@ struct svm_model
 				/* 0 if svm_model is created by svm_train */
 };
 
+/* FASTSK with packed_K set: sample i is x[i] = {{0, id}, {-1, 0}}, and the
+kernel of ids a >= b is packed_K[a * (a + 1) / 2 + b], the lower triangle stored
+row by row */
+double svm_packed_kernel(const double *packed_K, int a, int b);
+
+/* With param->warm_alpha set, a two-class C_SVC starts from that alpha, clipped
+to [0, C], and stores its solution back into it, so solving again with a larger
+C continues from there. warm_fold_alpha does the same for the probability
+folds, which are only the same folds for the same fold_seed. */
 struct svm_model *svm_train(const struct svm_problem *prob, const struct svm_parameter *param);
 void svm_cross_validation(const struct svm_problem *prob, const struct svm_parameter *param, int nr_fold, double *target);
 
@@ -0,0 +1,74 @@
+#include "profile.h"
+#include <time.h>
+#include <stdio.h>
+#include <string.h>
+
+ProfileTime profile_now() {
+    struct timespec wall, cpu;
+    clock_gettime(CLOCK_MONOTONIC, &wall);
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &cpu);
+    ProfileTime t;
+    t.wall = wall.tv_sec + wall.tv_nsec * 1e-9;
+    t.cpu = cpu.tv_sec + cpu.tv_nsec * 1e-9;
+    return t;
+}
+
+Profile::Profile() {
+    this->reset();
+}
+
+void Profile::reset() {
+    this->origin = profile_now();
+    this->events.clear();
+    this->threads.clear();
+    this->bytes_allocated = 0;
+}
+
+void Profile::start_threads(int num_threads) {
+    this->threads.assign(num_threads, ThreadProfile());
+}
+
+// Record the phase that started at start and ends now. Each thread only
+// records into its own list of events.
+void Profile::record(std::vector<ProfileEvent> &events, const char *name, int tid, ProfileTime start) {
+    ProfileTime end = profile_now();
+    ProfileEvent e;
+    e.name = name;
+    e.tid = tid;
+    e.start = start.wall - this->origin.wall;
+    e.wall = end.wall - start.wall;
+    e.cpu = end.cpu - start.cpu;
+    events.push_back(e);
+}
+
+double Profile::elapsed() {
+    return profile_now().wall - this->origin.wall;
+}
+
+static void write_events(FILE *f, const std::vector<ProfileEvent> &events, bool *first) {
+    for (size_t i = 0; i < events.size(); i++) {
+        const ProfileEvent &e = events[i];
+        fprintf(f, "%s\n{\"name\": \"%s\", \"ph\": \"X\", \"pid\": 0, \"tid\": %d, \"ts\": %.3f, \"dur\": %.3f, "
+            "\"args\": {\"cpu_ms\": %.3f}}",
+            *first ? "" : ",", e.name, e.tid + 1, e.start * 1e6, e.wall * 1e6, e.cpu * 1e3);
+        *first = false;
+    }
+}
+
+// Write the phases in Chrome trace event format (chrome://tracing, Perfetto).
+// The calling thread is tid 0, worker t is tid t + 1.
+void Profile::save_trace(std::string trace_file) {
+    FILE *f = fopen(trace_file.c_str(), "w");
+    if (f == NULL) {
+        printf("Could not open %s for writing\n", trace_file.c_str());
+        return;
+    }
+    bool first = true;
+    fprintf(f, "{\"traceEvents\": [");
+    write_events(f, this->events, &first);
+    for (size_t t = 0; t < this->threads.size(); t++) {
+        write_events(f, this->threads[t].events, &first);
+    }
+    fprintf(f, "\n], \"displayTimeUnit\": \"ms\"}\n");
+    fclose(f);
+}
@@ -0,0 +1,54 @@
+#ifndef PROFILE_H
+#define PROFILE_H
+
+#include <string>
+#include <vector>
+
+// sort groups are counted in bins of sizes [2^b, 2^(b+1))
+#define GROUP_HIST_BINS 32
+
+// Wall clock seconds, and CPU seconds used by the calling thread
+typedef struct ProfileTime {
+    double wall;
+    double cpu;
+} ProfileTime;
+
+ProfileTime profile_now();
+
+// One timed phase. start is relative to the start of the computation,
+// tid is -1 for the thread that called compute_kernel
+typedef struct ProfileEvent {
+    const char *name;
+    int tid;
+    double start;
+    double wall;
+    double cpu;
+} ProfileEvent;
+
+typedef struct ThreadProfile {
+    std::vector<ProfileEvent> events;
+    long int group_hist[GROUP_HIST_BINS];
+    long int work_items;
+    long int bytes_allocated;
+    double finish;      // when the thread ran out of work
+    double idle;        // time spent waiting for the slowest thread
+} ThreadProfile;
+
+// Timings and counters of the last kernel computation, only recorded when
+// profiling is enabled
+class Profile {
+public:
+    ProfileTime origin;
+    std::vector<ProfileEvent> events;
+    std::vector<ThreadProfile> threads;
+    long int bytes_allocated;
+
+    Profile();
+    void reset();
+    void start_threads(int);
+    void record(std::vector<ProfileEvent>&, const char *, int, ProfileTime);
+    double elapsed();
+    void save_trace(std::string);
+};
+
+#endif
@@ -45,10 +45,13 @@ Features* extractFeatures(int **S, int *seqLengths, int nStr, int g) {
     if (nfeat != c) {
         printf("Something is wrong...\n");
     }
-    F = (Features *)malloc(sizeof(Features));
+    F = new Features;
     (*F).features = features;
     (*F).group = group;
     (*F).n = nfeat;
+    (*F).packed = NULL;
+    (*F).bits = 0;
+    (*F).count = NULL;
     return F;
 }
 
@@ -83,13 +86,238 @@ Features* extractFeatures(int **S, std::vector<int> seqLengths, int nStr, int g)
     if (nfeat != c) {
         printf("Something is wrong...\n");
     }
-    F = (Features *)malloc(sizeof(Features));
+    F = new Features;
     (*F).features = features;
     (*F).group = group;
     (*F).n = nfeat;
+    (*F).packed = NULL;
+    (*F).bits = 0;
+    (*F).count = NULL;
     return F;
 }
 
+// Same as above for sequences stored back to back in one token buffer,
+// sequence i being tokens[offsets[i]] .. tokens[offsets[i + 1] - 1]
+template <typename T>
+static Features* extractFlatFeatures(const T *tokens, const int64_t *offsets, int nStr, int g) {
+    int nfeat = 0;
+    for (int i = 0; i < nStr; ++i) {
+        int len = offsets[i + 1] - offsets[i];
+        nfeat += (len >= g) ? (len - g + 1) : 0;
+    }
+
+    int *group = (int *) malloc(nfeat * sizeof(int));
+    int *features = (int *) malloc(nfeat * g * sizeof(int));
+    int c = 0;
+    for (int i = 0; i < nStr; ++i) {
+        const T *s = tokens + offsets[i];
+        int len = offsets[i + 1] - offsets[i];
+        for (int j = 0; j < len - g + 1; ++j) {
+            for (int j1 = 0; j1 < g; ++j1) {
+                features[c + j1*nfeat] = s[j + j1];
+            }
+            group[c] = i;
+            c++;
+        }
+    }
+    Features *F = new Features;
+    (*F).features = features;
+    (*F).group = group;
+    (*F).n = nfeat;
+    (*F).packed = NULL;
+    (*F).bits = 0;
+    (*F).count = NULL;
+    return F;
+}
+
+Features* extractFeatures(const uint8_t *tokens, const int64_t *offsets, int nStr, int g) {
+    return extractFlatFeatures(tokens, offsets, nStr, g);
+}
+
+Features* extractFeatures(const int32_t *tokens, const int64_t *offsets, int nStr, int g) {
+    return extractFlatFeatures(tokens, offsets, nStr, g);
+}
+
+//pack every g-mer into a single 64-bit word, first position in the most significant bits.
+//leaves F->packed NULL if the alphabet is too large for g characters to fit.
+void packFeatures(Features *F, int g) {
+    int nfeat = (*F).n;
+    int *features = (*F).features;
+    int max_char = 0;
+    for (long int i = 0; i < (long int) nfeat * g; ++i) {
+        if (features[i] > max_char) {
+            max_char = features[i];
+        }
+    }
+    int bits = 1;
+    while ((1 << bits) <= max_char) {
+        bits++;
+    }
+    (*F).bits = bits;
+    if (g * bits > 64) {
+        return;
+    }
+
+    uint64_t *packed = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+    for (int j = 0; j < nfeat; ++j) {
+        uint64_t word = 0;
+        for (int j1 = 0; j1 < g; ++j1) {
+            word = (word << bits) | (uint64_t) features[j + j1 * nfeat];
+        }
+        packed[j] = word;
+    }
+    (*F).packed = packed;
+}
+
+//merge repeated occurrences of a g-mer within a sequence into one feature with a count.
+//features end up ordered by g-mer rather than by position.
+void dedupFeatures(Features *F, int g) {
+    int nfeat = (*F).n;
+    int *features = (*F).features;
+    int *group = (*F).group;
+    unsigned int *order = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+
+    // stable sort by g-mer keeps features of the same g-mer ordered by sequence
+    if ((*F).packed != NULL) {
+        uint64_t *keys = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+        uint64_t *keys_tmp = (uint64_t *) malloc(nfeat * sizeof(uint64_t));
+        unsigned int *order_tmp = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+        for (int j = 0; j < nfeat; ++j) {
+            keys[j] = (*F).packed[j];
+            order[j] = j;
+        }
+        radixsort(keys, order, keys_tmp, order_tmp, nfeat, g * (*F).bits);
+        free(keys);
+        free(keys_tmp);
+        free(order_tmp);
+    } else {
+        int max_char = 0;
+        for (long int i = 0; i < (long int) nfeat * g; ++i) {
+            if (features[i] > max_char) {
+                max_char = features[i];
+            }
+        }
+        cntsrtna(order, (unsigned int *) features, g, nfeat, max_char + 1);
+    }
+
+    // keep the first feature of every run of identical (g-mer, sequence)
+    int *first = (int *) malloc(nfeat * sizeof(int));
+    unsigned int *count = (unsigned int *) malloc(nfeat * sizeof(unsigned int));
+    int n = 0;
+    for (int j = 0; j < nfeat; ++j) {
+        int cur = order[j];
+        bool same = false;
+        if (n > 0 && group[first[n - 1]] == group[cur]) {
+            int prev = first[n - 1];
+            if ((*F).packed != NULL) {
+                same = (*F).packed[prev] == (*F).packed[cur];
+            } else {
+                same = true;
+                for (int j1 = 0; j1 < g; ++j1) {
+                    if (features[prev + j1 * nfeat] != features[cur + j1 * nfeat]) {
+                        same = false;
+                        break;
+                    }
+                }
+            }
+        }
+        if (same) {
+            count[n - 1]++;
+        } else {
+            first[n] = cur;
+            count[n] = 1;
+            n++;
+        }
+    }
+
+    int *new_features = (int *) malloc((long int) n * g * sizeof(int));
+    int *new_group = (int *) malloc(n * sizeof(int));
+    for (int j = 0; j < n; ++j) {
+        for (int j1 = 0; j1 < g; ++j1) {
+            new_features[j + j1 * n] = features[first[j] + j1 * nfeat];
+        }
+        new_group[j] = group[first[j]];
+    }
+    if ((*F).packed != NULL) {
+        uint64_t *new_packed = (uint64_t *) malloc(n * sizeof(uint64_t));
+        for (int j = 0; j < n; ++j) {
+            new_packed[j] = (*F).packed[first[j]];
+        }
+        free((*F).packed);
+        (*F).packed = new_packed;
+    }
+    free(features);
+    free(group);
+    free((*F).count);
+    (*F).features = new_features;
+    (*F).group = new_group;
+    (*F).count = (unsigned int *) realloc(count, n * sizeof(unsigned int));
+    (*F).n = n;
+
+    free(first);
+    free(order);
+}
+
+//split the kept positions of a combination into runs of consecutive positions so
+//a packed g-mer can be projected with one shift and mask per run. returns the number of runs.
+unsigned int get_runs(int *kept, int k, int g, int bits, unsigned int *shift, uint64_t *mask, unsigned int *len) {
+    unsigned int nruns = 0;
+    int j = 0;
+    while (j < k) {
+        int first = kept[j];
+        while (j + 1 < k && kept[j + 1] == kept[j] + 1) {
+            j++;
+        }
+        int last = kept[j];
+        len[nruns] = (last - first + 1) * bits;
+        shift[nruns] = (g - 1 - last) * bits;
+        mask[nruns] = (len[nruns] >= 64) ? ~((uint64_t) 0) : ((((uint64_t) 1) << len[nruns]) - 1);
+        nruns++;
+        j++;
+    }
+    return nruns;
+}
+
+//index of the first stored entry of row i
+long int row_start(const KernelLayout *layout, long int i) {
+    if (!layout->cross) {
+        return i * (i + 1) / 2;
+    }
+    long int n_a = layout->n_a;
+    if (i <= n_a) {
+        return layout->a_pairs ? i * (i + 1) / 2 : i;
+    }
+    long int a_size = layout->a_pairs ? n_a * (n_a + 1) / 2 : n_a;
+    return a_size + (i - n_a) * (n_a + 1);
+}
+
+//number of entries stored for the layout
+long int kernel_size(const KernelLayout *layout) {
+    return row_start(layout, layout->n_str);
+}
+
+//position of pair (i, j) in a kernel stored with the layout, or -1 if the pair is skipped.
+//rows of the trailing sequences in cross mode hold the n_a leading columns, then the diagonal.
+long int kernel_index(const KernelLayout *layout, long int i, long int j) {
+    if (j > i) {
+        std::swap(i, j);
+    }
+    if (!layout->cross) {
+        return i * (i + 1) / 2 + j;
+    }
+    long int n_a = layout->n_a;
+    if (i < n_a) {
+        if (layout->a_pairs) {
+            return i * (i + 1) / 2 + j;
+        }
+        return (i == j) ? i : -1;
+    }
+    if (j < n_a) {
+        return row_start(layout, i) + j;
+    }
+    return (i == j) ? row_start(layout, i) + n_a : -1;
+}
+
 // array: pointer to space (N*(N-1)/2)
 // i    : row
 // j    : col
@@ -190,6 +418,78 @@ void cntsrtna(unsigned int *out,unsigned int *sx, int k, int r, int na) {
     free(bc1);
 }
 
+//LSD radix sort of 64-bit keys (only the low key_bits are used), carrying vals along.
+//uses as few passes as possible with digits of at most 11 bits.
+void radixsort(uint64_t *keys, unsigned int *vals, uint64_t *keys_tmp, unsigned int *vals_tmp, int n, int key_bits) {
+    if (key_bits <= 0) {
+        return;
+    }
+    int passes = (key_bits + 10) / 11;
+    int digit_bits = (key_bits + passes - 1) / passes;
+    int nbuckets = 1 << digit_bits;
+    uint64_t digit_mask = nbuckets - 1;
+    int *counts = (int *) malloc(nbuckets * sizeof(int));
+    uint64_t *src_keys = keys, *dst_keys = keys_tmp;
+    unsigned int *src_vals = vals, *dst_vals = vals_tmp;
+
+    for (int p = 0; p < passes; ++p) {
+        int shift = p * digit_bits;
+        memset(counts, 0, nbuckets * sizeof(int));
+        for (int i = 0; i < n; ++i) {
+            counts[(src_keys[i] >> shift) & digit_mask]++;
+        }
+        int total = 0;
+        for (int b = 0; b < nbuckets; ++b) {
+            int c = counts[b];
+            counts[b] = total;
+            total += c;
+        }
+        for (int i = 0; i < n; ++i) {
+            int dst = counts[(src_keys[i] >> shift) & digit_mask]++;
+            dst_keys[dst] = src_keys[i];
+            dst_vals[dst] = src_vals[i];
+        }
+        std::swap(src_keys, dst_keys);
+        std::swap(src_vals, dst_vals);
+    }
+
+    if (src_keys != keys) {
+        memcpy(keys, src_keys, n * sizeof(uint64_t));
+        memcpy(vals, src_vals, n * sizeof(unsigned int));
+    }
+    free(counts);
+}
+
+//sort keys that are already ordered by their bits above low_bits: each run of keys
+//sharing those high bits is sorted by its low_bits, small runs by insertion sort.
+void refinesort(uint64_t *keys, unsigned int *vals, uint64_t *keys_tmp, unsigned int *vals_tmp, int n, int low_bits) {
+    int i = 0;
+    while (i < n) {
+        int start = i;
+        uint64_t high = keys[i] >> low_bits;
+        while (i < n && (keys[i] >> low_bits) == high) {
+            i++;
+        }
+        int len = i - start;
+        if (len > 32) {
+            radixsort(keys + start, vals + start, keys_tmp, vals_tmp, len, low_bits);
+        } else if (len > 1) {
+            for (int j = start + 1; j < i; ++j) {
+                uint64_t key = keys[j];
+                unsigned int val = vals[j];
+                int j1 = j - 1;
+                while (j1 >= start && keys[j1] > key) {
+                    keys[j1 + 1] = keys[j1];
+                    vals[j1 + 1] = vals[j1];
+                    j1--;
+                }
+                keys[j1 + 1] = key;
+                vals[j1 + 1] = val;
+            }
+        }
+    }
+}
+
 //update cumulative mismatch profile
 void countAndUpdate(unsigned int *outK, unsigned int *sx, unsigned int *g, int k, int r, int nStr) {
     bool same;
@@ -264,29 +564,100 @@ void countAndUpdate(unsigned int *outK, unsigned int *sx, unsigned int *g, int k
    free(curfeat);
 }
 
+//add val to a kernel entry, atomically if the kernel is shared between threads
+static inline void entry_add(unsigned int *entry, unsigned int val, bool atomic) {
+    if (atomic) {
+        __atomic_fetch_add(entry, val, __ATOMIC_RELAXED);
+    } else {
+        *entry += val;
+    }
+}
+
+//add the pairs of one group of matching g-mers (sorted positions startInd..endInd)
+//to outK, weighted by the feature counts w if given. outK is triangular unless a
+//cross layout is given. ucnts must be all zero and is left that way.
+static void updateGroupTri(unsigned int *outK, unsigned int *g, unsigned int *w, long int startInd, long int endInd,
+    int *ucnts, int *updind, int nStr, bool atomic, const KernelLayout *layout) {
+    long int j, j1;
+    long int cu = 0;
+
+    if (layout == NULL || !layout->cross) {
+        for (j = startInd; j <= endInd; ++j) {
+            if (ucnts[g[j]] == 0) {
+                updind[cu] = g[j];
+                cu++;
+            }
+            ucnts[g[j]] += (w != NULL) ? w[j] : 1;
+        }
+        for (j = 0; j < cu; j++) {
+            for (j1 = j; j1 < cu; j1++) {
+                entry_add(&tri_access(outK, updind[j1], updind[j]), ucnts[updind[j]]*ucnts[updind[j1]], atomic);
+            }
+        }
+        for (j = 0; j < cu; j++) {
+            ucnts[updind[j]] = 0;
+        }
+        return;
+    }
+
+    // cross layout: A sequences are collected at the front of updind, B ones at the back
+    long int n_a = layout->n_a;
+    long int ca = 0, cb = 0;
+    for (j = startInd; j <= endInd; ++j) {
+        if (ucnts[g[j]] == 0) {
+            if (g[j] < n_a) {
+                updind[ca++] = g[j];
+            } else {
+                updind[nStr - 1 - cb++] = g[j];
+            }
+        }
+        ucnts[g[j]] += (w != NULL) ? w[j] : 1;
+    }
+    for (j = 0; j < ca; j++) {
+        long int a = updind[j];
+        if (layout->a_pairs) {
+            for (j1 = j; j1 < ca; j1++) {
+                entry_add(&outK[kernel_index(layout, a, updind[j1])], ucnts[a]*ucnts[updind[j1]], atomic);
+            }
+        } else {
+            entry_add(&outK[a], ucnts[a]*ucnts[a], atomic);
+        }
+    }
+    for (j = 0; j < cb; j++) {
+        long int b = updind[nStr - 1 - j];
+        unsigned int *row = outK + row_start(layout, b);
+        for (j1 = 0; j1 < ca; j1++) {
+            entry_add(&row[updind[j1]], ucnts[b]*ucnts[updind[j1]], atomic);
+        }
+        entry_add(&row[n_a], ucnts[b]*ucnts[b], atomic);
+    }
+    for (j = 0; j < ca; j++) {
+        ucnts[updind[j]] = 0;
+    }
+    for (j = 0; j < cb; j++) {
+        ucnts[updind[nStr - 1 - j]] = 0;
+    }
+}
+
 //update cumulative mismatch profile for a triangular outK
-void countAndUpdateTri(unsigned int *outK, unsigned int *sx, unsigned int *g, int k, int r, int nStr) {
+//count a sort group of the given size in its power of two bin
+static inline void count_group(long int *group_hist, long int size) {
+    group_hist[63 - __builtin_clzl((unsigned long) size)]++;
+}
+
+void countAndUpdateTri(unsigned int *outK, unsigned int *sx, unsigned int *g, unsigned int *w, int k, int r, int nStr,
+    bool atomic, const KernelLayout *layout, long int *group_hist) {
     bool same;
     long int i, j;
-    long int cu;
-    long int startInd, endInd, j1;
+    long int startInd, endInd;
     unsigned int *curfeat = (unsigned int *)malloc(k*sizeof(unsigned int));
-    int *ucnts= (int *)malloc(nStr*sizeof(int));
-    int num_str_pairs = nStr * (nStr+1) / 2;
-
+    int *ucnts = (int *)calloc(nStr, sizeof(int));
     int *updind = (int *)malloc(nStr*sizeof(int));
-    memset(updind, 0, sizeof(int) * nStr);
-   
+
     i = 0;
     while (i<r) {
         for (j = 0; j < k; ++j)
-            curfeat[j]=sx[i+j*r]; 
-        same=1;
-        for (j = 0;j < k; ++j)
-        if (curfeat[j]!=sx[i+j*r]) {
-            same=false;
-            break;
-        }
+            curfeat[j]=sx[i+j*r];
         same=true;
         startInd=i;
         while (same && i<r) {
@@ -301,43 +672,40 @@ void countAndUpdateTri(unsigned int *outK, unsigned int *sx, unsigned int *g, in
         }
         endInd= (i<r) ? (i - 1) : (r - 1);
 
-        if ((long int) endInd - startInd + 1 > 1) {
-            memset(ucnts, 0, nStr * sizeof(int));
-            for (j = startInd;j <= endInd; ++j) {
-                ucnts[g[j]]++;
-            }
-            cu = 0;
-            for (j=0;j<nStr;j++) {
-                if (ucnts[j] > 0) {
-                    updind[cu] = j;
-                    cu++;
-                }
-            }
-            for (j=0;j<cu;j++) {
-                for (j1=j;j1<cu;j1++) {
-                    tri_access(outK, updind[j1], updind[j]) += ucnts[updind[j]]*ucnts[updind[j1]];
-                }
-            }
-        } else {
-            for (j = startInd;j <= endInd; ++j) {
-                for (j1 = startInd;j1 <= j; ++j1) {
-                    tri_access(outK, g[j1], g[j])++;
-                }
-            }
-        }
+        if (group_hist != NULL) count_group(group_hist, endInd - startInd + 1);
+        updateGroupTri(outK, g, w, startInd, endInd, ucnts, updind, nStr, atomic, layout);
     }
     free(updind);
     free(ucnts);
     free(curfeat);
+}
 
+//update cumulative mismatch profile for a triangular outK from sorted packed keys
+void countAndUpdateTriPacked(unsigned int *outK, uint64_t *keys, unsigned int *g, unsigned int *w, int r, int nStr,
+    bool atomic, const KernelLayout *layout, long int *group_hist) {
+    int *ucnts = (int *)calloc(nStr, sizeof(int));
+    int *updind = (int *)malloc(nStr*sizeof(int));
+
+    long int i = 0;
+    while (i < r) {
+        long int startInd = i;
+        uint64_t curkey = keys[i];
+        while (i < r && keys[i] == curkey) {
+            i++;
+        }
+        if (group_hist != NULL) count_group(group_hist, i - startInd);
+        updateGroupTri(outK, g, w, startInd, i - 1, ucnts, updind, nStr, atomic, layout);
+    }
+    free(updind);
+    free(ucnts);
 }
 
 unsigned nchoosek(unsigned n, unsigned k) {
     if (k > n) return 0;
     if (k * 2 > n) k = n-k;
     if (k == 0) return 1;
-    int result = n;
-    for(int i = 2; i <= k; ++i ) {
+    unsigned result = n;
+    for(unsigned i = 2; i <= k; ++i ) {
         result *= (n-i+1);
         result /= i;
     }
@@ -346,14 +714,14 @@ unsigned nchoosek(unsigned n, unsigned k) {
 
 void getCombinations(unsigned int n, unsigned int k, int *pos, unsigned int depth, unsigned int margin, unsigned int* cnt_comb, unsigned int *out, int num_comb) {
     if (depth >= k) {
-        for ( int j = 0; j < k; ++j) {
+        for (unsigned int j = 0; j < k; ++j) {
             out[cnt_comb[0] + j*num_comb] = pos[j];
         }
         cnt_comb[0]++;
         return;
     }
 
-    for (int j = margin; j < n; ++j) {
+    for (unsigned int j = margin; j < n; ++j) {
         pos[depth] = j;
         getCombinations(n, k, pos, depth + 1, j + 1, cnt_comb, out, num_comb);
     }
@@ -383,8 +751,8 @@ void validate_args(int g, int m) {
         printf("Provided:\n\tg = %d\n\tm = %d\n", g, m);
         exit(1);
     }
-    if (g > 20) {
-        printf("g must be at most 20\n");
+    if (g > MAXG) {
+        printf("g must be at most %d\n", MAXG);
         printf("Provided:\n\tg = %d\n", g);
         exit(1);
     }
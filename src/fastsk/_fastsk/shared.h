@@ -3,7 +3,9 @@
 
 #define STRMAXLEN 15000
 #define MAXNSTR 15000
+#define MAXG 20
 #include <string>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <cstdlib>
@@ -13,9 +15,14 @@ typedef struct Feature {
 	int *features;
 	int *group;
 	int n;
+	uint64_t *packed;	// g-mers packed into one word each, NULL if they don't fit
+	int bits;			// bits per character in packed
+	unsigned int *count;	// occurrences of each (g-mer, sequence) feature, NULL if all 1
 	~Feature() {
 		free(features);
 		free(group);
+		free(packed);
+		free(count);
 	}
 } Features;
 
@@ -31,21 +38,54 @@ typedef struct Dict {
 	char *word;
 } Dict;
 
+//which pairs of sequences the kernel stores. the triangular layout keeps every pair.
+//the cross layout drops pairs among the trailing (B) sequences, keeping their
+//self-similarities for normalization, and keeps pairs among the leading n_a (A)
+//sequences only if a_pairs is set. rows are stored one after another.
+typedef struct KernelLayout {
+	bool cross;
+	bool a_pairs;
+	long int n_a;
+	long int n_str;
+} KernelLayout;
+
 typedef struct WorkItem {
 	int m;
 	int combo_num;
 } WorkItem;
 
+// the returned Features are allocated with new, release them with delete
 Features* extractFeatures(int **S, std::vector<int> seqLengths, int nStr, int g);
 Features* extractFeatures(int **S, int* seqLengths, int nStr, int g);
+Features* extractFeatures(const uint8_t *tokens, const int64_t *offsets, int nStr, int g);
+Features* extractFeatures(const int32_t *tokens, const int64_t *offsets, int nStr, int g);
+void packFeatures(Features *F, int g);
+void dedupFeatures(Features *F, int g);
+unsigned int get_runs(int *kept, int k, int g, int bits, unsigned int *shift, uint64_t *mask, unsigned int *len);
+//project a packed g-mer onto the runs of kept positions computed by get_runs
+inline uint64_t project_key(uint64_t word, unsigned int nruns, unsigned int *shift, uint64_t *mask, unsigned int *len) {
+    uint64_t key = 0;
+    for (unsigned int r = 0; r < nruns; ++r) {
+        key = (key << len[r]) | ((word >> shift[r]) & mask[r]);
+    }
+    return key;
+}
+long int row_start(const KernelLayout *layout, long int i);
+long int kernel_size(const KernelLayout *layout);
+long int kernel_index(const KernelLayout *layout, long int i, long int j);
 double& tri_access(double* array, int i, int j);
 unsigned int& tri_access(unsigned int* array, int i, int j, int N);
 unsigned int& tri_access(unsigned int* array, int i, int j);
 char *trimwhitespace(char *s);
 std::string trim(std::string& s);
 void cntsrtna(unsigned int *out,unsigned int *sx, int k, int r, int na);
+void radixsort(uint64_t *keys, unsigned int *vals, uint64_t *keys_tmp, unsigned int *vals_tmp, int n, int key_bits);
+void refinesort(uint64_t *keys, unsigned int *vals, uint64_t *keys_tmp, unsigned int *vals_tmp, int n, int low_bits);
 void countAndUpdate(unsigned int *outK, unsigned int *sx, unsigned int *g, int k, int r, int nStr);
-void countAndUpdateTri(unsigned int *outK, unsigned int *sx, unsigned int *g, int k, int r, int nStr);
+void countAndUpdateTri(unsigned int *outK, unsigned int *sx, unsigned int *g, unsigned int *w, int k, int r, int nStr,
+    bool atomic=false, const KernelLayout *layout=NULL, long int *group_hist=NULL);
+void countAndUpdateTriPacked(unsigned int *outK, uint64_t *keys, unsigned int *g, unsigned int *w, int r, int nStr,
+    bool atomic=false, const KernelLayout *layout=NULL, long int *group_hist=NULL);
 unsigned nchoosek(unsigned n, unsigned k);
 void getCombinations(unsigned int n, unsigned int k, int *pos, unsigned int depth, unsigned int margin, unsigned int *cnt_comb, unsigned int *out, int num_comb);
 void shuffle(WorkItem *array, size_t n);
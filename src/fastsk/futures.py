@@ -0,0 +1,84 @@
+"""Run FastSK jobs in the background.
+
+The native FastSK methods release the GIL while they compute, so a job
+started here runs alongside the caller's Python code, asyncio event loop
+and other jobs. Each job gets its own thread; use one FastSK object per
+job, a FastSK object must not run two jobs at once.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class KernelFuture(Future):
+    r"""A concurrent.futures.Future that can also be awaited from asyncio.
+
+    Examples
+    ----------
+    >>> future = compute_kernel_async(fastsk, Xtrain, Xtest)
+    >>> future.result()          # blocking, from any thread
+    >>> await future             # from a coroutine
+    """
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+def _run(future, fn, args, kwargs):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def submit(fn, *args, **kwargs):
+    r"""Call fn(*args, **kwargs) on a new thread.
+
+    Returns
+    ----------
+    future : KernelFuture
+        resolves to the return value of fn, or raises its exception.
+    """
+    future = KernelFuture()
+    thread = threading.Thread(target=_run, args=(future, fn, args, kwargs), daemon=True)
+    thread.start()
+    return future
+
+
+def compute_kernel_async(fastsk, Xtrain, Xtest, **kwargs):
+    r"""Non-blocking FastSK.compute_kernel, see submit."""
+    return submit(fastsk.compute_kernel, Xtrain, Xtest, **kwargs)
+
+
+def compute_kernel_flat_async(fastsk, tokens, offsets, **kwargs):
+    r"""Non-blocking FastSK.compute_kernel_flat, see submit."""
+    return submit(fastsk.compute_kernel_flat, tokens, offsets, **kwargs)
+
+
+def compute_dataset_async(fastsk, dataset, **kwargs):
+    r"""Non-blocking FastSK.compute_kernel of a Dataset, see submit.
+
+    A Dataset is read-only once built, so the kernels of several FastSK
+    objects with different (g, m) can be computed from it at the same time.
+    """
+    return submit(fastsk.compute_kernel, dataset, **kwargs)
+
+
+def compute_train_async(fastsk, Xtrain):
+    r"""Non-blocking FastSK.compute_train, see submit."""
+    return submit(fastsk.compute_train, Xtrain)
+
+
+def compute_cross_async(fastsk, A, B):
+    r"""Non-blocking FastSK.compute_cross, see submit."""
+    return submit(fastsk.compute_cross, A, B)
+
+
+def fit_async(fastsk, **kwargs):
+    r"""Non-blocking FastSK.fit, see submit."""
+    return submit(fastsk.fit, **kwargs)
@@ -0,0 +1,132 @@
+"""Grid search over g, m and C.
+
+C does not change the kernel, and compute_family gives the exact kernels of
+every m at a given g from one pass over the sequences, so the grid is walked
+one g at a time: the family is computed once, then every C is trained on each
+of its kernels along a single warm-started SVM path, see FastSK.fit_path.
+"""
+
+import csv
+import os
+
+from ._fastsk import FastSK
+from .futures import submit
+
+FIELDS = ["g", "m", "k", "C", "acc", "auc"]
+
+
+def _compute_family(dataset, g, ms, t, timeout):
+    kernel = FastSK(g=g, m=ms[0], t=t)
+    if timeout:
+        kernel.set_timeout(timeout)
+    kernel.compute_family(dataset, ms)
+    return kernel
+
+
+def grid_search(
+    dataset,
+    Ytrain,
+    Ytest,
+    g_vals,
+    C_vals,
+    ms=None,
+    t=1,
+    timeout=None,
+    prefetch=True,
+    output=None,
+    extra=None,
+):
+    r"""Train and evaluate an SVM for every (g, m, C) of a grid, computing
+    each kernel only once.
+
+    While the SVMs of one g are trained, the kernels of the next g are
+    computed in the background, so the kernel and SVM computations overlap.
+    This keeps two families of kernels in memory; pass prefetch=False to
+    hold one at a time.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        the train and test sequences.
+    Ytrain, Ytest : list
+        labels, > 0 for the positive class.
+    g_vals : list
+        the g values to try.
+    C_vals : list
+        the C values to try on every kernel.
+    ms : list, optional
+        the m values to try, the ones below g are used at each g. Defaults
+        to every m with k = g - m >= 3.
+    t : int
+        threads used by each kernel computation and SVM solver.
+    timeout : float, optional
+        seconds allowed for each kernel family, see FastSK.set_timeout.
+    prefetch : bool
+        compute the next kernel family while the SVMs are trained.
+    output : string, optional
+        CSV file each result is appended to as soon as it is known. The
+        header is written if the file is new or empty.
+    extra : dict, optional
+        constant columns put in front of every result, e.g. the dataset name.
+
+    Yields
+    ----------
+    result : dict
+        the extra columns followed by g, m, k, C, acc and auc, with acc a
+        fraction in [0, 1]. Results come g by g, m by m, C ascending.
+    """
+    extra = dict(extra or {})
+    families = []
+    for g in g_vals:
+        g_ms = list(range(0, g - 2)) if ms is None else [m for m in ms if m < g]
+        if g_ms:
+            families.append((g, g_ms))
+    if not families:
+        return
+
+    out, writer = None, None
+    if output:
+        new = not os.path.exists(output) or os.path.getsize(output) == 0
+        out = open(output, "a", newline="")
+        writer = csv.DictWriter(out, fieldnames=list(extra) + FIELDS)
+        if new:
+            writer.writeheader()
+            out.flush()
+
+    def start(family):
+        g, g_ms = family
+        return submit(_compute_family, dataset, g, g_ms, t, timeout)
+
+    try:
+        future = start(families[0]) if prefetch else None
+        for i, (g, g_ms) in enumerate(families):
+            if prefetch:
+                kernel = future.result()
+                if i + 1 < len(families):
+                    future = start(families[i + 1])
+            else:
+                kernel = _compute_family(dataset, g, g_ms, t, timeout)
+
+            kernel.set_labels(Ytrain, Ytest)
+            for m in g_ms:
+                kernel.select_m(m)
+                kernel.fit_path(C_vals, kernel_type="fastsk")
+                for C in kernel.get_path_Cs():
+                    kernel.select_C(C)
+                    scores = kernel.evaluate()
+                    result = dict(extra)
+                    result.update(
+                        g=g,
+                        m=m,
+                        k=g - m,
+                        C=C,
+                        acc=scores["accuracy"] / 100,
+                        auc=scores["auc"],
+                    )
+                    if writer:
+                        writer.writerow(result)
+                        out.flush()
+                    yield result
+    finally:
+        if out:
+            out.close()
@@ -1,6 +1,8 @@
 """Utils for reading fasta files
 """
 
+import numpy as np
+
 
 class Vocabulary(object):
     """A class for storing the vocabulary of a
@@ -95,6 +97,61 @@ class FastaUtility:
 
         return X, Y
 
+    def read_flat(self, data_file, regression=False):
+        r"""Read a FASTA-like file as read_data does, but return the sequences
+        as one flat token array plus offsets, the input format of
+        FastSK.compute_kernel_flat. Tokens get the same indexes as read_data
+        would give them.
+
+        Parameters
+        ----------
+        data_file : string
+            The path to the sequences.
+
+        Returns
+        ----------
+        tokens : numpy.ndarray
+            uint8 (int32 for vocabularies over 256 tokens) array of all
+            sequences back to back.
+        offsets : numpy.ndarray
+            int64 array, sequence i is tokens[offsets[i]:offsets[i + 1]].
+        Y : list
+            list of labels
+        """
+        seqs, Y = [], []
+        with open(data_file, "r") as f:
+            label_line = True
+            for line in f:
+                line = line.strip().lower()
+                if label_line:
+                    split = line.split(">")
+                    assert len(split) == 2
+                    if regression:
+                        label = split[1]
+                    else:
+                        label = int(split[1])
+                        assert label in [-1, 0, 1]
+                    Y.append(label)
+                    label_line = False
+                else:
+                    seqs.append(line)
+                    label_line = True
+            assert len(seqs) == len(Y)
+
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+        chars = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)
+
+        # add new characters in order of first appearance, like read_data
+        present, first = np.unique(chars, return_index=True)
+        table = np.zeros(256, dtype=np.int32)
+        for c in present[np.argsort(first)]:
+            table[c] = self._vocab.add(chr(c))
+        dtype = np.uint8 if self._vocab.size() <= 256 else np.int32
+        tokens = table.astype(dtype)[chars]
+
+        return tokens, offsets, Y
+
     def shortest_seq(self, data_file):
         X, Y = self.read_data(data_file)
         shortest = len(X[0])
@@ -0,0 +1,59 @@
+"""Quick validation script for the flat token input of compute_kernel_flat:
+tokens outside [0, dict_size) must be rejected before the kernel is computed.
+"""
+
+import argparse
+
+import numpy as np
+
+from fastsk import (
+    FastSK,
+    FastaUtility,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--train",
+        type=str,
+        default="../data/1.1.train.fasta",
+        help="training sequences file",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+def expect_value_error(tokens, offsets, dict_size):
+    try:
+        FastSK(g=14, m=11).compute_kernel_flat(tokens, offsets, dict_size=dict_size)
+    except ValueError:
+        return
+    raise AssertionError("tokens out of range for dict_size={}".format(dict_size))
+
+
+def main(args):
+    ## Get data
+    reader = FastaUtility()
+    tokens, offsets, _ = reader.read_flat(args.train)
+    dict_size = int(tokens.max()) + 1
+
+    ## Tokens too large for an explicit dict_size
+    expect_value_error(tokens, offsets, dict_size - 1)
+
+    ## Negative tokens, with and without an explicit dict_size
+    negative = tokens.astype(np.int32) - int(tokens.min()) - 1
+    expect_value_error(negative, offsets, -1)
+    expect_value_error(negative, offsets, dict_size)
+
+    ## Tokens in range
+    fastsk = FastSK(g=14, m=11)
+    fastsk.compute_kernel_flat(tokens, offsets, dict_size=dict_size)
+
+    print("Flat token checks passed")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    main(args)